@@ -0,0 +1,374 @@
+"""Benchmarks for ResidualBind.
+
+All data is synthetic with RNAcompete 2013 shapes, so no dataset download is
+needed. Results are written as json and can be compared with a stored
+baseline; timings that are slower than threshold x baseline are reported as
+regressions (non-zero exit code). A baseline is recorded with at least
+MIN_BASELINE_REPEATS repeats and is only compared against runs on a host with
+the same metadata (HOST_KEYS: machine, cores, library versions, threads).
+
+Usage:
+    python benchmark.py imports [--repeats 5] [--output imports.json]
+    python benchmark.py hotpaths [--scale small] [--output results.json]
+                                 [--baseline benchmark_baseline.json] [--threshold 1.25]
+                                 [--save-baseline --repeats 5] [--performance performance.json | --autotune predict]
+    python benchmark.py bucketing [--scale small] [--output bucketing.json]
+"""
+
+import os, sys, io, json, time, argparse, platform, subprocess, tempfile, contextlib
+import numpy as np
+
+
+#-------------------------------------------------------------------------------------
+# Cold-start import latency
+#-------------------------------------------------------------------------------------
+
+
+# entry points as they are used by drivers and scoring jobs
+IMPORT_ENTRY_POINTS = {
+    'residualbind': 'import residualbind',
+    'residualbind.generate_null_sequence_set': 'from residualbind import generate_null_sequence_set',
+    'residualbind.GlobalImportance': 'from residualbind import GlobalImportance',
+    'residualbind.ResidualBind()': 'from residualbind import ResidualBind; ResidualBind()',
+    'helper': 'import helper',
+    'helper.load_rnacompete_data': 'from helper import load_rnacompete_data',
+    'explain': 'import explain',
+    'numpy_inference': 'import numpy_inference',
+    'inference': 'import inference',
+    'tensorflow': 'import tensorflow',
+}
+
+
+def time_import(statement, repeats=5):
+    """cold-start latency of an import statement, each repeat in a fresh interpreter"""
+    code = ("import time, sys; start = time.perf_counter(); %s; "
+            "print(time.perf_counter() - start, 'tensorflow' in sys.modules)"%(statement))
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True,
+                                text=True, check=True).stdout.split()
+        times.append(float(output[-2]))
+    return {'median_sec': float(np.median(times)), 'min_sec': float(np.min(times)),
+            'loads_tensorflow': output[-1] == 'True'}
+
+
+def benchmark_imports(repeats=5, entry_points=None):
+    """cold-start import latency of each entry point"""
+    if entry_points is None:
+        entry_points = IMPORT_ENTRY_POINTS
+    results = {}
+    for name, statement in entry_points.items():
+        results[name] = time_import(statement, repeats)
+        print('%-45s %8.3f s  tensorflow: %s'%(name, results[name]['median_sec'], results[name]['loads_tensorflow']))
+    return results
+
+
+#-------------------------------------------------------------------------------------
+# Synthetic RNAcompete-shaped data
+#-------------------------------------------------------------------------------------
+
+
+SCALES = {
+    # num_train, num_valid, num_test, num_experiments, num_sequences (GIA nulls, mutagenesis, windows)
+    'small': {'num_train': 5000, 'num_valid': 500, 'num_test': 5000, 'num_experiments': 16, 'num_null': 1000,
+              'num_strings': 5000, 'num_profiles': 1000, 'num_explain': 10, 'num_windows': 50, 'kmer_size': 4},
+    'full': {'num_train': 108000, 'num_valid': 12000, 'num_test': 121000, 'num_experiments': 244, 'num_null': 1000,
+             'num_strings': 240000, 'num_profiles': 20000, 'num_explain': 100, 'num_windows': 500, 'kmer_size': 6},
+}
+
+
+def random_one_hot(num_seq, seq_length=41, alphabet_size=4, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.eye(alphabet_size, dtype=np.float32)[rng.randint(0, alphabet_size, (num_seq, seq_length))]
+
+
+def synthetic_rnacompete(file_path, num_train, num_valid, num_test, num_experiments, seq_length=41, seed=0):
+    """write an hdf5 file in the layout of generate_rnacompete_2013_dataset.py"""
+    import h5py
+    rng = np.random.RandomState(seed)
+    with h5py.File(file_path, 'w') as f:
+        for name, num_seq in [('train', num_train), ('valid', num_valid), ('test', num_test)]:
+            # sequence (4) and structure (5) channels, stored as (N, A, L)
+            X = np.concatenate([random_one_hot(num_seq, seq_length, 4, rng.randint(1e6)),
+                                rng.dirichlet(np.ones(5), (num_seq, seq_length)).astype(np.float32)], axis=2)
+            Y = rng.lognormal(size=(num_seq, num_experiments)).astype(np.float32)
+            Y[rng.uniform(size=Y.shape) < 0.01] = np.nan
+            f.create_dataset('X_'+name, data=X.transpose([0, 2, 1]), compression='gzip')
+            f.create_dataset('Y_'+name, data=Y, compression='gzip')
+        f.create_dataset('experiment', data=[('RNCMPT%05d'%(i)).encode('UTF8') for i in range(num_experiments)])
+    return file_path
+
+
+def synthetic_sequences(num_seq, min_length=30, max_length=41, seed=0):
+    rng = np.random.RandomState(seed)
+    return ["".join(rng.choice(list('ACGU'), rng.randint(min_length, max_length+1))) for _ in range(num_seq)]
+
+
+def synthetic_rnaplfold_profiles(profile_path, num_seq, seq_length=41, seed=0):
+    """write E/H/I/M profiles in the format of the modified RNAplfold scripts"""
+    rng = np.random.RandomState(seed)
+    probs = rng.dirichlet(np.ones(5), (num_seq, seq_length))/1.01
+    for k, name in enumerate(['E', 'H', 'I', 'M']):
+        with open(profile_path+name+'_profile.txt', 'w') as f:
+            for n in range(num_seq):
+                f.write('>seq %d\n'%(n))
+                f.write('\t'.join(['%.4f'%(p) for p in probs[n,:,k]]) + '\n')
+
+
+#-------------------------------------------------------------------------------------
+# Hot-path benchmarks
+#-------------------------------------------------------------------------------------
+
+
+def time_call(fn, repeats=3):
+    """wall-clock times of repeated calls, after one untimed warm-up call"""
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_hotpaths(scale='small', repeats=3, cases=None, performance=None):
+    """time each hot path on synthetic data (with a PerformanceConfig for the models);
+       returns name -> timing dictionary"""
+    import helper, explain
+    import residualbind as rb
+    import numpy_inference
+    import generate_rnacompete_2013_dataset as generate
+    size = SCALES[scale]
+
+    def quiet(fn):
+        def wrapper():
+            with contextlib.redirect_stdout(io.StringIO()):
+                return fn()
+        return wrapper
+
+    # synthetic data, profiles and weights are removed when the cases are done
+    with tempfile.TemporaryDirectory(prefix='residualbind_benchmark_') as tmp_dir:
+        # shared synthetic data
+        data_path = synthetic_rnacompete(os.path.join(tmp_dir, 'rnacompete.h5'), size['num_train'],
+                                         size['num_valid'], size['num_test'], size['num_experiments'])
+        train, valid, test = helper.load_rnacompete_data(data_path, rbp_index=0)
+        strings = synthetic_sequences(size['num_strings'])
+        profile_path = os.path.join(tmp_dir, 'rnaplfold')
+        synthetic_rnaplfold_profiles(profile_path, size['num_profiles'])
+        merged_path = profile_path + '_structure_profiles.txt'
+        generate.merge_structural_profile(profile_path, merged_path)
+
+        weights_path = os.path.join(tmp_dir, 'model_weights.hdf5')
+        model = rb.ResidualBind(list(train['inputs'].shape)[1:], 1, weights_path, performance=performance)
+        quiet(model.save_weights)()
+        frozen = rb.ResidualBind(list(train['inputs'].shape)[1:], 1, weights_path, performance=performance)
+        frozen.model.set_weights(model.model.get_weights())
+        frozen.freeze()
+        numpy_model = numpy_inference.NumpyResidualBind(weights_path)
+
+        gi = rb.GlobalImportance(frozen)
+        gi.set_null_model('profile', test['inputs'], num_sample=size['num_null'])
+        x_explain = test['inputs'][:size['num_explain']]
+        x_windows = random_one_hot(size['num_windows'], 200)
+        num_null = size['num_null']
+        num_kmers = 4**size['kmer_size']
+
+        # name: (function, number of items processed per call)
+        all_cases = {
+            'helper.load_rnacompete_data': (lambda: helper.load_rnacompete_data(data_path, rbp_index=0), size['num_train']+size['num_valid']+size['num_test']),
+            'generate.convert_one_hot': (lambda: generate.convert_one_hot(strings, 41), len(strings)),
+            'generate.merge_structural_profile': (lambda: generate.merge_structural_profile(profile_path, merged_path), size['num_profiles']),
+            'generate.extract_structural_profile': (lambda: generate.extract_structural_profile(merged_path, size['num_profiles'], 41), size['num_profiles']),
+            'null.profile': (lambda: rb.generate_null_sequence_set('profile', test['inputs'], num_null), num_null),
+            'null.random': (lambda: rb.generate_null_sequence_set('random', test['inputs'], num_null), num_null),
+            'null.dinuc': (lambda: rb.generate_null_sequence_set('dinuc', test['inputs'], num_null), num_null),
+            'null.quartile1': (lambda: rb.generate_null_sequence_set('quartile1', test['inputs'], num_null, test['targets']), num_null),
+            'gia.embed_patterns': (lambda: gi.embed_patterns([('UGCAUG', 17), ('GCGCGC', 2)]), num_null),
+            'gia.optimal_kmer': (lambda: gi.optimal_kmer(size['kmer_size'], 17), num_kmers*num_null),
+            'gia.kmer_mutagenesis': (lambda: gi.kmer_mutagenesis('UGCAUG', 17), 24*num_null),
+            'explain.mutagenesis': (quiet(lambda: explain.mutagenesis(model.model, x_explain)), len(x_explain)),
+            'explain.saliency': (lambda: explain.saliency(model.model, test['inputs'][:1000]), 1000),
+            'ResidualBind.predict': (quiet(lambda: model.predict(test['inputs'])), len(test['inputs'])),
+            'ResidualBind.predict (frozen)': (lambda: frozen.predict(test['inputs']), len(test['inputs'])),
+            'NumpyResidualBind.predict': (lambda: numpy_model.predict(test['inputs']), len(test['inputs'])),
+            'ResidualBind.predict_windows': (quiet(lambda: model.predict_windows(x_windows)), len(x_windows)*(200-41-1)),
+            'ResidualBind.fit (1 epoch)': (quiet(lambda: model.fit(train, valid, num_epochs=1)), len(train['inputs'])),
+        }
+        if cases is not None:
+            all_cases = {name: all_cases[name] for name in cases}
+
+        results = {}
+        for name, (fn, num_items) in all_cases.items():
+            times = time_call(fn, repeats)
+            results[name] = {'median_sec': float(np.median(times)), 'min_sec': float(np.min(times)),
+                             'items': int(num_items), 'items_per_sec': float(num_items/np.median(times))}
+            print('%-40s %10.4f s  %12.1f items/s'%(name, results[name]['median_sec'], results[name]['items_per_sec']))
+
+        # checkpoints written in the background by fit must finish before the directory is removed
+        model.wait_for_checkpoints()
+    return results
+
+
+def benchmark_bucketing(scale='small', repeats=3, performance=None, min_length=20, max_length=200,
+                        bucket_width=8, seed=0):
+    """variable-length ResidualBind on sequences of mixed lengths (most short, few long):
+       length-bucketed batches against padding every sequence to the longest one"""
+    import bucketing
+    import residualbind as rb
+    size = SCALES[scale]
+    rng = np.random.RandomState(seed)
+    num_seq = size['num_test']
+    lengths = np.minimum(max_length, min_length + rng.exponential(30, size=num_seq).astype(int))
+    sequences = [np.eye(4, dtype=np.float32)[rng.randint(4, size=length)] for length in lengths]
+    targets = rng.normal(size=(num_seq, 1)).astype(np.float32)
+    padded = bucketing.pad_to_max(sequences)
+    batches = bucketing.bucket_batches(lengths, 100, bucket_width)
+    print('lengths %d-%d (mean %.1f): padding is %.1f%% of the positions when padded to max, %.1f%% in buckets'%(
+          lengths.min(), lengths.max(), lengths.mean(), 100*bucketing.padding_fraction(lengths, [(np.arange(num_seq), lengths.max())]),
+          100*bucketing.padding_fraction(lengths, batches)))
+
+    model = rb.ResidualBind((None, 4), 1, os.devnull, performance=performance)
+    model._compile_model(0.001)
+    # both cases must compute the same function, in inference and in training, for the comparison to hold
+    for training in [False, True]:
+        change = max(bucketing.padding_invariance(model.model, sequences[i], training=training) for i in range(10))
+        print('largest change of a %s prediction with the padding length: %.2e'%(
+              'training' if training else 'inference', change))
+        if change > 1e-4:
+            raise ValueError('the variable-length model depends on the padding')
+    train_padded = {'inputs': padded, 'targets': targets}
+    train_bucketed = {'inputs': sequences, 'targets': targets}
+
+    all_cases = {
+        'predict (pad to max)': (lambda: model.model.predict(padded, batch_size=100, verbose=0), num_seq),
+        'predict (bucketed)': (lambda: model.predict(sequences, batch_size=100), num_seq),
+        'fit epoch (pad to max)': (lambda: model.model.fit(**model._training_data(train_padded, 100), epochs=1,
+                                                           verbose=0), num_seq),
+        'fit epoch (bucketed)': (lambda: model.model.fit(**model._training_data(train_bucketed, 100), epochs=1,
+                                                         verbose=0), num_seq),
+    }
+    results = {}
+    for name, (fn, num_items) in all_cases.items():
+        times = time_call(fn, repeats)
+        results[name] = {'median_sec': float(np.median(times)), 'min_sec': float(np.min(times)),
+                         'items': int(num_items), 'items_per_sec': float(num_items/np.median(times))}
+        print('%-40s %10.4f s  %12.1f items/s'%(name, results[name]['median_sec'], results[name]['items_per_sec']))
+    for task in ['predict', 'fit epoch']:
+        print('%s speed-up with buckets: %.2fx'%(task, results[task+' (pad to max)']['median_sec']/
+                                                 results[task+' (bucketed)']['median_sec']))
+    return results
+
+
+# metadata that must match for timings to be compared against a baseline
+HOST_KEYS = ['machine', 'processor', 'cpu_count', 'python', 'numpy', 'tensorflow', 'intra_op_threads',
+             'inter_op_threads']
+
+# fewer repeats make the median of a baseline as noisy as a single run
+MIN_BASELINE_REPEATS = 5
+
+
+def metadata(performance=None):
+    """environment and performance settings the benchmark ran with"""
+    info = {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if 'tensorflow' in sys.modules:
+        tf = sys.modules['tensorflow']
+        info['tensorflow'] = tf.__version__
+        info['intra_op_threads'] = tf.config.threading.get_intra_op_parallelism_threads()
+        info['inter_op_threads'] = tf.config.threading.get_inter_op_parallelism_threads()
+        info['onednn'] = os.environ.get('TF_ENABLE_ONEDNN_OPTS')
+    if performance is not None:
+        info['performance'] = performance.to_dict()
+        if performance.tuning:
+            info['performance']['tuning'] = performance.tuning['best']
+    return info
+
+
+def host_mismatch(info, baseline_info):
+    """host metadata keys that differ between a run and its baseline"""
+    return [key for key in HOST_KEYS if info.get(key) != baseline_info.get(key)]
+
+
+def compare(results, baseline, threshold=1.25):
+    """ratio to baseline median time for each case; a case is a regression when both its
+       median and its fastest time are more than threshold times those of the baseline"""
+    regressions = []
+    print('%-40s %10s %10s %8s %8s'%('case', 'baseline', 'current', 'ratio', 'min ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_sec']/baseline[name]['median_sec']
+        min_ratio = result['min_sec']/baseline[name]['min_sec']
+        regression = ratio > threshold and min_ratio > threshold
+        flag = ' REGRESSION' if regression else ''
+        print('%-40s %10.4f %10.4f %8.2f %8.2f%s'%(name, baseline[name]['median_sec'], result['median_sec'], ratio,
+                                                  min_ratio, flag))
+        if regression:
+            regressions.append(name)
+    return regressions
+
+
+#-------------------------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ResidualBind benchmarks')
+    parser.add_argument('suite', choices=['imports', 'hotpaths', 'bucketing'])
+    parser.add_argument('--repeats', type=int, default=None)
+    parser.add_argument('--scale', choices=list(SCALES.keys()), default='small')
+    parser.add_argument('--cases', nargs='*', default=None, help='subset of hot-path cases to run')
+    parser.add_argument('--output', default=None, help='write results as json')
+    parser.add_argument('--baseline', default=None, help='json results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio that counts as regression')
+    parser.add_argument('--save-baseline', action='store_true', help='write results to the baseline file')
+    parser.add_argument('--performance', default=None, help='PerformanceConfig json for the models')
+    parser.add_argument('--autotune', choices=['train', 'predict'], default=None,
+                        help='tune thread pools and batch size before the hot-path benchmark')
+    args = parser.parse_args()
+
+    performance = None
+    if args.performance:
+        from performance import PerformanceConfig
+        performance = PerformanceConfig.load(args.performance)
+    elif args.autotune:
+        from performance import autotune
+        performance = autotune((41, 4), mode=args.autotune)
+
+    repeats = args.repeats or (5 if args.suite == 'imports' else 3)
+    if args.save_baseline and repeats < MIN_BASELINE_REPEATS:
+        raise ValueError('a baseline needs at least %d repeats'%(MIN_BASELINE_REPEATS))
+    if args.suite == 'imports':
+        results = benchmark_imports(repeats)
+    elif args.suite == 'bucketing':
+        results = benchmark_bucketing(args.scale, repeats, performance)
+    else:
+        results = benchmark_hotpaths(args.scale, repeats, args.cases, performance)
+    report = {'suite': args.suite, 'scale': args.scale, 'repeats': repeats, 'metadata': metadata(performance),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['suite'] != args.suite or baseline.get('scale') != args.scale:
+            raise ValueError('baseline was recorded for a different suite or scale')
+        mismatch = host_mismatch(report['metadata'], baseline['metadata'])
+        if mismatch:
+            raise ValueError('baseline was recorded on a different host or environment (%s); record one here '
+                             'with --save-baseline'%(', '.join(mismatch)))
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('%d regression(s): %s'%(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Length-bucketed batches for variable-length sequences.
+
+A ResidualBind built with input_shape=(None, A) leaves all-zero (padded)
+positions out of the batchnorm moments, zeroes their activations after
+every batchnorm and averages its trunk over the other positions, so a
+sequence gets the same prediction, and in training the same batch
+statistics, however far it is padded (all-zero positions inside a
+sequence, e.g. unknown letters, are treated the same way). Instead of
+padding every sequence to the longest one, sequences are grouped into
+buckets of similar length (padded lengths rounded up to a multiple of
+bucket_width) and each batch is padded only to its bucket's length.
+Sequences are lists of (L_i, A) one-hot arrays; ResidualBind.fit and
+predict take such lists directly.
+
+Usage:
+    sequences = one_hot_sequences(['ACGU...', ...])
+    model = ResidualBind((None, 4), 1, weights_path)
+    model.fit({'inputs': sequences, 'targets': targets}, valid)
+    predictions = model.predict(sequences)
+"""
+
+import numpy as np
+
+
+def one_hot_sequences(sequences, alphabet='ACGU'):
+    """list of (L_i, A) one-hot arrays of sequence strings (T is read as U; other letters are all-zero)"""
+    from helper import encode_sequence
+    eye = np.vstack([np.eye(len(alphabet), dtype=np.float32), np.zeros((1, len(alphabet)), dtype=np.float32)])
+    return [eye[encode_sequence(sequence, alphabet)] for sequence in sequences]
+
+
+def bucket_batches(lengths, batch_size=100, bucket_width=8, shuffle=False, seed=None):
+    """batches of sequence indices with similar lengths, as (index, padded length) pairs;
+       with shuffle, the members and the order of the batches are random"""
+    lengths = np.asarray(lengths)
+    padded = np.maximum(1, np.ceil(lengths/bucket_width).astype(int))*bucket_width
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+    order = order[np.argsort(padded[order], kind='stable')]
+
+    batches = []
+    boundaries = np.where(np.diff(padded[order]) != 0)[0] + 1
+    for bucket in np.split(order, boundaries):
+        if not len(bucket):
+            continue
+        for start in range(0, len(bucket), batch_size):
+            batches.append((bucket[start:start+batch_size], int(padded[bucket[0]])))
+    if shuffle:
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+    return batches
+
+
+def pad_batch(sequences, index, length):
+    """right-padded (len(index), length, A) array of the indexed sequences"""
+    num_channels = sequences[index[0]].shape[1]
+    x = np.zeros((len(index), length, num_channels), dtype=np.float32)
+    for i, n in enumerate(index):
+        x[i, :len(sequences[n])] = sequences[n][:length]
+    return x
+
+
+def pad_to_max(sequences):
+    """all sequences right-padded to the longest one (the fixed-shape alternative)"""
+    return pad_batch(sequences, np.arange(len(sequences)), max(len(s) for s in sequences))
+
+
+def padding_invariance(model, sequence, lengths=[0, 3, 11, 63], training=False):
+    """largest change in the predictions of a keras model with a variable input length
+       when a sequence is right-padded by each number of positions in lengths
+
+    With training, the forward pass runs in training mode (batchnorm with batch
+    moments) with dropout turned off; the weights, including the batchnorm
+    moving moments it updates, are restored afterwards.
+    """
+    from tensorflow import keras
+    batches = [pad_batch([sequence], [0], len(sequence) + n) for n in lengths]
+    if not training:
+        predictions = [np.asarray(model.predict_on_batch(x)) for x in batches]
+    else:
+        dropout = [layer for layer in model.layers if isinstance(layer, keras.layers.Dropout)]
+        rates = [layer.rate for layer in dropout]
+        weights = model.get_weights()
+        try:
+            for layer in dropout:
+                layer.rate = 0.
+            predictions = [np.asarray(model(x, training=True)) for x in batches]
+        finally:
+            for layer, rate in zip(dropout, rates):
+                layer.rate = rate
+            model.set_weights(weights)
+    return float(np.max(np.abs(np.array(predictions) - predictions[0])))
+
+
+def padding_fraction(lengths, batches):
+    """fraction of the computed positions that are padding"""
+    computed = sum(len(index)*length for index, length in batches)
+    return 1 - np.sum(lengths)/max(computed, 1)
+
+
+def predict_bucketed(model, sequences, batch_size=100, bucket_width=8):
+    """predictions of a keras model with a variable input length, in the order of sequences"""
+    batches = bucket_batches([len(s) for s in sequences], batch_size, bucket_width)
+    predictions = None
+    for index, length in batches:
+        scores = np.asarray(model.predict_on_batch(pad_batch(sequences, index, length)))
+        if predictions is None:
+            predictions = np.zeros((len(sequences),) + scores.shape[1:], dtype=scores.dtype)
+        predictions[index] = scores
+    return predictions
+
+
+_masked_batchnorm = None
+
+
+def masked_batch_normalization(**kwargs):
+    """keras BatchNormalization layer, called as layer(x, mask=mask), whose batch moments
+       in training leave out masked (padded) positions; inference uses the moving moments"""
+    global _masked_batchnorm
+    if _masked_batchnorm is None:
+        import tensorflow as tf
+        from tensorflow import keras
+
+        class MaskedBatchNormalization(keras.layers.BatchNormalization):
+            def call(self, inputs, training=None, mask=None):
+                if mask is None:
+                    return super().call(inputs, training=training)
+                if training is None:
+                    training = keras.backend.learning_phase()
+                inference = lambda: super(MaskedBatchNormalization, self).call(inputs, training=False)
+                if tf.is_tensor(training):
+                    return tf.cond(tf.cast(training, tf.bool), lambda: self._masked_moments_call(inputs, mask),
+                                   inference)
+                return self._masked_moments_call(inputs, mask) if training else inference()
+
+            def _masked_moments_call(self, inputs, mask):
+                x = tf.cast(inputs, self.moving_mean.dtype)
+                weights = tf.cast(mask, x.dtype)[..., tf.newaxis]
+                mean, variance = tf.nn.weighted_moments(x, axes=list(range(len(x.shape) - 1)),
+                                                        frequency_weights=weights)
+                self.moving_mean.assign(self.momentum*self.moving_mean + (1 - self.momentum)*mean)
+                self.moving_variance.assign(self.momentum*self.moving_variance + (1 - self.momentum)*variance)
+                outputs = tf.nn.batch_normalization(x, mean, variance, self.beta, self.gamma, self.epsilon)
+                return tf.cast(outputs, inputs.dtype)
+
+        _masked_batchnorm = MaskedBatchNormalization
+    return _masked_batchnorm(**kwargs)
+
+
+def bucketed_dataset(sequences, targets, batch_size=100, bucket_width=8, seed=None):
+    """tf.data.Dataset of shuffled length-bucketed (inputs, targets) batches; every pass
+       over it (epoch) draws new batches"""
+    import tensorflow as tf
+    targets = np.asarray(targets, dtype=np.float32)
+    rng = np.random.RandomState(seed)
+    num_channels = sequences[0].shape[1]
+
+    def generator():
+        for index, length in bucket_batches([len(s) for s in sequences], batch_size, bucket_width,
+                                            shuffle=True, seed=rng.randint(2**31)):
+            yield pad_batch(sequences, index, length), targets[index]
+
+    signature = (tf.TensorSpec((None, None, num_channels), tf.float32),
+                 tf.TensorSpec((None,) + targets.shape[1:], tf.float32))
+    return tf.data.Dataset.from_generator(generator, output_signature=signature).prefetch(2)
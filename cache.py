@@ -0,0 +1,185 @@
+"""Memoized predictions for repeated sequences.
+
+GIA and mutagenesis score many identical sequences (the same null sequence
+with overlapping interventions, duplicate nulls, wild-type k-mers).
+CachedModel wraps any model with a predict method, looks up each input row
+in a cache and sends only the rows it has not seen to the model, in one
+call. Rows are keyed by their bytes (one-hot rows are bit-packed, which keeps
+the key exact and short) under a fingerprint of the model weights, so
+cached scores of other weights are never returned.
+
+Usage:
+    from cache import CachedModel
+
+    cached = CachedModel(resnet, max_entries=1000000)         # in-memory LRU
+    cached = CachedModel(resnet, cache_path='scores.sqlite')  # on disk, shared across runs
+    gi = GlobalImportance(cached)
+    print(cached.stats())
+"""
+
+import hashlib, sqlite3, collections
+import numpy as np
+from monitor import monitor
+
+
+def row_keys(X):
+    """bytes key per row of X; binary (one-hot) inputs are bit-packed, others are hashed"""
+    X = np.ascontiguousarray(X, dtype=np.float32).reshape(len(X), -1)
+    if np.all((X == 0) | (X == 1)):
+        packed = np.packbits(X.astype(bool), axis=1)
+        return [b'b' + row.tobytes() for row in packed]
+    return [b'h' + hashlib.blake2b(row.tobytes(), digest_size=16).digest() for row in X]
+
+
+def weights_fingerprint(model):
+    """hash of the weights of a ResidualBind (or keras, NumPy inference) model"""
+    if hasattr(model, 'model') and hasattr(model.model, 'get_weights'):
+        weights = model.model.get_weights()
+    elif hasattr(model, 'get_weights'):
+        weights = model.get_weights()
+    elif hasattr(model, 'params'):
+        weights = [unit[key] for kind in ['conv', 'dense'] for unit in model.params[kind] for key in ['kernel', 'bias']]
+    else:
+        raise ValueError('cannot fingerprint the weights of %s; pass fingerprint'%(type(model).__name__))
+    digest = hashlib.blake2b(digest_size=16)
+    for w in weights:
+        digest.update(str(w.shape).encode('utf8'))
+        digest.update(np.ascontiguousarray(w).tobytes())
+    return digest.hexdigest()
+
+
+#-------------------------------------------------------------------------------------
+# Stores
+#-------------------------------------------------------------------------------------
+
+
+class LRUStore():
+    """In-memory cache of at most max_entries rows, evicting the least recently used"""
+    def __init__(self, max_entries=1000000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+
+    def get_many(self, fingerprint, keys):
+        values = []
+        for key in keys:
+            value = self.entries.get((fingerprint, key))
+            if value is not None:
+                self.entries.move_to_end((fingerprint, key))
+            values.append(value)
+        return values
+
+
+    def put_many(self, fingerprint, keys, values):
+        for key, value in zip(keys, values):
+            self.entries[(fingerprint, key)] = value
+            self.entries.move_to_end((fingerprint, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteStore():
+    """On-disk cache in an sqlite file (unbounded; delete the file to clear it)"""
+    def __init__(self, file_path, chunk_size=500):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS scores '
+                                '(fingerprint TEXT, key BLOB, value BLOB, PRIMARY KEY (fingerprint, key))')
+
+
+    def get_many(self, fingerprint, keys):
+        found = {}
+        for start in range(0, len(keys), self.chunk_size):
+            chunk = keys[start:start+self.chunk_size]
+            query = 'SELECT key, value FROM scores WHERE fingerprint = ? AND key IN (%s)'%(','.join('?'*len(chunk)))
+            for key, value in self.connection.execute(query, [fingerprint] + chunk):
+                found[bytes(key)] = np.frombuffer(value, dtype=np.float32)
+        return [found.get(key) for key in keys]
+
+
+    def put_many(self, fingerprint, keys, values):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?)',
+                                        [(fingerprint, key, np.asarray(value, dtype=np.float32).tobytes())
+                                         for key, value in zip(keys, values)])
+
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+
+
+#-------------------------------------------------------------------------------------
+# Memoizing model
+#-------------------------------------------------------------------------------------
+
+
+class CachedModel():
+    """Predict wrapper that scores each distinct row once
+
+    The weights fingerprint is recomputed on every predict call, so training
+    or loading other weights into the wrapped model never returns stale
+    scores; pass fingerprint to skip hashing when the weights are fixed.
+    Other attributes are those of the wrapped model.
+    """
+    def __init__(self, model, max_entries=1000000, cache_path=None, fingerprint=None):
+        self.model = model
+        self.store = SQLiteStore(cache_path) if cache_path else LRUStore(max_entries)
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+
+
+    def __getattr__(self, name):
+        # only called for attributes CachedModel does not have
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+    def predict(self, X, batch_size=None, **kwargs):
+        if batch_size is not None:
+            kwargs['batch_size'] = batch_size
+        if not len(X):
+            return self.model.predict(X, **kwargs)
+        fingerprint = self.fingerprint or weights_fingerprint(self.model)
+        with monitor.timer('CachedModel.lookup', len(X)):
+            keys = row_keys(X)
+            values = self.store.get_many(fingerprint, keys)
+
+        # distinct missing rows, in order of first occurrence
+        missing = collections.OrderedDict()
+        for i, (key, value) in enumerate(zip(keys, values)):
+            if value is None:
+                missing.setdefault(key, []).append(i)
+        # repeats of a missing row within the call are scored once, so they count as hits
+        num_hits = len(keys) - len(missing)
+        self.hits += num_hits
+        self.misses += len(missing)
+        monitor.count('prediction_cache_hits', num_hits)
+        monitor.count('prediction_cache_misses', len(missing))
+
+        if missing:
+            rows = [rows[0] for rows in missing.values()]
+            predictions = np.asarray(self.model.predict(np.asarray(X)[rows], **kwargs), dtype=np.float32)
+            self.store.put_many(fingerprint, list(missing), list(predictions))
+            for prediction, rows in zip(predictions, missing.values()):
+                for i in rows:
+                    values[i] = prediction
+        return np.stack(values)
+
+
+    def stats(self):
+        """hit and miss counts (duplicate rows within a call count as hits)"""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/total if total else 0.,
+                'entries': len(self.store)}
+
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,114 @@
+"""Weight snapshots in memory and asynchronous checkpoint writing.
+
+A snapshot is a list of numpy weights per layer, taken with snapshot_weights.
+AsyncCheckpointer writes snapshots from a background thread in the keras hdf5
+weights format (readable by model.load_weights and numpy_inference), first to
+a temporary file that is then renamed over the checkpoint, so a reader never
+sees a partially written file.
+"""
+
+import os, threading, collections
+import h5py
+import numpy as np
+
+
+def snapshot_weights(model):
+    """copy of the weights of each layer of a keras model"""
+    return [layer.get_weights() for layer in model.layers]
+
+
+def restore_weights(model, snapshot):
+    """set the weights of a keras model from a snapshot"""
+    for layer, weights in zip(model.layers, snapshot):
+        if weights:
+            layer.set_weights(weights)
+
+
+def layer_metadata(model):
+    """layer and weight names of a keras model, as stored in hdf5 weights files"""
+    try:
+        from keras import __version__ as keras_version
+    except ImportError:
+        from tensorflow.keras import __version__ as keras_version
+    return {'layer_names': [layer.name for layer in model.layers],
+            'weight_names': [[w.name for w in layer.weights] for layer in model.layers],
+            'keras_version': keras_version}
+
+
+def write_weights_hdf5(file_path, metadata, snapshot):
+    """write a snapshot in the keras hdf5 weights format, atomically replacing file_path"""
+    tmp_path = file_path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name in metadata['layer_names']]
+        f.attrs['backend'] = 'tensorflow'.encode('utf8')
+        f.attrs['keras_version'] = str(metadata['keras_version']).encode('utf8')
+        for name, weight_names, weights in zip(metadata['layer_names'], metadata['weight_names'], snapshot):
+            group = f.create_group(name)
+            group.attrs['weight_names'] = [w.encode('utf8') for w in weight_names] if weight_names else np.array([])
+            for weight_name, value in zip(weight_names, weights):
+                group.create_dataset(weight_name, data=value)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def read_weights_hdf5(file_path):
+    """layer names and weights (a snapshot) from a keras hdf5 weights file"""
+    with h5py.File(file_path, 'r') as f:
+        layer_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in f.attrs['layer_names']]
+        snapshot = []
+        for name in layer_names:
+            group = f[name]
+            weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+            snapshot.append([np.array(group[n]) for n in weight_names])
+    return layer_names, snapshot
+
+
+class AsyncCheckpointer():
+    """Writes weight snapshots in a background thread
+
+    Snapshots are copies, so training continues while they are written. Only
+    the most recent pending snapshot for a path is written. The writer thread
+    exits when there is nothing left to write and is not a daemon, so pending
+    checkpoints are completed before the interpreter exits. wait() blocks
+    until all writes are done and re-raises a failed write.
+    """
+    def __init__(self, model):
+        self.metadata = layer_metadata(model)
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.error = None
+
+
+    def save(self, file_path, snapshot):
+        with self.lock:
+            self.pending.pop(file_path, None)
+            self.pending[file_path] = snapshot
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.start()
+
+
+    def wait(self):
+        while True:
+            with self.lock:
+                thread = self.thread
+            if thread is None:
+                break
+            thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                file_path, snapshot = self.pending.popitem(last=False)
+            try:
+                write_weights_hdf5(file_path, self.metadata, snapshot)
+            except Exception as error:
+                self.error = error
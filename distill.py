@@ -0,0 +1,123 @@
+"""Knowledge distillation of ResidualBind into slimmer students for bulk scans.
+
+A trained teacher labels the RNAcompete training sequences and synthetic
+sequences (null models of GlobalImportance and point mutants of the
+training sequences), and a student with fewer filters, a smaller kernel and
+a smaller dense layer is trained on those labels. The student is early
+stopped on the measured validation targets, so its test Pearson r is
+directly comparable to the teacher's. speed_accuracy reports sequences per
+second against test Pearson r.
+
+Usage:
+    teacher = ResidualBind(input_shape, 1, teacher_weights_path)
+    teacher.load_weights()
+    student = distill(teacher, train, valid, student_weights_path, num_filters=32, kernel_size=7, dense_units=64)
+    report = speed_accuracy({'teacher': teacher, 'student': student}, test)
+"""
+
+import time
+import numpy as np
+from monitor import monitor, log_event
+
+
+# student architectures, from the teacher's 96 filters/kernel 11/256 units down
+STUDENTS = {
+    'small': {'num_filters': 48, 'kernel_size': 9, 'dense_units': 128},
+    'tiny': {'num_filters': 32, 'kernel_size': 7, 'dense_units': 64},
+    'micro': {'num_filters': 16, 'kernel_size': 5, 'dilations': [2, 4], 'dense_units': 32},
+}
+
+
+def mutate(X, mutation_rate=0.1, seed=None):
+    """one-hot sequences with a fraction of the positions set to a random other nucleotide"""
+    rng = np.random.RandomState(seed)
+    N, L, A = X.shape
+    x_index = np.argmax(X, axis=2)
+    mutated = rng.uniform(size=(N, L)) < mutation_rate
+    x_index[mutated] = (x_index[mutated] + rng.randint(1, A, size=np.sum(mutated))) % A
+    return np.eye(A, dtype=np.float32)[x_index]
+
+
+@monitor.timed('distill.synthetic_sequences')
+def synthetic_sequences(base_sequence, num_sample, null_models=['random', 'dinuc'], mutation_rate=0.1):
+    """sequences from GIA null models and point mutants of base_sequence, num_sample of each kind"""
+    from residualbind import generate_null_sequence_set
+    X = [mutate(base_sequence[np.random.randint(len(base_sequence), size=num_sample)], mutation_rate)]
+    for null_model in null_models:
+        X.append(generate_null_sequence_set(null_model, base_sequence, num_sample).astype(np.float32))
+    return np.concatenate(X, axis=0)
+
+
+def teacher_labels(teacher, X, batch_size=None):
+    """soft targets of the teacher"""
+    with monitor.timer('distill.teacher_labels', len(X)):
+        return teacher.predict(X, batch_size).astype(np.float32)
+
+
+@monitor.timed('distill.distill')
+def distill(teacher, train, valid, weights_path, num_synthetic=None, null_models=['random', 'dinuc'],
+            mutation_rate=0.1, num_epochs=100, patience=10, lr=0.001, lr_decay=0.3, decay_patience=5,
+            **architecture):
+    """train a student ResidualBind (architecture: num_filters, kernel_size, dilations,
+       pool_size, dense_units) on teacher labels of the training set and synthetic sequences
+
+    num_synthetic sequences of each synthetic kind (default: as many as the
+    training set) are added when the inputs are sequences only (4 channels).
+    The student is early stopped on the measured validation targets.
+    """
+    from residualbind import ResidualBind
+    X = train['inputs']
+    if X.shape[2] == 4:
+        num_synthetic = len(X) if num_synthetic is None else num_synthetic
+        if num_synthetic:
+            X = np.concatenate([X, synthetic_sequences(train['inputs'], num_synthetic, null_models,
+                                                       mutation_rate)], axis=0)
+    targets = teacher_labels(teacher, X)
+    log_event('distill', '  Distilling on %d sequences (%d synthetic)'%(len(X), len(X) - len(train['inputs'])),
+              num_sequences=len(X), architecture=architecture)
+
+    student = ResidualBind(list(X.shape[1:]), targets.shape[1], weights_path, teacher.classification,
+                           performance=teacher.performance, **architecture)
+    student.fit({'inputs': X, 'targets': targets}, valid, num_epochs=num_epochs, patience=patience,
+                lr=lr, lr_decay=lr_decay, decay_patience=decay_patience)
+    if student.best_weights is None:
+        # validation Pearson r was nan in every epoch (e.g. constant predictions)
+        log_event('distill_failed', '  Student failed to learn; keeping the weights of the last epoch',
+                  architecture=architecture)
+    else:
+        student.restore_best_weights()
+    return student
+
+
+def speed_accuracy(models, test, batch_size=1000, repeats=3, freeze=True):
+    """sequences/sec and test Pearson r of each model in a dict of name -> ResidualBind
+
+    With freeze, models are timed through their frozen inference graph, as
+    they would be deployed for scans.
+    """
+    from residualbind import pearsonr_scores
+    report = {}
+    for name, model in models.items():
+        predictor = model.freeze() if freeze else model
+        predictor.predict(test['inputs'][:batch_size], batch_size=batch_size)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            predictions = predictor.predict(test['inputs'], batch_size=batch_size)
+            times.append(time.perf_counter() - start)
+        report[name] = {'num_params': int(model.model.count_params()),
+                        'seqs_per_sec': len(test['inputs'])/min(times),
+                        'pearsonr': float(np.nanmean(pearsonr_scores(test['targets'], predictions)))}
+    return report
+
+
+def format_speed_accuracy(report, reference='teacher'):
+    """text table of speed_accuracy, with speed-up and change in Pearson r relative to reference"""
+    lines = ['  %-10s %10s %12s %8s %9s %9s'%('model', 'params', 'seqs/sec', 'speedup', 'pearsonr', 'delta r')]
+    base = report.get(reference)
+    for name, entry in report.items():
+        speedup = entry['seqs_per_sec']/base['seqs_per_sec'] if base else np.nan
+        delta = entry['pearsonr'] - base['pearsonr'] if base else np.nan
+        lines.append('  %-10s %10d %12.1f %7.1fx %9.4f %+9.4f'%(name, entry['num_params'], entry['seqs_per_sec'],
+                                                               speedup, entry['pearsonr'], delta))
+    return '\n'.join(lines)
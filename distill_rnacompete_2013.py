@@ -0,0 +1,77 @@
+import os, time
+import numpy as np
+from residualbind import ResidualBind
+import helper, distill
+from performance import autotune
+from monitor import monitor, SweepReport, set_verbosity, log_to_jsonl
+
+#---------------------------------------------------------------------------------------
+
+normalization = 'log_norm'   # 'log_norm' or 'clip_norm'
+ss_type = 'seq'                  # 'seq', 'pu', or 'struct'
+data_path = '../data/RNAcompete_2013/rnacompete2013.h5'
+results_path = os.path.join('../results', 'rnacompete_2013')
+teacher_path = os.path.join(results_path, normalization+'_'+ss_type)   # from train_rnacompete_2013.py
+save_path = helper.make_directory(results_path, normalization+'_'+ss_type+'_distill')
+students = ['small', 'tiny', 'micro']     # architectures in distill.STUDENTS
+verbose = 1                      # 0: silent, 1: progress, 2: keras progress bars
+performance_path = os.path.join(results_path, 'performance_train.json')  # tuned thread settings for this machine
+
+set_verbosity(verbose)
+log_to_jsonl(os.path.join(save_path, 'events.jsonl'))
+
+#---------------------------------------------------------------------------------------
+
+# loop over different RNA binding proteins
+reports = []
+sweep = SweepReport()
+experiments = helper.get_experiment_names(data_path)
+for rbp_index, experiment in enumerate(experiments):
+    print('Distilling: '+ experiment)
+    monitor.reset()
+    start = time.time()
+
+    # load rbp dataset
+    train, valid, test = helper.load_rnacompete_data(data_path, 
+                                                     ss_type=ss_type, 
+                                                     normalization=normalization, 
+                                                     rbp_index=rbp_index)
+
+    # load teacher
+    input_shape = list(train['inputs'].shape)[1:]
+    performance = autotune(input_shape, mode='train', batch_sizes=[100], cache_path=performance_path)
+    teacher = ResidualBind(input_shape, 1, os.path.join(teacher_path, experiment + '_weights.hdf5'),
+                           performance=performance)
+    teacher.load_weights()
+
+    # distill students
+    models = {'teacher': teacher}
+    for name in students:
+        weights_path = os.path.join(save_path, experiment + '_' + name + '_weights.hdf5')
+        models[name] = distill.distill(teacher, train, valid, weights_path, **distill.STUDENTS[name])
+
+    # speed/accuracy tradeoff on the test set
+    report = distill.speed_accuracy(models, test)
+    print(distill.format_speed_accuracy(report))
+    reports.append(report)
+
+    monitor.add_time('experiment', time.time() - start)
+    print(monitor.report('  Timing: ' + experiment))
+    sweep.add(experiment, monitor.snapshot())
+
+# save speed/accuracy of each model to table
+file_path = os.path.join(results_path, normalization+'_'+ss_type+'_distill.tsv')
+with open(file_path, 'w') as f:
+    f.write('%s\t%s\t%s\t%s\t%s\n'%('Experiment', 'Model', 'Parameters', 'Sequences/sec', 'Pearson score'))
+    for experiment, report in zip(experiments, reports):
+        for name, entry in report.items():
+            f.write('%s\t%s\t%d\t%.1f\t%.4f\n'%(experiment, name, entry['num_params'], entry['seqs_per_sec'],
+                                                entry['pearsonr']))
+
+for name in ['teacher'] + students:
+    print('%s: %.1f seqs/sec, Pearson r %.4f'%(name, np.mean([r[name]['seqs_per_sec'] for r in reports]),
+                                                np.mean([r[name]['pearsonr'] for r in reports])))
+
+# save per-experiment and aggregated timings
+print(sweep.report())
+sweep.write(os.path.join(save_path, 'timing.json'))
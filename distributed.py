@@ -0,0 +1,97 @@
+"""Data-parallel multi-worker training on CPUs.
+
+Every worker process runs the same script with its own TF_CONFIG. The
+workers train on separate shards of the training set
+(helper.load_rnacompete_data(shard=...)) and a MultiWorkerMirroredStrategy
+all-reduces the gradients, so the weights stay identical on every worker.
+Each worker evaluates the full validation set, which keeps the early-stopping
+and learning-rate decay decisions of ResidualBind.fit in agreement; only the
+chief writes checkpoints and result files.
+
+Usage (several workers on one machine):
+    python distributed.py --num_workers 4 train_rnacompete_2013.py
+
+On several nodes, set TF_CONFIG on each node (see tf_config) and run the
+script there.
+"""
+
+import os, sys, json, socket, argparse, subprocess
+
+
+def tf_config(hosts, task_index):
+    """TF_CONFIG for worker task_index of a cluster given as a list of 'host:port'"""
+    return json.dumps({'cluster': {'worker': list(hosts)}, 'task': {'type': 'worker', 'index': task_index}})
+
+
+def worker_info():
+    """(task index, number of workers) from TF_CONFIG; (0, 1) for a single process"""
+    config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    workers = config.get('cluster', {}).get('worker', [])
+    if not workers:
+        return 0, 1
+    return config['task']['index'], len(workers)
+
+
+def shard():
+    """shard argument for helper.load_rnacompete_data, or None for a single process"""
+    task_index, num_workers = worker_info()
+    return (task_index, num_workers) if num_workers > 1 else None
+
+
+def is_chief():
+    return worker_info()[0] == 0
+
+
+def strategy_from_env():
+    """MultiWorkerMirroredStrategy when TF_CONFIG defines several workers, else None
+
+    Must be called before any other TensorFlow op is run.
+    """
+    if worker_info()[1] == 1:
+        return None
+    import tensorflow as tf
+    options = tf.distribute.experimental.CommunicationOptions(
+                    implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def free_ports(num_ports):
+    """unused local TCP ports"""
+    sockets = []
+    for _ in range(num_ports):
+        s = socket.socket()
+        s.bind(('localhost', 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch_local(command, num_workers, threads_per_worker=None):
+    """run command in num_workers local worker processes and wait for them
+
+    Returns the exit codes; worker output other than the chief's is discarded.
+    """
+    hosts = ['localhost:%d'%(port) for port in free_ports(num_workers)]
+    processes = []
+    for task_index in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=tf_config(hosts, task_index))
+        if threads_per_worker:
+            env['OMP_NUM_THREADS'] = env['TF_NUM_INTRAOP_THREADS'] = str(threads_per_worker)
+        output = None if task_index == 0 else subprocess.DEVNULL
+        processes.append(subprocess.Popen(command, env=env, stdout=output, stderr=output))
+    return [process.wait() for process in processes]
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='launch a script in several local worker processes')
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--threads_per_worker', type=int, default=None)
+    parser.add_argument('script')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    codes = launch_local([sys.executable, args.script] + args.args, args.num_workers, args.threads_per_worker)
+    sys.exit(max(codes))
@@ -1,14 +1,14 @@
 import numpy as np
-import pandas as pd
-import logomaker
-import matplotlib.pyplot as plt
-from tensorflow import keras
-from tensorflow.keras import backend as K
-import tensorflow.compat.v1.keras.backend as K1
+from monitor import keras_verbose
 
 
 
 def saliency(model, X, class_index=0, layer=-1, batch_size=256):
+    import tensorflow as tf
+    if tf.executing_eagerly():
+        return _saliency_eager(model, X, class_index, layer, batch_size)
+
+    import tensorflow.compat.v1.keras.backend as K1
     saliency = K1.gradients(model.layers[layer].output[:,class_index], model.input)[0]
     sess = K1.get_session()
 
@@ -24,6 +24,22 @@ def saliency(model, X, class_index=0, layer=-1, batch_size=256):
     return np.concatenate(attr_score, axis=0)
 
 
+def _saliency_eager(model, X, class_index=0, layer=-1, batch_size=256):
+    """saliency maps with a gradient tape (TF2 eager execution)"""
+    import tensorflow as tf
+    from tensorflow import keras
+    intermediate = keras.Model(inputs=model.inputs, outputs=model.layers[layer].output)
+
+    attr_score = []
+    for start in range(0, len(X), batch_size):
+        x = tf.constant(X[start:start+batch_size], dtype=tf.float32)
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            outputs = intermediate(x, training=False)[:, class_index]
+        attr_score.append(tape.gradient(outputs, x).numpy())
+    return np.concatenate(attr_score, axis=0)
+
+
 def mutagenesis(model, X, class_index=0, layer=-1):
 
     def generate_mutagenesis(X):
@@ -38,6 +54,7 @@ def mutagenesis(model, X, class_index=0, layer=-1):
                 X_mut.append(X_new)
         return np.array(X_mut)
 
+    from tensorflow import keras
     N, L, A = X.shape 
     intermediate = keras.Model(inputs=model.inputs, outputs=model.layers[layer].output)
 
@@ -45,13 +62,13 @@ def mutagenesis(model, X, class_index=0, layer=-1):
     for x in X:
 
         # get baseline wildtype score
-        wt_score = intermediate.predict(np.expand_dims(x, axis=0))[:, class_index]
+        wt_score = intermediate.predict(np.expand_dims(x, axis=0), verbose=keras_verbose())[:, class_index]
 
         # generate mutagenized sequences
         x_mut = generate_mutagenesis(x)
         
         # get predictions of mutagenized sequences
-        predictions = intermediate.predict(x_mut)[:,class_index]
+        predictions = intermediate.predict(x_mut, verbose=keras_verbose())[:,class_index]
 
         # reshape mutagenesis predictiosn
         mut_score = np.zeros((L,A))
@@ -5,10 +5,8 @@ Summary: Generates hdf5 file with all 2013 RNAcompete experiments.
 #---------------------------------------------------------------------------------------
 
 import os, sys, h5py
-import pandas as pd
 import numpy as np
-from six.moves import cPickle
-np.random.seed(100)
+from functools import reduce
 
 #---------------------------------------------------------------------------------------
 
@@ -119,7 +117,7 @@ def merge_structural_profile(profile_path, merged_path):
         I_prob =  Iprofiles[i*2+1].split()
         M_prob =  Mprofiles[i*2+1].split()
         E_prob =  Eprofiles[i*2+1].split()
-        P_prob = map( (lambda a, b, c, d: 1-float(a)-float(b)-float(c)-float(d)), H_prob, I_prob, M_prob, E_prob)
+        P_prob = list(map( (lambda a, b, c, d: 1-float(a)-float(b)-float(c)-float(d)), H_prob, I_prob, M_prob, E_prob))
         fhout.write(list_to_str(P_prob[:len(P_prob)])+'\n')
         fhout.write(list_to_str(H_prob[:len(P_prob)])+'\n')
         fhout.write(list_to_str(I_prob[:len(P_prob)])+'\n')
@@ -169,70 +167,74 @@ def extract_structural_profile(merged_path, num_seq, window):
 #---------------------------------------------------------------------------------------
 
 
-data_path = '../../data/RNAcompete_2013'
-
-# load binding affinities for each rnacompete experiment
-df = pd.read_csv(os.path.join(data_path,'targets.tsv'), sep='\t')
-targets = df.to_numpy()
-experiments = [x.encode('UTF8') for x in df.columns.values]
-
-# load sequences
-df = pd.read_csv(os.path.join(data_path,'sequences.tsv'), sep='\t')
-rnac_set = df['Fold ID'].to_numpy()
-sequences = df['seq'].to_numpy()
-
-# get the maximum length sequence
-max_length = 0
-for seq in sequences:
-    max_length = np.maximum(max_length, len(seq))
-
-# convert sequences into one-hot representation
-one_hot = convert_one_hot(sequences, max_length)
-
-# save sequences in a fasta format (for rnaplfold)
-fasta_path = os.path.join(data_path,'sequences.fa')
-generate_fasta(sequences, fasta_path)
-
-# generate secondary structure profiles with rnaplfold
-profile_path = os.path.join(data_path,'rnaplfold')
-predict_structure(fasta_path, profile_path, window=max_length)
-
-# generate merged secondary structure profile
-merged_path = profile_path+'_structure_profiles.txt'
-num_seq = merge_structural_profile(profile_path, merged_path)
-
-# extract secondary structure profiles
-structure = extract_structural_profile(merged_path, num_seq, window)
-
-# merge sequences and structural profiles
-data = np.concatenate([one_hot, structure], axis=1)
-data = one_hot
-
-# split dataset into train, cross-validation, and test set
-valid_frac = 0.1
-index = np.where(rnac_set == 'A')[0]
-num_seq = len(index)
-num_valid = int(num_seq*valid_frac)
-shuffle = np.random.permutation(num_seq)
-
-X_train = data[shuffle[num_valid:]]
-Y_train = targets[[shuffle[num_valid:]]]
-
-X_valid = data[shuffle[:num_valid]]
-Y_valid = targets[[shuffle[:num_valid]]]
-
-test_index = np.where(rnac_set == 'B')[0]
-X_test = data[test_index]
-Y_test = targets[test_index]
-
-# save dataset
-save_path = os.path.join(data_path, 'rnacompete2013.h5')
-print('saving dataset: ', save_path)
-with h5py.File(save_path, "w") as f:
-    dset = f.create_dataset("X_train", data=X_train.astype(np.float32), compression="gzip")
-    dset = f.create_dataset("Y_train", data=Y_train.astype(np.float32), compression="gzip")
-    dset = f.create_dataset("X_valid", data=X_valid.astype(np.float32), compression="gzip")
-    dset = f.create_dataset("Y_valid", data=Y_valid.astype(np.float32), compression="gzip")
-    dset = f.create_dataset("X_test", data=X_test.astype(np.float32), compression="gzip")
-    dset = f.create_dataset("Y_test", data=Y_test.astype(np.float32), compression="gzip")
-    dset = f.create_dataset("experiment", data=experiments, compression="gzip")
+if __name__ == '__main__':
+    import pandas as pd
+    np.random.seed(100)
+
+    data_path = '../../data/RNAcompete_2013'
+
+    # load binding affinities for each rnacompete experiment
+    df = pd.read_csv(os.path.join(data_path,'targets.tsv'), sep='\t')
+    targets = df.to_numpy()
+    experiments = [x.encode('UTF8') for x in df.columns.values]
+
+    # load sequences
+    df = pd.read_csv(os.path.join(data_path,'sequences.tsv'), sep='\t')
+    rnac_set = df['Fold ID'].to_numpy()
+    sequences = df['seq'].to_numpy()
+
+    # get the maximum length sequence
+    max_length = 0
+    for seq in sequences:
+        max_length = np.maximum(max_length, len(seq))
+
+    # convert sequences into one-hot representation
+    one_hot = convert_one_hot(sequences, max_length)
+
+    # save sequences in a fasta format (for rnaplfold)
+    fasta_path = os.path.join(data_path,'sequences.fa')
+    generate_fasta(sequences, fasta_path)
+
+    # generate secondary structure profiles with rnaplfold
+    profile_path = os.path.join(data_path,'rnaplfold')
+    predict_structure(fasta_path, profile_path, window=max_length)
+
+    # generate merged secondary structure profile
+    merged_path = profile_path+'_structure_profiles.txt'
+    num_seq = merge_structural_profile(profile_path, merged_path)
+
+    # extract secondary structure profiles
+    structure = extract_structural_profile(merged_path, num_seq, window)
+
+    # merge sequences and structural profiles
+    data = np.concatenate([one_hot, structure], axis=1)
+    data = one_hot
+
+    # split dataset into train, cross-validation, and test set
+    valid_frac = 0.1
+    index = np.where(rnac_set == 'A')[0]
+    num_seq = len(index)
+    num_valid = int(num_seq*valid_frac)
+    shuffle = np.random.permutation(num_seq)
+
+    X_train = data[shuffle[num_valid:]]
+    Y_train = targets[[shuffle[num_valid:]]]
+
+    X_valid = data[shuffle[:num_valid]]
+    Y_valid = targets[[shuffle[:num_valid]]]
+
+    test_index = np.where(rnac_set == 'B')[0]
+    X_test = data[test_index]
+    Y_test = targets[test_index]
+
+    # save dataset
+    save_path = os.path.join(data_path, 'rnacompete2013.h5')
+    print('saving dataset: ', save_path)
+    with h5py.File(save_path, "w") as f:
+        dset = f.create_dataset("X_train", data=X_train.astype(np.float32), compression="gzip")
+        dset = f.create_dataset("Y_train", data=Y_train.astype(np.float32), compression="gzip")
+        dset = f.create_dataset("X_valid", data=X_valid.astype(np.float32), compression="gzip")
+        dset = f.create_dataset("Y_valid", data=Y_valid.astype(np.float32), compression="gzip")
+        dset = f.create_dataset("X_test", data=X_test.astype(np.float32), compression="gzip")
+        dset = f.create_dataset("Y_test", data=Y_test.astype(np.float32), compression="gzip")
+        dset = f.create_dataset("experiment", data=experiments, compression="gzip")
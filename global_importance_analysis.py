@@ -1,16 +1,20 @@
-import os
+import os, time
 import pandas as pd
 import numpy as np
 import logomaker
 from six.moves import cPickle
 import matplotlib.pyplot as plt
 from scipy import stats
-from residualbind import ResidualBind, GlobalImportance
-import helper, explain
+from residualbind import ResidualBind, GlobalImportance, InterventionPlan
+import residualbind
+import helper, explain, kmer_table
+from performance import autotune
+from monitor import monitor, SweepReport, set_verbosity, log_to_jsonl
 
 #---------------------------------------------------------------------
 
 null_model = 'profile'  # 'profile', 'random' , 'dinuc', 'quartile1', 'quartile2', 'quartile3', 'quartile4']  
+kmer_search = 'exhaustive'   # 'exhaustive' or 'adaptive' (racing on null subsamples, for large k)
 
 normalization = 'log_norm'   # 'log_norm' or 'clip_norm'
 ss_type = 'seq'                  # 'seq', 'pu', or 'struct'
@@ -21,6 +25,11 @@ plot_path = helper.make_directory(save_path, 'plots_'+null_model)
 motif_path = helper.make_directory(save_path, 'motifs_'+null_model)
 kmer_path = helper.make_directory(save_path, 'kmer_motifs_'+null_model)
 alphabet = 'ACGU'
+verbose = 1                      # 0: silent, 1: progress, 2: keras progress bars
+performance_path = os.path.join(results_path, 'performance_predict.json')  # tuned settings for this machine
+
+set_verbosity(verbose)
+log_to_jsonl(os.path.join(plot_path, 'events.jsonl'))
 
 #---------------------------------------------------------------------------------------
 
@@ -31,8 +40,11 @@ experiments = helper.get_experiment_names(data_path)
 multiple_sites_all = []
 gcbias_all = []
 hairpin_all = []
+sweep = SweepReport()
 for rbp_index, experiment in enumerate(experiments):
     print(rbp_index, experiment)
+    monitor.reset()
+    start = time.time()
 
     # load rbp dataset
     train, valid, test = helper.load_rnacompete_data(data_path, 
@@ -44,8 +56,10 @@ for rbp_index, experiment in enumerate(experiments):
     input_shape = list(train['inputs'].shape)[1:]
     num_class = 1
     weights_path = os.path.join(save_path, experiment + '_weights.hdf5')    
-    model = ResidualBind(input_shape, num_class, weights_path)
+    performance = autotune(input_shape, mode='predict', cache_path=performance_path)
+    model = ResidualBind(input_shape, num_class, weights_path, performance=performance)
     model.load_weights()
+    model.freeze()
 
     # instantiate global importance
     gi = GlobalImportance(model, alphabet)
@@ -59,13 +73,16 @@ for rbp_index, experiment in enumerate(experiments):
 
     kmer_size = 6
     position = 17
-    kmers, mean_scores = gi.optimal_kmer(kmer_size, position, class_index=0)
+    kmers, mean_scores = gi.optimal_kmer(kmer_size, position, class_index=0, search=kmer_search)
 
     # save top kmers to file
     with open(os.path.join(plot_path, experiment + '_kmer.txt'), 'w') as f:
         for i in range(10):
             f.write("%s\t%.3f\n"%(kmers[i], mean_scores[i]))
 
+    # save the effects of all k-mers for surrogate scoring (kmer_table.KmerScorer)
+    kmer_table.save_kmer_table(os.path.join(save_path, experiment+'_kmer_table.npz'), kmers, mean_scores, position)
+
     # set kmer to investigate
     motif = kmers[0]
        
@@ -149,12 +166,24 @@ for rbp_index, experiment in enumerate(experiments):
     fig.savefig(outfile, format='pdf', dpi=200, bbox_inches='tight')
 
 
+    #-----------------------------------------------------------------------------
+    # score the interventions of all remaining analyses together in large batches
+    print("performing positional bias, multiple sites, gc-bias and hairpin analyses")
+
+    plan = InterventionPlan()
+    plan.add('positional_bias', residualbind.positional_bias_interventions(motif, [3, 10, 16, 22, 28, 34]))
+    plan.add('multiple_sites', residualbind.multiple_sites_interventions(motif, [4, 12, 20]))
+    plan.add('gc_bias', residualbind.gc_bias_interventions(motif, 17, 'GCGCGC', [34, 2]))
+    plan.add('hairpin_control', [(motif, 17), (motif, 9)])
+    plan.add('hairpin', [(motif, 17), (motif, 9)], hairpin=(8, 24, 9))
+    effects = gi.run_plan(plan, class_index=0)
+
+
     #-----------------------------------------------------------------------------
     # positional bias analysis
-    print("performing positional bias analysis")
 
     positions = [3, 10, 16, 22, 28, 34]
-    all_scores = gi.positional_bias(motif, positions, class_index=0)
+    all_scores = effects['positional_bias']
 
     fig = plt.figure()
     flierprops = dict(marker='^', markerfacecolor='green', markersize=14, linestyle='none')
@@ -170,10 +199,9 @@ for rbp_index, experiment in enumerate(experiments):
 
     #-----------------------------------------------------------------------------
     # Multiple sites
-    print("performing multiple sites analysis")
 
     positions = [4, 12, 20]
-    all_scores = gi.multiple_sites(motif, positions, class_index=0)
+    all_scores = effects['multiple_sites']
 
     fig = plt.figure(figsize=(4,5))
     flierprops = dict(marker='^', markerfacecolor='green', markersize=14,linestyle='none')
@@ -200,12 +228,8 @@ for rbp_index, experiment in enumerate(experiments):
 
     #-----------------------------------------------------------------------------
     # GC Bias 
-    print("performing gc-bias analysis")
 
-    motif_position = 17
-    gc_motif = 'GCGCGC'
-    gc_positions = [34, 2]
-    all_scores = gi.gc_bias(motif, motif_position, gc_motif, gc_positions, class_index=0)
+    all_scores = effects['gc_bias']
 
     fig = plt.figure(figsize=(4,5))
     flierprops = dict(marker='^', markerfacecolor='green', markersize=14, linestyle='none')
@@ -230,20 +254,9 @@ for rbp_index, experiment in enumerate(experiments):
 
     #-----------------------------------------------------------------------------
     # hairpin structure bias analysis
-    print("performing hairpin bias analysis")
 
-    positions = [17, 9]
-
-    # embed patterns in same positions in random sequences
-    all_scores = []
-    for position in positions:
-        all_scores.append(gi.embed_predict_effect((motif, position), class_index=0))
-
-    # embed motif in loop and stem of hairpin sequence
-    for position in positions:
-        one_hot = gi.embed_pattern_hairpin((motif, position), stem_left=8, stem_right=24, stem_size=9)
-        all_scores.append(gi.predict_effect(one_hot))
-    all_scores = np.array(all_scores)
+    # motif at the same positions in random sequences, then in loop and stem of hairpin sequence
+    all_scores = np.concatenate([effects['hairpin_control'], effects['hairpin']], axis=0)
         
     fig = plt.figure(figsize=(4,5))
     flierprops = dict(marker='^', markerfacecolor='green', markersize=14, linestyle='none')
@@ -267,11 +280,16 @@ for rbp_index, experiment in enumerate(experiments):
 
     hairpin_all.append([np.mean(all_scores, axis=1), pvalue1, pvalue2, pvalue3])
 
+    monitor.add_time('experiment', time.time() - start)
+    print(monitor.report('  Timing: ' + experiment))
+    sweep.add(experiment, monitor.snapshot())
+
 # save main results
 with open(os.path.join(plot_path, 'results.pickle'), 'wb') as f:
     cPickle.dump(np.array(multiple_sites_all), f)
     cPickle.dump(np.array(gcbias_all), f)
     cPickle.dump(np.array(hairpin_all), f)
 
-
-
+# save per-experiment and aggregated timings
+print(sweep.report())
+sweep.write(os.path.join(plot_path, 'timing.json'))
@@ -1,7 +1,6 @@
-import os, h5py
+import os
 import numpy as np
-from scipy import stats
-import matplotlib.pyplot as plt
+from monitor import monitor, log_event
 
 
 def make_directory(path, foldername, verbose=1):
@@ -9,16 +8,36 @@ def make_directory(path, foldername, verbose=1):
 
     if not os.path.isdir(path):
         os.mkdir(path)
-        print("making directory: " + path)
+        if verbose:
+            log_event('make_directory', "making directory: " + path, path=path)
 
     outdir = os.path.join(path, foldername)
     if not os.path.isdir(outdir):
         os.mkdir(outdir)
-        print("making directory: " + outdir)
+        if verbose:
+            log_event('make_directory', "making directory: " + outdir, path=outdir)
     return outdir
 
 
-def load_rnacompete_data(file_path, ss_type='seq', normalization='log_norm', rbp_index=None, dataset_name=None):
+def encode_sequence(sequence, alphabet='ACGU'):
+    """integer encoding of a sequence string (T is read as U); other letters are -1"""
+    lookup = np.full(256, -1, dtype=np.int64)
+    for i, base in enumerate(alphabet):
+        lookup[ord(base)] = lookup[ord(base.lower())] = i
+    if 'U' in alphabet:
+        lookup[ord('T')] = lookup[ord('t')] = alphabet.index('U')
+    return lookup[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+
+
+@monitor.timed('load_rnacompete_data')
+def load_rnacompete_data(file_path, ss_type='seq', normalization='log_norm', rbp_index=None, dataset_name=None,
+                         shard=None, mask_value=None):
+    """load train, valid and test sets; shard=(index, num_shards) keeps only an equal-sized
+       block of the training set for one worker of a data-parallel run (see distributed.py).
+       With mask_value, all experiments are kept as targets (rbp_index=None): sequences measured
+       in any experiment are kept, each experiment is normalized separately and missing
+       measurements are set to mask_value"""
+    import h5py
 
     def prepare_data(train, ss_type=None):
 
@@ -61,16 +80,35 @@ def load_rnacompete_data(file_path, ss_type='seq', normalization='log_norm', rbp
             params = [MIN, mu, sigma]
         return data_norm, params
 
+    def normalize_columns(data, normalization):
+        data = np.array(data)
+        for i in range(data.shape[1]):
+            valid = np.isnan(data[:,i]) == False
+            data[valid,i] = normalize_data(data[valid,i], normalization)[0]
+        data[np.isnan(data)] = mask_value
+        return data
+
+    def read(key, rows=None):
+        data = dataset[key]
+        if rows is None:
+            monitor.count('hdf5_bytes_read', data.id.get_storage_size())
+            return np.array(data).astype(np.float32)
+
+        # read the span of the requested rows in one contiguous slice
+        start, end = (rows[0], rows[-1]+1) if len(rows) else (0, 0)
+        monitor.count('hdf5_bytes_read', data.id.get_storage_size()*(end - start)//max(len(data), 1))
+        return np.array(data[start:end]).astype(np.float32)[rows - start]
+
     # open dataset
     dataset = h5py.File(file_path, 'r')
     if not dataset_name:  
         # load data from RNAcompete 2013
-        X_train = np.array(dataset['X_train']).astype(np.float32)
-        Y_train = np.array(dataset['Y_train']).astype(np.float32)
-        X_valid = np.array(dataset['X_valid']).astype(np.float32)
-        Y_valid = np.array(dataset['Y_valid']).astype(np.float32)
-        X_test = np.array(dataset['X_test']).astype(np.float32)
-        Y_test = np.array(dataset['Y_test']).astype(np.float32)
+        X_train_key = 'X_train'
+        Y_train = read('Y_train')
+        X_valid = read('X_valid')
+        Y_valid = read('Y_valid')
+        X_test = read('X_test')
+        Y_test = read('Y_test')
 
         # expand dims of targets
         if rbp_index is not None:
@@ -79,12 +117,12 @@ def load_rnacompete_data(file_path, ss_type='seq', normalization='log_norm', rbp
             Y_test = Y_test[:,rbp_index]
     else:
         # necessary for RNAcompete 2009 dataset
-        X_train = np.array(dataset['/'+dataset_name+'/X_train']).astype(np.float32)
-        Y_train = np.array(dataset['/'+dataset_name+'/Y_train']).astype(np.float32)
-        X_valid = np.array(dataset['/'+dataset_name+'/X_valid']).astype(np.float32)
-        Y_valid = np.array(dataset['/'+dataset_name+'/Y_valid']).astype(np.float32)
-        X_test = np.array(dataset['/'+dataset_name+'/X_test']).astype(np.float32)
-        Y_test = np.array(dataset['/'+dataset_name+'/Y_test']).astype(np.float32)
+        X_train_key = '/'+dataset_name+'/X_train'
+        Y_train = read('/'+dataset_name+'/Y_train')
+        X_valid = read('/'+dataset_name+'/X_valid')
+        Y_valid = read('/'+dataset_name+'/Y_valid')
+        X_test = read('/'+dataset_name+'/X_test')
+        Y_test = read('/'+dataset_name+'/Y_test')
 
     # expand dims of targets if needed
     if len(Y_train.shape) == 1:
@@ -93,25 +131,44 @@ def load_rnacompete_data(file_path, ss_type='seq', normalization='log_norm', rbp
         Y_test = np.expand_dims(Y_test, axis=1)
 
     # transpose to make (N, L, A)
-    X_train = X_train.transpose([0, 2, 1])
     X_test = X_test.transpose([0, 2, 1])
     X_valid = X_valid.transpose([0, 2, 1])
 
-    # filter NaN
-    train_index = np.where(np.isnan(Y_train) == False)[0]
-    valid_index = np.where(np.isnan(Y_valid) == False)[0]
-    test_index = np.where(np.isnan(Y_test) == False)[0]
-    Y_train = Y_train[train_index]
-    Y_valid = Y_valid[valid_index]
-    Y_test = Y_test[test_index]
-    X_train = X_train[train_index]
-    X_valid = X_valid[valid_index]
-    X_test = X_test[test_index]
-
-    # normalize intenensities
-    Y_train, params_train = normalize_data(Y_train, normalization)
-    Y_valid, params_valid = normalize_data(Y_valid, normalization)
-    Y_test, params_test = normalize_data(Y_test, normalization)
+    if mask_value is None:
+        # filter NaN
+        train_index = np.where(np.isnan(Y_train) == False)[0]
+        valid_index = np.where(np.isnan(Y_valid) == False)[0]
+        test_index = np.where(np.isnan(Y_test) == False)[0]
+        Y_train = Y_train[train_index]
+        Y_valid = Y_valid[valid_index]
+        Y_test = Y_test[test_index]
+        X_valid = X_valid[valid_index]
+        X_test = X_test[test_index]
+
+        # normalize intenensities
+        Y_train, params_train = normalize_data(Y_train, normalization)
+        Y_valid, params_valid = normalize_data(Y_valid, normalization)
+        Y_test, params_test = normalize_data(Y_test, normalization)
+    else:
+        # keep sequences with a measurement in any experiment and mask the missing ones
+        train_index = np.where(np.any(np.isnan(Y_train) == False, axis=1))[0]
+        valid_index = np.where(np.any(np.isnan(Y_valid) == False, axis=1))[0]
+        test_index = np.where(np.any(np.isnan(Y_test) == False, axis=1))[0]
+        Y_train = normalize_columns(Y_train[train_index], normalization)
+        Y_valid = normalize_columns(Y_valid[valid_index], normalization)
+        Y_test = normalize_columns(Y_test[test_index], normalization)
+        X_valid = X_valid[valid_index]
+        X_test = X_test[test_index]
+
+    # the training set is normalized with the statistics of all shards
+    if shard is not None:
+        shard_index, num_shards = shard
+        size = len(train_index)//num_shards
+        train_index = train_index[shard_index*size:(shard_index+1)*size]
+        Y_train = Y_train[shard_index*size:(shard_index+1)*size]
+    X_train = read(X_train_key, train_index).transpose([0, 2, 1])
+
+    monitor.count('sequences_loaded', len(X_train) + len(X_valid) + len(X_test))
 
     # dictionary for each dataset
     train = {'inputs': X_train, 'targets': Y_train}
@@ -128,6 +185,7 @@ def load_rnacompete_data(file_path, ss_type='seq', normalization='log_norm', rbp
 
 
 def dataset_keys_hdf5(file_path):
+    import h5py
     dataset = h5py.File(file_path, 'r')
     keys = []
     for key in dataset.keys():
@@ -137,6 +195,7 @@ def dataset_keys_hdf5(file_path):
 
 def get_experiment_names(file_path):
     """Get the name of a given RNAcompete experiment"""
+    import h5py
     dataset = h5py.File(file_path, 'r')
     return [i.decode('UTF-8') for i in np.array(dataset['experiment'])]
 
@@ -148,6 +207,8 @@ def find_experiment_index(data_path, experiment):
     
 def add_significance(all_scores, start, end, height, percentile=97.5, significance=0.5, fontsize=14):
     """Add significance to bar plots"""
+    import matplotlib.pyplot as plt
+    from scipy import stats
 
     def significance_bar(start,end,height,displaystring,linewidth = 1.2,
                          markersize = 8,boxpad=0.3,fontsize = 15,color = 'k'):
@@ -158,7 +219,11 @@ def add_significance(all_scores, start, end, height, percentile=97.5, significan
         plt.text(0.5*(start+end),height,displaystring,ha = 'center',va='center',bbox=dict(facecolor='1.', edgecolor='none',boxstyle='Square,pad='+str(boxpad)),size = fontsize)
 
     #results = stats.wilcoxon(all_scores[start-1], all_scores[end-1])
-    results = stats.ttest_ind(all_scores[start-1], all_scores[end-1], equal_var=False) # Welch’s t-test because unequal variance
+    if hasattr(all_scores[start-1], 'ttest'):
+        # streaming GIA statistics (EffectAccumulator)
+        results = all_scores[start-1].ttest(all_scores[end-1])
+    else:
+        results = stats.ttest_ind(all_scores[start-1], all_scores[end-1], equal_var=False) # Welch’s t-test because unequal variance
     if results.pvalue > significance:
         displaystring = 'NS'
     else:
@@ -0,0 +1,398 @@
+import os, time
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from numpy_inference import fold_layers
+from monitor import log_event
+
+
+#-------------------------------------------------------------------------------------
+# Folding BatchNorm into the preceding Conv1D/Dense layers
+#-------------------------------------------------------------------------------------
+
+
+def fold_batchnorm(model):
+    """fold a trained ResidualBind keras model into inference parameters
+
+    Every BatchNormalization is folded into the kernel and bias of the Conv1D
+    or Dense layer before it. Dropout layers are dropped from the graph, but
+    their rate is kept as the input dropout of the next Conv1D/Dense layer.
+    """
+    layers = []
+    for layer in model.layers:
+        if isinstance(layer, keras.layers.GlobalAveragePooling1D):
+            raise ValueError('only fixed-length models can be folded into an inference graph')
+        config = layer.get_config()
+        if isinstance(layer, keras.layers.Conv1D):
+            layers.append({'type': 'conv', 'weights': layer.get_weights(),
+                           'dilation': config['dilation_rate'][0], 'use_bias': config['use_bias']})
+        elif isinstance(layer, keras.layers.Dense):
+            layers.append({'type': 'dense', 'weights': layer.get_weights(), 'use_bias': config['use_bias']})
+        elif isinstance(layer, keras.layers.BatchNormalization):
+            layers.append({'type': 'batchnorm', 'weights': layer.get_weights(), 'epsilon': config['epsilon']})
+        elif isinstance(layer, keras.layers.Dropout):
+            layers.append({'type': 'dropout', 'rate': config['rate']})
+        elif isinstance(layer, keras.layers.AveragePooling1D):
+            layers.append({'type': 'pool', 'pool_size': config['pool_size'][0]})
+        elif isinstance(layer, keras.layers.Activation) and config['activation'] == 'sigmoid':
+            layers.append({'type': 'sigmoid'})
+    return fold_layers(layers)
+
+
+#-------------------------------------------------------------------------------------
+# Frozen inference graph
+#-------------------------------------------------------------------------------------
+
+
+class FrozenGraph(tf.Module):
+    """ResidualBind forward pass on folded parameters as a tf.function with a fixed input signature"""
+    def __init__(self, params, input_shape):
+        super().__init__()
+        self.conv = [{'kernel': tf.Variable(c['kernel'], trainable=False),
+                      'bias': tf.Variable(c['bias'], trainable=False)} for c in params['conv']]
+        self.dense = [{'kernel': tf.Variable(d['kernel'], trainable=False),
+                       'bias': tf.Variable(d['bias'], trainable=False)} for d in params['dense']]
+        self.dilation = [int(c['dilation']) for c in params['conv']]
+        self.conv_dropout = [float(c['dropout']) for c in params['conv']]
+        self.dense_dropout = [float(d['dropout']) for d in params['dense']]
+        self.pool_size = int(params['pool_size'])
+        self.classification = bool(params['classification'])
+        self.input_shape = tuple(input_shape)
+        self.serve = tf.function(self._forward,
+                                 input_signature=[tf.TensorSpec((None,) + self.input_shape, tf.float32)])
+
+
+    def _conv(self, x, i):
+        nn = tf.nn.conv1d(x, self.conv[i]['kernel'], stride=1, padding='SAME', dilations=self.dilation[i])
+        return nn + self.conv[i]['bias']
+
+
+    def _dropout(self, x, rate):
+        """dropout is removed from the inference graph (see MCDropoutGraph)"""
+        return x
+
+
+    def _forward(self, x):
+        # layer 1 (its dropout also applies to the skip connection)
+        nn = tf.nn.relu(self._conv(x, 0))
+        nn = self._dropout(nn, self.conv_dropout[1])
+
+        # dilated residual block
+        residual = self._conv(nn, 1)
+        for i in range(2, len(self.conv)):
+            residual = self._conv(self._dropout(tf.nn.relu(residual), self.conv_dropout[i]), i)
+        nn = tf.nn.relu(nn + residual)
+
+        # average pooling
+        nn = tf.nn.avg_pool1d(nn, ksize=self.pool_size, strides=self.pool_size, padding='VALID')
+
+        # fully-connected NN
+        nn = tf.reshape(nn, [tf.shape(nn)[0], -1])
+        for i, d in enumerate(self.dense[:-1]):
+            nn = tf.nn.relu(tf.matmul(self._dropout(nn, self.dense_dropout[i]), d['kernel']) + d['bias'])
+        nn = self._dropout(nn, self.dense_dropout[-1])
+        outputs = tf.matmul(nn, self.dense[-1]['kernel']) + self.dense[-1]['bias']
+
+        if self.classification:
+            outputs = tf.sigmoid(outputs)
+        return outputs
+
+
+class MCDropoutGraph(FrozenGraph):
+    """Monte-Carlo dropout: the frozen graph with its dropout active
+
+    serve tiles a batch num_samples times and runs all samples in one forward
+    pass, returning predictions of shape (num_samples, N, num_class).
+    BatchNorm stays folded with its moving statistics.
+    """
+    def __init__(self, params, input_shape, num_samples=20):
+        super().__init__(params, input_shape)
+        self.num_samples = int(num_samples)
+        self.serve = tf.function(self._sample,
+                                 input_signature=[tf.TensorSpec((None,) + self.input_shape, tf.float32)])
+
+
+    def _dropout(self, x, rate):
+        return tf.nn.dropout(x, rate) if rate > 0 else x
+
+
+    def _sample(self, x):
+        N = tf.shape(x)[0]
+        outputs = self._forward(tf.tile(x, [self.num_samples] + [1]*len(self.input_shape)))
+        return tf.reshape(outputs, [self.num_samples, N, -1])
+
+
+class InferenceModel():
+    """Predict interface for a frozen (or exported) ResidualBind graph"""
+    def __init__(self, graph):
+        self.graph = graph
+
+
+    def predict(self, X, batch_size=100):
+        X = np.asarray(X, dtype=np.float32)
+        if not len(X):
+            return self.graph.serve(tf.zeros((1,) + X.shape[1:])).numpy()[:0]
+        predictions = []
+        for start in range(0, len(X), batch_size):
+            predictions.append(self.graph.serve(tf.constant(X[start:start+batch_size])).numpy())
+        return np.concatenate(predictions, axis=0)
+
+
+def freeze(model, input_shape):
+    """frozen inference model (folded BatchNorm, no dropout) of a keras ResidualBind model"""
+    return InferenceModel(FrozenGraph(fold_batchnorm(model), input_shape))
+
+
+def mc_dropout(model, input_shape, num_samples=20):
+    """Monte-Carlo dropout model of a keras ResidualBind model (see EnsembleModel.predict_uncertainty)"""
+    return EnsembleModel(MCDropoutGraph(fold_batchnorm(model), input_shape, num_samples))
+
+
+def export_inference(model, input_shape, export_path):
+    """save the frozen graph as a SavedModel that loads without the model-definition code"""
+    graph = FrozenGraph(fold_batchnorm(model), input_shape)
+    tf.saved_model.save(graph, export_path, signatures=graph.serve)
+    log_event('export', '  Exporting inference graph to: ' + export_path, path=export_path)
+    return export_path
+
+
+def load_inference(export_path):
+    """load an exported inference graph"""
+    if not os.path.isdir(export_path):
+        raise IOError('inference graph not found: ' + export_path)
+    return InferenceModel(tf.saved_model.load(export_path))
+
+
+#-------------------------------------------------------------------------------------
+# Ensembles of replicates (seeds, cross-validation folds)
+#-------------------------------------------------------------------------------------
+
+
+def stack_params(params_list):
+    """stack the folded parameters of replicates with the same architecture along a member axis"""
+    first = params_list[0]
+    for params in params_list[1:]:
+        shapes = [u['kernel'].shape for u in params['conv'] + params['dense']]
+        if shapes != [u['kernel'].shape for u in first['conv'] + first['dense']] or \
+           params['pool_size'] != first['pool_size'] or params['classification'] != first['classification']:
+            raise ValueError('ensemble members must have the same architecture')
+    stacked = {'conv': [], 'dense': [], 'pool_size': first['pool_size'], 'classification': first['classification']}
+    for kind in ['conv', 'dense']:
+        for i, unit in enumerate(first[kind]):
+            stacked[kind].append({'kernel': np.stack([p[kind][i]['kernel'] for p in params_list]),
+                                  'bias': np.stack([p[kind][i]['bias'] for p in params_list])})
+            if kind == 'conv':
+                stacked[kind][-1]['dilation'] = unit['dilation']
+    return stacked
+
+
+class EnsembleGraph(tf.Module):
+    """Forward pass of M ResidualBind replicates at once
+
+    The members' channels are laid side by side (N, L, M*C): the first layer
+    is one convolution with the members' kernels concatenated, the residual
+    convolutions are grouped convolutions (one group per member) and the
+    dense layers are matrix products batched over the members, so a batch is
+    scored by all members in one call.
+    """
+    def __init__(self, stacked_params, input_shape):
+        super().__init__()
+        def side_by_side(kernel):
+            # (M, K, C, D) -> (K, C, M*D)
+            M, K, C, D = kernel.shape
+            return np.transpose(kernel, [1, 2, 0, 3]).reshape(K, C, M*D)
+        self.conv = [{'kernel': tf.Variable(side_by_side(c['kernel']), trainable=False),
+                      'bias': tf.Variable(c['bias'].reshape(-1), trainable=False)} for c in stacked_params['conv']]
+        self.dense = [{'kernel': tf.Variable(d['kernel'], trainable=False),
+                       'bias': tf.Variable(d['bias'][:, np.newaxis, :], trainable=False)} for d in stacked_params['dense']]
+        self.dilation = [int(c['dilation']) for c in stacked_params['conv']]
+        self.pool_size = int(stacked_params['pool_size'])
+        self.classification = bool(stacked_params['classification'])
+        self.num_members = int(stacked_params['conv'][0]['kernel'].shape[0])
+        self.input_shape = tuple(input_shape)
+        self.serve = tf.function(self._forward,
+                                 input_signature=[tf.TensorSpec((None,) + self.input_shape, tf.float32)])
+
+
+    def _conv(self, x, i):
+        # input channels/kernel input channels gives the number of groups
+        nn = tf.nn.conv1d(x, self.conv[i]['kernel'], stride=1, padding='SAME', dilations=self.dilation[i])
+        return nn + self.conv[i]['bias']
+
+
+    def _forward(self, x):
+        # layer 1
+        nn = tf.nn.relu(self._conv(x, 0))
+
+        # dilated residual block
+        residual = self._conv(nn, 1)
+        for i in range(2, len(self.conv)):
+            residual = self._conv(tf.nn.relu(residual), i)
+        nn = tf.nn.relu(nn + residual)
+
+        # average pooling
+        nn = tf.nn.avg_pool1d(nn, ksize=self.pool_size, strides=self.pool_size, padding='VALID')
+
+        # fully-connected NN, batched over members: (N, P, M*C) -> (M, N, P*C)
+        N, P = tf.shape(nn)[0], tf.shape(nn)[1]
+        nn = tf.reshape(nn, [N, P, self.num_members, -1])
+        nn = tf.reshape(tf.transpose(nn, [2, 0, 1, 3]), [self.num_members, N, -1])
+        for d in self.dense[:-1]:
+            nn = tf.nn.relu(tf.matmul(nn, d['kernel']) + d['bias'])
+        outputs = tf.matmul(nn, self.dense[-1]['kernel']) + self.dense[-1]['bias']
+
+        if self.classification:
+            outputs = tf.sigmoid(outputs)
+        return outputs
+
+
+class EnsembleModel():
+    """Predict interface for an ensemble of ResidualBind replicates (or of
+    Monte-Carlo dropout samples, see mc_dropout)
+
+    predict returns the ensemble mean, so it can replace a single model (e.g.
+    in GlobalImportance); predict_members also returns the variance across
+    members and the predictions of each member, shape (M, N, num_class).
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+
+    def predict_members(self, X, batch_size=100):
+        X = np.asarray(X, dtype=np.float32)
+        if not len(X):
+            members = self.graph.serve(tf.zeros((1,) + X.shape[1:])).numpy()[:, :0]
+        else:
+            members = np.concatenate([self.graph.serve(tf.constant(X[start:start+batch_size])).numpy()
+                                      for start in range(0, len(X), batch_size)], axis=1)
+        return {'mean': np.mean(members, axis=0), 'variance': np.var(members, axis=0), 'members': members}
+
+
+    def predict(self, X, batch_size=100):
+        return self.predict_members(X, batch_size)['mean']
+
+
+    def predict_uncertainty(self, X, num_samples=None, batch_size=100):
+        """predictive mean, variance and samples (the members), as ResidualBind.predict_uncertainty;
+           the number of samples is fixed by the graph, num_samples is ignored"""
+        predictions = self.predict_members(X, batch_size)
+        predictions['samples'] = predictions.pop('members')
+        return predictions
+
+
+def load_ensemble(weights_paths, input_shape, dilations=[2, 4, 8], pool_size=10):
+    """ensemble of ResidualBind weights files (replicates with the same architecture)"""
+    from numpy_inference import load_folded_weights
+    stacked = stack_params([load_folded_weights(path, dilations, pool_size) for path in weights_paths])
+    return EnsembleModel(EnsembleGraph(stacked, input_shape))
+
+
+def ensemble(models, input_shape):
+    """ensemble of trained keras ResidualBind models"""
+    return EnsembleModel(EnsembleGraph(stack_params([fold_batchnorm(model) for model in models]), input_shape))
+
+
+#-------------------------------------------------------------------------------------
+# Post-training quantization for CPU inference
+#-------------------------------------------------------------------------------------
+
+
+def export_tflite(model, input_shape, tflite_path, quantization='int8', calibration_data=None, num_calibration=500):
+    """convert the frozen graph to a quantized TFLite flatbuffer
+
+    quantization is 'int8', 'float16' or None (float32). For 'int8', weights
+    are always quantized; with calibration_data (e.g. test['inputs'] from
+    helper.load_rnacompete_data) activations are quantized as well, otherwise
+    dynamic-range quantization is used. Inputs and outputs stay float32.
+    """
+    graph = FrozenGraph(fold_batchnorm(model), input_shape)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([graph.serve.get_concrete_function()], graph)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if calibration_data is not None:
+            index = np.random.permutation(len(calibration_data))[:num_calibration]
+            calibration_data = np.asarray(calibration_data, dtype=np.float32)[index]
+
+            def representative_dataset():
+                for x in calibration_data:
+                    yield [x[np.newaxis]]
+            converter.representative_dataset = representative_dataset
+    elif quantization is not None:
+        raise ValueError("quantization must be 'int8', 'float16' or None")
+
+    with open(tflite_path, 'wb') as f:
+        f.write(converter.convert())
+    log_event('export', '  Exporting quantized model to: ' + tflite_path, path=tflite_path,
+              quantization=quantization)
+    return tflite_path
+
+
+class TFLiteModel():
+    """Predict interface for a (quantized) TFLite ResidualBind model"""
+    def __init__(self, tflite_path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.num_class = int(self.interpreter.get_output_details()[0]['shape'][-1])
+        self.batch_size = None
+
+
+    def predict(self, X, batch_size=100):
+        X = np.asarray(X, dtype=np.float32)
+        if not len(X):
+            return np.zeros((0, self.num_class), dtype=np.float32)
+        predictions = []
+        for start in range(0, len(X), batch_size):
+            x = X[start:start+batch_size]
+
+            # tensors are reallocated only when the batch size changes
+            if len(x) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, x.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(x)
+            self.interpreter.set_tensor(self.input_index, x)
+            self.interpreter.invoke()
+            predictions.append(np.copy(self.interpreter.get_tensor(self.output_index)))
+        return np.concatenate(predictions, axis=0)
+
+
+def quantization_report(model, input_shape, tflite_path, test, batch_size=100, num_threads=1):
+    """compare a quantized TFLite model with the float32 frozen graph on a test set
+
+    Returns Pearson r of both models, the accuracy delta, throughput (sequences
+    per second with num_threads threads for TFLite) and model size in bytes.
+    """
+    from residualbind import pearsonr_scores
+
+    def throughput(predictor):
+        start = time.time()
+        predictions = predictor.predict(test['inputs'], batch_size=batch_size)
+        return predictions, len(test['inputs'])/(time.time() - start)
+
+    params = fold_batchnorm(model)
+    float_model = InferenceModel(FrozenGraph(params, input_shape))
+    quantized_model = TFLiteModel(tflite_path, num_threads=num_threads)
+    float_model.predict(test['inputs'][:batch_size], batch_size)
+    quantized_model.predict(test['inputs'][:batch_size], batch_size)
+
+    float_predictions, float_throughput = throughput(float_model)
+    quantized_predictions, quantized_throughput = throughput(quantized_model)
+    float_r = np.nanmean(pearsonr_scores(test['targets'], float_predictions))
+    quantized_r = np.nanmean(pearsonr_scores(test['targets'], quantized_predictions))
+
+    float_size = sum(unit[key].nbytes for unit in params['conv'] + params['dense'] for key in ['kernel', 'bias'])
+    return {'float32_pearsonr': float_r,
+            'quantized_pearsonr': quantized_r,
+            'delta_pearsonr': quantized_r - float_r,
+            'float32_seqs_per_sec': float_throughput,
+            'quantized_seqs_per_sec': quantized_throughput,
+            'float32_bytes': float_size,
+            'quantized_bytes': os.path.getsize(tflite_path)}
@@ -0,0 +1,169 @@
+"""K-mer effect tables and a surrogate scorer built on them.
+
+GlobalImportance.optimal_kmer scores every k-mer of a given size for an RBP.
+save_kmer_table stores those effects as one float32 array indexed by the
+k-mer (base-4 number of its letters), so that KmerScorer can score any
+sequence or transcript in O(L) with array lookups: the index of every k-mer
+in a sequence is computed at once from its integer encoding and looked up in
+the table.
+
+The surrogate serves as a pre-filter for scans: KmerScorer.scan scores all
+windows of a transcript with the table and sends only the best windows to the
+full model.
+
+Usage:
+    kmers, mean_scores = gi.optimal_kmer(6, 17)
+    save_kmer_table(table_path, kmers, mean_scores, position=17)
+
+    scorer = KmerScorer.load(table_path)
+    hits = scorer.scan(transcript, model, window=41, top_fraction=0.01)
+"""
+
+import numpy as np
+from helper import encode_sequence
+
+
+def kmer_table_index(kmers, alphabet='ACGU'):
+    """table index of each k-mer string (the order of itertools.product over the alphabet;
+       residualbind.kmer_index gives the categorical k-mers in that order)"""
+    kmers = list(kmers)
+    codes = np.array([encode_sequence(kmer, alphabet) for kmer in kmers])
+    if np.any(codes < 0):
+        raise ValueError('k-mers must only contain the letters ' + alphabet)
+    return np.dot(codes, len(alphabet)**np.arange(codes.shape[1])[::-1])
+
+
+def kmer_table(kmers, scores, alphabet='ACGU'):
+    """effect of every k-mer as an array indexed by kmer_table_index (e.g. from optimal_kmer)"""
+    kmers = list(kmers)
+    kmer_size = len(kmers[0])
+    if len(kmers) != len(alphabet)**kmer_size:
+        raise ValueError('a k-mer table needs the scores of all %d k-mers'%(len(alphabet)**kmer_size))
+    table = np.zeros(len(kmers), dtype=np.float32)
+    table[kmer_table_index(kmers, alphabet)] = scores
+    return table
+
+
+def save_kmer_table(file_path, kmers, scores, position=None, alphabet='ACGU'):
+    """save the effects of all k-mers (in any order) as a compact array"""
+    table = kmer_table(kmers, scores, alphabet)
+    with open(file_path, 'wb') as f:
+        np.savez(f, table=table, kmer_size=len(kmers[0]), alphabet=alphabet,
+                 position=-1 if position is None else position)
+    return file_path
+
+
+def load_kmer_table(file_path):
+    """table, k-mer size, alphabet and embedding position of a saved k-mer table"""
+    with np.load(file_path) as data:
+        position = int(data['position'])
+        return data['table'], int(data['kmer_size']), str(data['alphabet']), (None if position < 0 else position)
+
+
+#-------------------------------------------------------------------------------------
+# Surrogate scoring
+#-------------------------------------------------------------------------------------
+
+
+class KmerScorer():
+    """Scores sequences by the table effects of the k-mers they contain"""
+    def __init__(self, table, kmer_size, alphabet='ACGU'):
+        if len(table) != len(alphabet)**kmer_size:
+            raise ValueError('table must have %d entries'%(len(alphabet)**kmer_size))
+        self.table = np.asarray(table, dtype=np.float32)
+        self.kmer_size = kmer_size
+        self.alphabet = alphabet
+
+
+    @classmethod
+    def load(cls, file_path):
+        table, kmer_size, alphabet, _ = load_kmer_table(file_path)
+        return cls(table, kmer_size, alphabet)
+
+
+    def kmer_indices(self, x_index):
+        """table index of the k-mer starting at each position of integer-encoded sequences
+           (..., L) -> (..., L-k+1); k-mers with letters outside the alphabet are -1"""
+        x_index = np.asarray(x_index)
+        k = self.kmer_size
+        num_kmers = x_index.shape[-1] - k + 1
+        if num_kmers < 1:
+            return np.zeros(x_index.shape[:-1] + (0,), dtype=np.int64)
+        index = np.zeros(x_index.shape[:-1] + (num_kmers,), dtype=np.int64)
+        invalid = np.zeros(index.shape, dtype=bool)
+        for j in range(k):
+            letters = x_index[..., j:j+num_kmers]
+            index = index*len(self.alphabet) + letters
+            invalid |= letters < 0
+        index[invalid] = -1
+        return index
+
+
+    def position_scores(self, X):
+        """effect of the k-mer at each position, for one-hot (N, L, A) or integer (N, L)
+           sequences or a sequence string; positions with unknown letters get -inf"""
+        if isinstance(X, str):
+            X = encode_sequence(X, self.alphabet)
+        else:
+            X = np.asarray(X)
+            if X.ndim == 3:
+                X = np.where(np.max(X, axis=2) > 0, np.argmax(X, axis=2), -1)
+        index = self.kmer_indices(X)
+        return np.where(index >= 0, self.table[np.maximum(index, 0)], -np.inf)
+
+
+    def score(self, X, reduce='max'):
+        """surrogate score per sequence: the strongest k-mer ('max') or the sum of the
+           positive k-mer effects ('sum')"""
+        scores = self.position_scores(X)
+        if reduce == 'max':
+            return np.max(scores, axis=-1)
+        elif reduce == 'sum':
+            return np.sum(np.maximum(scores, 0), axis=-1)
+        raise ValueError("reduce must be 'max' or 'sum'")
+
+
+    def window_scores(self, sequence, window=41, reduce='max'):
+        """surrogate score of every window of a sequence string (window start positions)"""
+        from numpy.lib.stride_tricks import sliding_window_view
+        scores = self.position_scores(sequence)
+        span = window - self.kmer_size + 1
+        if len(scores) < span:
+            return np.zeros(0, dtype=np.float32)
+        if reduce == 'max':
+            return np.max(sliding_window_view(scores, span), axis=-1)
+        elif reduce == 'sum':
+            # running sum of the positive effects
+            cumulative = np.concatenate([[0.], np.cumsum(np.maximum(scores, 0))])
+            return cumulative[span:] - cumulative[:-span]
+        raise ValueError("reduce must be 'max' or 'sum'")
+
+
+    def scan(self, sequence, model=None, window=41, stride=1, threshold=None, top_fraction=0.01,
+             reduce='max', batch_size=1000):
+        """pre-filtered scan of a transcript
+
+        All windows are scored with the table; the windows at stride with a
+        surrogate score above threshold (or, without threshold, the top_fraction
+        best) are scored by model (anything with predict on one-hot windows).
+        Returns the window starts, their surrogate scores and the model scores
+        (None without model).
+        """
+        surrogate = self.window_scores(sequence, window, reduce)
+        starts = np.arange(0, len(surrogate), stride)
+        surrogate = surrogate[starts]
+        if threshold is None:
+            num_keep = min(len(starts), max(1, int(np.ceil(top_fraction*len(starts)))))
+            keep = np.sort(np.argsort(surrogate)[::-1][:num_keep])
+        else:
+            keep = np.where(surrogate >= threshold)[0]
+        starts, surrogate = starts[keep], surrogate[keep]
+
+        predictions = None
+        if model is not None and len(starts):
+            x_index = encode_sequence(sequence, self.alphabet)
+            windows = x_index[starts[:, np.newaxis] + np.arange(window)]
+            one_hot = np.eye(len(self.alphabet), dtype=np.float32)[np.maximum(windows, 0)]
+            one_hot[windows < 0] = 0
+            predictions = model.predict(one_hot, batch_size=batch_size)
+        return {'starts': starts, 'surrogate_scores': surrogate, 'predictions': predictions}
@@ -0,0 +1,220 @@
+"""Timers, counters and structured logging for training, inference and GIA.
+
+Timed sections are recorded in a global Monitor (monitor.monitor). Timers are
+inclusive, so a GlobalImportance method also contains the time of the predict
+calls it makes. A driver resets the monitor for each experiment, collects its
+snapshot in a SweepReport and writes the per-experiment and aggregated
+reports at the end of the sweep.
+
+Usage:
+    from monitor import monitor, SweepReport
+
+    with monitor.timer('plotting'):
+        ...
+    monitor.count('bytes_read', num_bytes)
+    print(monitor.report())
+
+Progress messages and metrics (per-epoch loss, validation r, learning rate,
+epoch time, predict throughput) are logged as events on the 'residualbind'
+logger, which is silent unless a handler is attached:
+
+    import monitor
+    monitor.set_verbosity(1)                 # progress messages on stdout
+    monitor.log_to_jsonl('events.jsonl')     # one json object per event
+"""
+
+import sys, time, json, logging, functools, contextlib, collections
+
+
+class Monitor():
+    """Registry of named timers (calls, seconds, items processed) and counters"""
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.timers = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+
+    def add_time(self, name, seconds, items=0):
+        timer = self.timers.setdefault(name, {'calls': 0, 'seconds': 0., 'items': 0})
+        timer['calls'] += 1
+        timer['seconds'] += seconds
+        timer['items'] += int(items)
+
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    @contextlib.contextmanager
+    def timer(self, name, items=0):
+        """time a block; items (e.g. number of sequences) gives the throughput"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, items)
+
+
+    def timed(self, name=None):
+        """decorator that times every call of a function"""
+        def decorator(fn):
+            timer_name = name or fn.__qualname__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(timer_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def snapshot(self):
+        """copy of the timers (with items per second) and counters"""
+        timers = collections.OrderedDict()
+        for name, timer in self.timers.items():
+            timers[name] = dict(timer)
+            if timer['items'] and timer['seconds'] > 0:
+                timers[name]['items_per_sec'] = timer['items']/timer['seconds']
+        return {'timers': timers, 'counters': dict(self.counters)}
+
+
+    def report(self, title=None):
+        return format_report(self.snapshot(), title)
+
+
+def format_report(snapshot, title=None):
+    """text table of a monitor snapshot"""
+    lines = [title] if title else []
+    lines.append('  %-40s %8s %12s %14s'%('timer', 'calls', 'seconds', 'items/sec'))
+    for name, timer in snapshot['timers'].items():
+        rate = '%14.1f'%(timer['items_per_sec']) if 'items_per_sec' in timer else '%14s'%('-')
+        lines.append('  %-40s %8d %12.3f %s'%(name, timer['calls'], timer['seconds'], rate))
+    for name, value in snapshot['counters'].items():
+        lines.append('  %-40s %8s %12s %14s'%(name, '', '', value))
+    return '\n'.join(lines)
+
+
+class SweepReport():
+    """Per-experiment monitor snapshots of a sweep and their aggregate"""
+    def __init__(self):
+        self.experiments = collections.OrderedDict()
+
+
+    def add(self, experiment, snapshot):
+        self.experiments[experiment] = snapshot
+
+
+    def aggregate(self):
+        total = Monitor()
+        for snapshot in self.experiments.values():
+            for name, timer in snapshot['timers'].items():
+                entry = total.timers.setdefault(name, {'calls': 0, 'seconds': 0., 'items': 0})
+                for key in ['calls', 'seconds', 'items']:
+                    entry[key] += timer[key]
+            for name, value in snapshot['counters'].items():
+                total.count(name, value)
+        return total.snapshot()
+
+
+    def report(self):
+        return format_report(self.aggregate(), 'Sweep (%d experiments)'%(len(self.experiments)))
+
+
+    def write(self, file_path):
+        """save per-experiment and aggregated timings as json"""
+        with open(file_path, 'w') as f:
+            json.dump({'experiments': self.experiments, 'total': self.aggregate()}, f, indent=2)
+        return file_path
+
+
+@contextlib.contextmanager
+def trace(logdir=None):
+    """record a TensorFlow profiler trace (viewable in TensorBoard) when logdir is given"""
+    if logdir is None:
+        yield
+        return
+    import tensorflow as tf
+    tf.profiler.experimental.start(logdir)
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
+
+
+# global monitor used by helper, residualbind and the drivers
+monitor = Monitor()
+
+
+#-------------------------------------------------------------------------------------
+# Structured logging
+#-------------------------------------------------------------------------------------
+
+
+logger = logging.getLogger('residualbind')
+logger.addHandler(logging.NullHandler())
+
+
+def log_event(event, message=None, level=logging.INFO, **fields):
+    """log an event with fields; message is the human-readable form"""
+    if logger.isEnabledFor(level):
+        logger.log(level, message or event, extra={'event': event, 'fields': fields})
+
+
+class JSONLHandler(logging.Handler):
+    """writes every log record as a json line, flushed so that it can be tailed"""
+    def __init__(self, file_path, mode='a'):
+        super().__init__()
+        self.file = open(file_path, mode)
+
+
+    def emit(self, record):
+        entry = {'time': record.created, 'level': record.levelname,
+                 'event': getattr(record, 'event', None), 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        try:
+            self.file.write(json.dumps(entry, default=float) + '\n')
+            self.file.flush()
+        except Exception:
+            self.handleError(record)
+
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def set_verbosity(verbose=1, stream=sys.stdout):
+    """0: silent, 1: progress messages, 2: debug messages and keras progress bars"""
+    global _verbosity, _stream_handler
+    if _stream_handler is not None:
+        logger.removeHandler(_stream_handler)
+        _stream_handler = None
+    _verbosity = verbose
+    if verbose:
+        _stream_handler = logging.StreamHandler(stream)
+        _stream_handler.setFormatter(logging.Formatter('%(message)s'))
+        _stream_handler.setLevel(logging.DEBUG if verbose > 1 else logging.INFO)
+        logger.addHandler(_stream_handler)
+        logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def log_to_jsonl(file_path, level=logging.INFO):
+    """stream events to a jsonl file (handlers are removed with logger.removeHandler)"""
+    handler = JSONLHandler(file_path)
+    handler.setLevel(level)
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    return handler
+
+
+def keras_verbose():
+    """verbose argument for keras fit/predict: progress bars only at verbosity 2"""
+    return 1 if _verbosity > 1 else 0
+
+
+_verbosity = 0
+_stream_handler = None
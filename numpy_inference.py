@@ -0,0 +1,173 @@
+"""Inference-only ResidualBind forward pass in NumPy.
+
+Loads the *_weights.hdf5 files written by ResidualBind.save_weights and scores
+sequences without importing TensorFlow.
+"""
+
+import h5py
+import numpy as np
+
+
+#-------------------------------------------------------------------------------------
+# Folded parameters
+#-------------------------------------------------------------------------------------
+
+
+def fold_layers(layers):
+    """fold a sequence of layer descriptions into inference parameters
+
+    Each layer is a dict with 'type' in ['conv', 'dense', 'batchnorm', 'dropout',
+    'pool', 'sigmoid']. Every batchnorm is folded into the kernel and bias of the
+    conv/dense layer before it; dropout rates are kept as the input dropout of
+    the next conv/dense layer.
+    """
+    params = {'conv': [], 'dense': [], 'pool_size': None, 'classification': False}
+    dropout = 0.
+    for i, layer in enumerate(layers):
+        if layer['type'] in ['conv', 'dense']:
+            kernel = layer['weights'][0].astype(np.float32)
+            if layer['use_bias']:
+                bias = layer['weights'][1].astype(np.float32)
+            else:
+                bias = np.zeros(kernel.shape[-1], dtype=np.float32)
+
+            # fold the following batchnorm
+            if i+1 < len(layers) and layers[i+1]['type'] == 'batchnorm':
+                gamma, beta, moving_mean, moving_variance = layers[i+1]['weights']
+                scale = gamma/np.sqrt(moving_variance + layers[i+1]['epsilon'])
+                kernel = kernel*scale
+                bias = (bias - moving_mean)*scale + beta
+
+            unit = {'kernel': kernel.astype(np.float32), 'bias': bias.astype(np.float32), 'dropout': dropout}
+            if layer['type'] == 'conv':
+                unit['dilation'] = layer['dilation']
+                params['conv'].append(unit)
+            else:
+                params['dense'].append(unit)
+            dropout = 0.
+
+        elif layer['type'] == 'dropout':
+            dropout = layer['rate']
+        elif layer['type'] == 'pool':
+            params['pool_size'] = layer['pool_size']
+        elif layer['type'] == 'sigmoid':
+            params['classification'] = True
+    return params
+
+
+def is_variable_length(weights_path):
+    """whether a weights file holds a variable-length ResidualBind (input_shape=(None, A)),
+       which pools globally over the unpadded positions instead of with pool_size"""
+    with h5py.File(weights_path, 'r') as f:
+        layer_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in f.attrs['layer_names']]
+    return any(name.startswith('global_average_pooling') for name in layer_names)
+
+
+def load_folded_weights(weights_path, dilations=[2, 4, 8], pool_size=10, epsilon=1e-3):
+    """read a keras hdf5 weights file of ResidualBind and fold it into inference parameters
+
+    Dilation rates and pool size are not stored in the weights file and must
+    match the architecture that was trained; a trailing activation layer marks a
+    classification model. Only fixed-length models are supported.
+    """
+    if is_variable_length(weights_path):
+        raise ValueError('%s holds a variable-length model; only fixed-length models can be folded'%(weights_path))
+    with h5py.File(weights_path, 'r') as f:
+        layer_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in f.attrs['layer_names']]
+
+        layers = []
+        conv_dilations = [1, 1] + list(dilations)
+        for name in layer_names:
+            group = f[name]
+            weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+            weights = {n.split('/')[-1].split(':')[0]: np.array(group[n]) for n in weight_names}
+
+            if 'moving_mean' in weights:
+                layers.append({'type': 'batchnorm', 'epsilon': epsilon,
+                               'weights': [weights['gamma'], weights['beta'],
+                                           weights['moving_mean'], weights['moving_variance']]})
+            elif 'kernel' in weights:
+                layer = {'weights': [weights['kernel']] + ([weights['bias']] if 'bias' in weights else []),
+                         'use_bias': 'bias' in weights}
+                if weights['kernel'].ndim == 3:
+                    layer['type'] = 'conv'
+                    layer['dilation'] = conv_dilations[len([l for l in layers if l['type'] == 'conv'])]
+                else:
+                    layer['type'] = 'dense'
+                layers.append(layer)
+
+        classification = layer_names[-1].startswith('activation')
+
+    if len([l for l in layers if l['type'] == 'conv']) != len(conv_dilations):
+        raise ValueError('weights file does not match dilations %s'%(str(dilations)))
+
+    params = fold_layers(layers)
+    params['pool_size'] = pool_size
+    params['classification'] = classification
+    return params
+
+
+#-------------------------------------------------------------------------------------
+# Forward pass
+#-------------------------------------------------------------------------------------
+
+
+def conv1d(x, kernel, bias, dilation=1):
+    """'same' dilated 1D convolution as a single matrix product over the stacked kernel taps"""
+    N, L, C = x.shape
+    K = kernel.shape[0]
+    pad = dilation*(K - 1)
+    x_pad = np.pad(x, ((0, 0), (pad//2, pad - pad//2), (0, 0)))
+    columns = np.concatenate([x_pad[:, k*dilation:k*dilation+L, :] for k in range(K)], axis=2)
+    nn = np.dot(columns.reshape(N*L, K*C), kernel.reshape(K*C, -1)) + bias
+    return nn.reshape(N, L, -1)
+
+
+def forward(params, x):
+    """ResidualBind forward pass on folded parameters"""
+    conv = params['conv']
+
+    # layer 1
+    nn = np.maximum(conv1d(x, conv[0]['kernel'], conv[0]['bias'], conv[0]['dilation']), 0)
+
+    # dilated residual block
+    residual = conv1d(nn, conv[1]['kernel'], conv[1]['bias'], conv[1]['dilation'])
+    for c in conv[2:]:
+        residual = conv1d(np.maximum(residual, 0), c['kernel'], c['bias'], c['dilation'])
+    nn = np.maximum(nn + residual, 0)
+
+    # average pooling
+    N, L, C = nn.shape
+    pool_size = params['pool_size']
+    P = L//pool_size
+    if P*C != params['dense'][0]['kernel'].shape[0]:
+        raise ValueError('parameters expect %d pooled features, inputs of length %d give %d'%(
+                         params['dense'][0]['kernel'].shape[0], L, P*C))
+    nn = nn[:, :P*pool_size].reshape(N, P, pool_size, C).mean(axis=2)
+
+    # fully-connected NN
+    nn = nn.reshape(N, -1)
+    for d in params['dense'][:-1]:
+        nn = np.maximum(np.dot(nn, d['kernel']) + d['bias'], 0)
+    outputs = np.dot(nn, params['dense'][-1]['kernel']) + params['dense'][-1]['bias']
+
+    if params['classification']:
+        outputs = 1/(1 + np.exp(-outputs))
+    return outputs
+
+
+class NumpyResidualBind():
+    """Inference-only ResidualBind that runs on NumPy/BLAS"""
+    def __init__(self, weights_path=None, dilations=[2, 4, 8], pool_size=10, params=None):
+        if params is None:
+            params = load_folded_weights(weights_path, dilations, pool_size)
+        self.weights_path = weights_path
+        self.params = params
+
+
+    def predict(self, X, batch_size=1000):
+        X = np.asarray(X, dtype=np.float32)
+        predictions = [forward(self.params, X[start:start+batch_size]) for start in range(0, len(X), batch_size)]
+        if not predictions:
+            return np.zeros((0, self.params['dense'][-1]['bias'].shape[0]), dtype=np.float32)
+        return np.concatenate(predictions, axis=0)
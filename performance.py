@@ -0,0 +1,210 @@
+"""CPU performance settings for ResidualBind and an auto-tuner for them.
+
+A PerformanceConfig sets TensorFlow's thread pools, XLA compilation, the
+oneDNN switch and a mixed bfloat16 policy, plus the batch sizes used by fit
+and predict when none is given. It is passed to ResidualBind and applied
+before the model is built. Thread pools (and oneDNN) can only be set before
+TensorFlow initializes, so autotune measures each thread setting in a fresh
+subprocess.
+
+Usage:
+    from performance import PerformanceConfig, autotune
+
+    performance = autotune(input_shape, mode='predict', cache_path='performance.json')
+    model = ResidualBind(input_shape, num_class, weights_path, performance=performance)
+"""
+
+import os, sys, json, time, socket, logging, subprocess
+import numpy as np
+from monitor import log_event
+
+
+def num_cpus():
+    """cores available to this process"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def bfloat16_supported():
+    """whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except IOError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+class PerformanceConfig():
+    """Thread pools, XLA, oneDNN, mixed precision and batch sizes
+
+    Settings left at None keep the TensorFlow defaults. mixed_precision is
+    True, False or 'auto' (bfloat16 only if the CPU supports it natively).
+    """
+    def __init__(self, intra_op_threads=None, inter_op_threads=None, jit_compile=False,
+                 mixed_precision=False, onednn=None, batch_size=100, predict_batch_size=100):
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.jit_compile = jit_compile
+        self.mixed_precision = mixed_precision
+        self.onednn = onednn
+        self.batch_size = batch_size
+        self.predict_batch_size = predict_batch_size
+        self.tuning = None
+
+
+    @property
+    def use_bfloat16(self):
+        if self.mixed_precision == 'auto':
+            return bfloat16_supported()
+        return bool(self.mixed_precision)
+
+
+    def apply(self):
+        """apply the settings to TensorFlow (thread pools only before it initializes)"""
+        if self.onednn is not None:
+            if 'tensorflow' in sys.modules:
+                log_event('performance_warning', 'oneDNN must be set before tensorflow is imported',
+                          level=logging.WARNING, setting='onednn')
+            os.environ['TF_ENABLE_ONEDNN_OPTS'] = '1' if self.onednn else '0'
+
+        import tensorflow as tf
+        for setting, setter in [(self.intra_op_threads, tf.config.threading.set_intra_op_parallelism_threads),
+                                (self.inter_op_threads, tf.config.threading.set_inter_op_parallelism_threads)]:
+            if setting is not None:
+                try:
+                    setter(setting)
+                except RuntimeError:
+                    log_event('performance_warning', 'thread pools are fixed once tensorflow has initialized',
+                              level=logging.WARNING, setting='threads')
+
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16' if self.use_bfloat16 else 'float32')
+        return self
+
+
+    def to_dict(self):
+        config = {key: getattr(self, key) for key in ['intra_op_threads', 'inter_op_threads', 'jit_compile',
+                  'mixed_precision', 'onednn', 'batch_size', 'predict_batch_size']}
+        config['use_bfloat16'] = self.use_bfloat16
+        return config
+
+
+    @classmethod
+    def from_dict(cls, config):
+        performance = cls(**{key: value for key, value in config.items() if key not in ['use_bfloat16', 'tuning']})
+        performance.tuning = config.get('tuning')
+        return performance
+
+
+    def save(self, file_path):
+        config = self.to_dict()
+        config['tuning'] = self.tuning
+        with open(file_path, 'w') as f:
+            json.dump(config, f, indent=2)
+        return file_path
+
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path) as f:
+            return cls.from_dict(json.load(f))
+
+
+
+#-------------------------------------------------------------------------------------
+# Auto-tuning
+#-------------------------------------------------------------------------------------
+
+
+def measure_throughput(performance, input_shape, batch_sizes, mode='predict', num_samples=2000, repeats=2):
+    """samples per second of ResidualBind training or prediction for each batch size"""
+    from residualbind import ResidualBind
+    model = ResidualBind(input_shape, 1, os.devnull, performance=performance)
+    model._compile_model(0.001)
+
+    rng = np.random.RandomState(0)
+    x = rng.uniform(size=(num_samples,) + tuple(input_shape)).astype(np.float32)
+    y = rng.normal(size=(num_samples, 1)).astype(np.float32)
+
+    throughput = {}
+    for batch_size in batch_sizes:
+        if mode == 'train':
+            run = lambda: model.model.fit(x, y, epochs=1, batch_size=batch_size, shuffle=True, verbose=0)
+        else:
+            run = lambda: model.model.predict(x, batch_size=batch_size, verbose=0)
+        run()
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        throughput[batch_size] = num_samples/min(times)
+    return throughput
+
+
+def thread_options(cpus=None):
+    """(intra, inter) thread settings to try"""
+    cpus = cpus or num_cpus()
+    intra = sorted(set([cpus, max(1, cpus//2), max(1, cpus//4)]), reverse=True)
+    inter = sorted(set([1, min(2, cpus)]))
+    return [(i, j) for i in intra for j in inter]
+
+
+def autotune(input_shape, mode='predict', batch_sizes=None, threads=None, jit_compile=False,
+             mixed_precision=False, num_samples=2000, cache_path=None):
+    """find the thread pools and batch size with the highest samples/second on this machine
+
+    mode is 'train' (tunes batch_size) or 'predict' (tunes predict_batch_size).
+    Note that the training batch size also changes the optimization, so the
+    learning rate may need to be adjusted with it. Each thread setting is
+    measured in a subprocess. With cache_path, a result for the same machine,
+    input shape and settings is reused.
+    """
+    if batch_sizes is None:
+        batch_sizes = [100, 200, 500] if mode == 'train' else [100, 500, 1000, 2000]
+    threads = threads or thread_options()
+    key = {'host': socket.gethostname(), 'cpus': num_cpus(), 'input_shape': list(input_shape), 'mode': mode,
+           'batch_sizes': list(batch_sizes), 'threads': [list(t) for t in threads],
+           'jit_compile': jit_compile, 'mixed_precision': mixed_precision}
+
+    if cache_path and os.path.exists(cache_path):
+        performance = PerformanceConfig.load(cache_path)
+        if performance.tuning and performance.tuning.get('key') == key:
+            return performance
+
+    measurements = []
+    for intra, inter in threads:
+        performance = PerformanceConfig(intra, inter, jit_compile, mixed_precision)
+        request = json.dumps({'performance': performance.to_dict(), 'input_shape': list(input_shape),
+                              'batch_sizes': list(batch_sizes), 'mode': mode, 'num_samples': num_samples})
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), request], check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        throughput = json.loads(output.decode().strip().splitlines()[-1])
+        for batch_size, samples_per_sec in throughput.items():
+            measurements.append({'intra_op_threads': intra, 'inter_op_threads': inter,
+                                 'batch_size': int(batch_size), 'samples_per_sec': samples_per_sec})
+            log_event('autotune', '  threads %d/%d, batch size %s: %.1f samples/sec'%(intra, inter, batch_size,
+                      samples_per_sec), mode=mode, **measurements[-1])
+
+    best = max(measurements, key=lambda m: m['samples_per_sec'])
+    performance = PerformanceConfig(best['intra_op_threads'], best['inter_op_threads'], jit_compile, mixed_precision)
+    if mode == 'train':
+        performance.batch_size = best['batch_size']
+    else:
+        performance.predict_batch_size = best['batch_size']
+    performance.tuning = {'key': key, 'best': best, 'measurements': measurements}
+
+    if cache_path:
+        performance.save(cache_path)
+    return performance
+
+
+
+if __name__ == '__main__':
+    # measurement of one thread setting for autotune (run in a fresh process)
+    request = json.loads(sys.argv[1])
+    throughput = measure_throughput(PerformanceConfig.from_dict(request['performance']), request['input_shape'],
+                                    request['batch_sizes'], request['mode'], request['num_samples'])
+    print(json.dumps(throughput))
@@ -0,0 +1,49 @@
+import os, time
+import numpy as np
+from residualbind import ResidualBind
+import helper
+from performance import autotune
+from monitor import monitor, set_verbosity, log_to_jsonl
+
+#---------------------------------------------------------------------------------------
+
+normalization = 'log_norm'   # 'log_norm' or 'clip_norm'
+ss_type = 'seq'                  # 'seq', 'pu', or 'struct'
+data_path = '../data/RNAcompete_2013/rnacompete2013.h5'
+results_path = helper.make_directory('../results', 'rnacompete_2013')
+trunk_path = os.path.join(results_path, normalization+'_'+ss_type+'_trunk.hdf5')  # used by train_rnacompete_2013.py
+mask_value = -100.               # target value of sequences not measured in an experiment
+verbose = 1                      # 0: silent, 1: progress, 2: keras progress bars
+performance_path = os.path.join(results_path, 'performance_train.json')  # tuned thread settings for this machine
+
+set_verbosity(verbose)
+log_to_jsonl(os.path.join(results_path, normalization+'_'+ss_type+'_pretrain_events.jsonl'))
+
+#---------------------------------------------------------------------------------------
+
+# pretrain a multi-output model on all RNA binding proteins at once
+start = time.time()
+experiments = helper.get_experiment_names(data_path)
+train, valid, test = helper.load_rnacompete_data(data_path, 
+                                                 ss_type=ss_type, 
+                                                 normalization=normalization, 
+                                                 rbp_index=None,
+                                                 mask_value=mask_value)
+
+# load residualbind model with one output per experiment
+input_shape = list(train['inputs'].shape)[1:]
+num_class = len(experiments)
+weights_path = os.path.join(results_path, normalization+'_'+ss_type+'_pretrain_weights.hdf5')
+performance = autotune(input_shape, mode='train', batch_sizes=[100], cache_path=performance_path)
+resnet = ResidualBind(input_shape, num_class, weights_path, performance=performance, mask_value=mask_value)
+
+# fit model
+resnet.fit(train, valid, num_epochs=300, patience=20, 
+          lr=0.001, lr_decay=0.3, decay_patience=7)
+
+# evaluate model and save the trunk for fine-tuning
+metrics = resnet.test_model(test, load_weights='best')
+print("Test: %.4f+/-%.4f"%(np.nanmean(metrics), np.nanstd(metrics)))
+resnet.save_trunk(trunk_path)
+monitor.add_time('pretrain', time.time() - start)
+print(monitor.report('Timing: pretraining'))
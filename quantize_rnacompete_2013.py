@@ -0,0 +1,79 @@
+import os, time
+import numpy as np
+from residualbind import ResidualBind
+import inference
+import helper
+from performance import autotune
+from monitor import monitor, SweepReport, set_verbosity, log_to_jsonl
+
+#---------------------------------------------------------------------------------------
+
+normalization = 'log_norm'   # 'log_norm' or 'clip_norm'
+ss_type = 'seq'                  # 'seq', 'pu', or 'struct'
+quantization = 'int8'            # 'int8' or 'float16'
+num_threads = 1                  # threads per TFLite interpreter (throughput per core)
+data_path = '../data/RNAcompete_2013/rnacompete2013.h5'
+results_path = helper.make_directory('../results', 'rnacompete_2013')
+save_path = helper.make_directory(results_path, normalization+'_'+ss_type)
+tflite_path = helper.make_directory(save_path, 'tflite_'+quantization)
+verbose = 1                      # 0: silent, 1: progress, 2: keras progress bars
+performance_path = os.path.join(results_path, 'performance_predict.json')  # tuned settings for this machine
+
+set_verbosity(verbose)
+log_to_jsonl(os.path.join(tflite_path, 'events.jsonl'))
+
+#---------------------------------------------------------------------------------------
+
+# loop over different RNA binding proteins
+reports = []
+sweep = SweepReport()
+experiments = helper.get_experiment_names(data_path)
+for rbp_index, experiment in enumerate(experiments):
+    print('Analyzing: '+ experiment)
+    monitor.reset()
+    start = time.time()
+
+    # load rbp dataset
+    train, valid, test = helper.load_rnacompete_data(data_path, 
+                                                     ss_type=ss_type, 
+                                                     normalization=normalization, 
+                                                     rbp_index=rbp_index)
+
+    # load residualbind model
+    input_shape = list(train['inputs'].shape)[1:]
+    num_class = 1
+    weights_path = os.path.join(save_path, experiment + '_weights.hdf5')    
+    performance = autotune(input_shape, mode='predict', cache_path=performance_path)
+    model = ResidualBind(input_shape, num_class, weights_path, performance=performance)
+    model.load_weights()
+
+    # quantize with test inputs as calibration data
+    file_path = os.path.join(tflite_path, experiment + '.tflite')
+    with monitor.timer('export_tflite'):
+        inference.export_tflite(model.model, input_shape, file_path, quantization, calibration_data=test['inputs'])
+
+    # compare with float32 model
+    report = inference.quantization_report(model.model, input_shape, file_path, test,
+                                           batch_size=performance.predict_batch_size, num_threads=num_threads)
+    print("  Pearson r: %.4f (float32) %.4f (%s)"%(report['float32_pearsonr'], report['quantized_pearsonr'], quantization))
+    reports.append(report)
+
+    monitor.add_time('experiment', time.time() - start)
+    print(monitor.report('  Timing: ' + experiment))
+    sweep.add(experiment, monitor.snapshot())
+
+print('MEAN DELTA PEARSON R: %.4f+/-%.4f'%(np.mean([r['delta_pearsonr'] for r in reports]), 
+                                           np.std([r['delta_pearsonr'] for r in reports])))
+
+# save results to table
+keys = ['float32_pearsonr', 'quantized_pearsonr', 'delta_pearsonr', 'float32_seqs_per_sec', 
+        'quantized_seqs_per_sec', 'float32_bytes', 'quantized_bytes']
+file_path = os.path.join(results_path, normalization+'_'+ss_type+'_'+quantization+'_quantization.tsv')
+with open(file_path, 'w') as f:
+    f.write('Experiment\t' + '\t'.join(keys) + '\n')
+    for experiment, report in zip(experiments, reports):
+        f.write(experiment + '\t' + '\t'.join(['%.4f'%(report[key]) for key in keys]) + '\n')
+
+# save per-experiment and aggregated timings
+print(sweep.report())
+sweep.write(os.path.join(results_path, normalization+'_'+ss_type+'_'+quantization+'_timing.json'))
@@ -1,28 +1,75 @@
 import os
-from tensorflow import keras
-from tensorflow.keras import backend as K
-from scipy import stats
 import numpy as np
 import itertools
+from dinuc_shuffle import dinuc_shuffle
+import time
+from monitor import monitor, log_event, keras_verbose
+
+# tensorflow and scipy are imported in the code paths that need them, so that
+# GIA utilities and null sequence models load without the deep learning stack
 
 class ResidualBind():
 
-    def __init__(self, input_shape=(41,4), num_class=1, weights_path='.', classification=False):
+    def __init__(self, input_shape=(41,4), num_class=1, weights_path='.', classification=False, performance=None,
+                 strategy=None, num_filters=96, kernel_size=11, dilations=[2, 4, 8], pool_size=10, dense_units=256,
+                 mask_value=None):
 
         self.input_shape = input_shape
         self.num_class = num_class
         self.weights_path = weights_path
         self.classification = classification
-        self.model = self.build(input_shape)
+        self.num_filters = num_filters
+        self.kernel_size = kernel_size
+        self.dilations = list(dilations)
+        self.pool_size = pool_size
+        self.dense_units = dense_units
+        # targets equal to mask_value (unmeasured experiments) are left out of the loss and metrics
+        self.mask_value = mask_value
+        self.performance = performance
+        if performance is not None:
+            performance.apply()
+
+        # data-parallel training (see distributed.py); only the chief writes checkpoints
+        self.strategy = strategy
+        self.chief = strategy is None or strategy.cluster_resolver.task_id == 0
+        with self._scope():
+            self.model = self.build(input_shape)
+        self.frozen = None
+        self.mc_dropout = None
+        self.best_weights = None
+        self.checkpointer = None
 
 
     def build(self, input_shape):
-        K.clear_session()
+        from tensorflow import keras
+        from tensorflow.keras import backend as K
+        if self.strategy is None:
+            # clearing the session would also drop the strategy scope
+            K.clear_session()
+
+        # input layer
+        inputs = keras.layers.Input(shape=input_shape)
+
+        mask = None
+        if input_shape[0] is None:
+            # variable length: batchnorm moments leave out all-zero (padded) positions, which are
+            # zeroed after every batchnorm, so that the 'same' convolutions see the same zeros as
+            # at the end of an unpadded sequence
+            import tensorflow as tf
+            mask = keras.layers.Lambda(lambda x: tf.reduce_any(tf.not_equal(x, 0), axis=-1))(inputs)
+
+        def masked_batchnorm(nn):
+            # with a mask, batch moments and outputs leave out the padded positions
+            if mask is None:
+                return keras.layers.BatchNormalization()(nn)
+            import bucketing
+            nn = bucketing.masked_batch_normalization()(nn, mask=mask)
+            return keras.layers.Lambda(lambda t: t[0]*tf.cast(t[1], t[0].dtype)[:, :, tf.newaxis])([nn, mask])
 
         def residual_block(input_layer, filter_size, activation='relu', dilated=False):
 
             if dilated:
-                factor = [2, 4, 8]
+                factor = self.dilations
             else:
                 factor = [1]
             num_filters = input_layer.shape.as_list()[-1]  
@@ -34,7 +81,7 @@ class ResidualBind():
                                            padding='same',
                                            dilation_rate=1,
                                            )(input_layer) 
-            nn = keras.layers.BatchNormalization()(nn)
+            nn = masked_batchnorm(nn)
             for f in factor:
                 nn = keras.layers.Activation('relu')(nn)
                 nn = keras.layers.Dropout(0.1)(nn)
@@ -46,31 +93,34 @@ class ResidualBind():
                                                padding='same',
                                                dilation_rate=f,
                                                )(nn) 
-                nn = keras.layers.BatchNormalization()(nn)
+                nn = masked_batchnorm(nn)
             nn = keras.layers.add([input_layer, nn])
             return keras.layers.Activation(activation)(nn)
 
-        # input layer
-        inputs = keras.layers.Input(shape=input_shape)
-
         # layer 1
-        nn = keras.layers.Conv1D(filters=96,
-                                 kernel_size=11,
+        nn = keras.layers.Conv1D(filters=self.num_filters,
+                                 kernel_size=self.kernel_size,
                                  strides=1,
                                  activation=None,
                                  use_bias=False,
                                  padding='same',
                                  )(inputs)                               
-        nn = keras.layers.BatchNormalization()(nn)
+        nn = masked_batchnorm(nn)
         nn = keras.layers.Activation('relu')(nn)
         nn = keras.layers.Dropout(0.1)(nn)
         
         # dilated residual block
         nn = residual_block(nn, filter_size=3, dilated=True)
 
-        # average pooling
-        nn = keras.layers.AveragePooling1D(pool_size=10)(nn)
-        nn = keras.layers.Dropout(0.2)(nn)
+        if mask is not None:
+            # variable length: average over the unpadded positions (see bucketing.py)
+            nn = keras.layers.GlobalAveragePooling1D()(nn, mask=mask)
+            nn = keras.layers.Dropout(0.2)(nn)
+        else:
+            # average pooling
+            nn = keras.layers.AveragePooling1D(pool_size=self.pool_size)(nn)
+            nn = keras.layers.Dropout(0.2)(nn)
+            nn = keras.layers.Flatten()(nn)
 
         """
         # layer 2
@@ -92,45 +142,146 @@ class ResidualBind():
         nn = keras.layers.Dropout(0.3)(nn)
         """
         # Fully-connected NN
-        nn = keras.layers.Flatten()(nn)
-        nn = keras.layers.Dense(256, activation=None, use_bias=False)(nn)
+        nn = keras.layers.Dense(self.dense_units, activation=None, use_bias=False)(nn)
         nn = keras.layers.BatchNormalization()(nn)
         nn = keras.layers.Activation('relu')(nn)
         nn = keras.layers.Dropout(0.5)(nn)
 
-        # output layer
-        outputs = keras.layers.Dense(self.num_class, activation='linear', use_bias=True)(nn)
+        # output layer (kept in float32 under a mixed precision policy)
+        outputs = keras.layers.Dense(self.num_class, activation='linear', use_bias=True, dtype='float32')(nn)
         
         if self.classification:
-            outputs = keras.layers.Activation('sigmoid')(outputs)
+            outputs = keras.layers.Activation('sigmoid', dtype='float32')(outputs)
 
         return keras.Model(inputs=inputs, outputs=outputs)
 
     def load_weights(self):
+        self.wait_for_checkpoints()
         self.model.load_weights(self.weights_path)
-        print('  Loading model from: ' + self.weights_path)
+        log_event('load_weights', '  Loading model from: ' + self.weights_path, weights_path=self.weights_path)
+        self.mc_dropout = None
+        if self.frozen is not None:
+            self.freeze()
+
+    def freeze(self):
+        """route predict through a frozen graph (BatchNorm folded, dropout removed)"""
+        import inference
+        self.frozen = inference.freeze(self.model, self.input_shape)
+        return self.frozen
+
+    def export_inference(self, export_path):
+        """export a frozen SavedModel that loads with inference.load_inference"""
+        import inference
+        return inference.export_inference(self.model, self.input_shape, export_path)
+
+    def restore_best_weights(self):
+        """set the model to the best weights of the last fit without reading them from disk"""
+        from checkpoint import restore_weights
+        if self.best_weights is None:
+            raise ValueError('no best weights in memory; fit the model or use load_weights')
+        restore_weights(self.model, self.best_weights)
+        self.mc_dropout = None
+        if self.frozen is not None:
+            self.freeze()
 
     def save_weights(self):
+        self.wait_for_checkpoints()
         self.model.save_weights(self.weights_path)
-        print('  Saving model to: ' + self.weights_path)
+        log_event('save_weights', '  Saving model to: ' + self.weights_path, weights_path=self.weights_path)
+
+    def trunk_layers(self):
+        """convolutional and residual layers before the dense head"""
+        from tensorflow import keras
+        for index, layer in enumerate(self.model.layers):
+            if isinstance(layer, (keras.layers.Flatten, keras.layers.GlobalAveragePooling1D)):
+                return self.model.layers[:index]
+        return self.model.layers
+
+    def save_trunk(self, file_path):
+        """save the weights of the trunk in the keras hdf5 weights format"""
+        from checkpoint import layer_metadata, snapshot_weights, write_weights_hdf5
+        num_layers = len(self.trunk_layers())
+        metadata = layer_metadata(self.model)
+        metadata['layer_names'] = metadata['layer_names'][:num_layers]
+        metadata['weight_names'] = metadata['weight_names'][:num_layers]
+        write_weights_hdf5(file_path, metadata, snapshot_weights(self.model)[:num_layers])
+        log_event('save_trunk', '  Saving trunk to: ' + file_path, weights_path=file_path)
+        return file_path
+
+    def load_trunk(self, file_path, trainable=False):
+        """initialize the trunk from save_trunk (e.g. pretrained on all experiments); with
+           trainable=False it is frozen and fit trains only the dense head"""
+        from checkpoint import read_weights_hdf5
+        layers = self.trunk_layers()
+        layer_names, snapshot = read_weights_hdf5(file_path)
+        if len(snapshot) != len(layers):
+            raise ValueError('trunk in %s has %d layers, model has %d'%(file_path, len(snapshot), len(layers)))
+        for layer, weights in zip(layers, snapshot):
+            if [w.shape for w in weights] != [tuple(w.shape) for w in layer.weights]:
+                raise ValueError('trunk in %s does not match the architecture of the model'%(file_path))
+            if weights:
+                layer.set_weights(weights)
+            layer.trainable = trainable
+        self.frozen = None
+        self.mc_dropout = None
+        log_event('load_trunk', '  Loading trunk from: ' + file_path, weights_path=file_path, trainable=trainable)
+
+    def _scope(self):
+        """distribution strategy scope for creating variables"""
+        import contextlib
+        return self.strategy.scope() if self.strategy is not None else contextlib.nullcontext()
+
+    def save_checkpoint(self, snapshot=None):
+        """write a weight snapshot (default: the current weights) to weights_path in the background"""
+        from checkpoint import AsyncCheckpointer, snapshot_weights
+        if not self.chief:
+            return
+        if self.checkpointer is None:
+            self.checkpointer = AsyncCheckpointer(self.model)
+        if snapshot is None:
+            snapshot = snapshot_weights(self.model)
+        self.checkpointer.save(self.weights_path, snapshot)
+        log_event('save_weights', '  Saving model to: ' + self.weights_path, weights_path=self.weights_path)
+
+    def wait_for_checkpoints(self):
+        """block until background checkpoint writes are done"""
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
 
     def _compile_model(self, lr):
-        optimizer = keras.optimizers.Adam(learning_rate=lr)
+        from tensorflow import keras
+        with self._scope():
+            optimizer = keras.optimizers.Adam(learning_rate=lr)
+        options = {'jit_compile': True} if self.performance is not None and self.performance.jit_compile else {}
             
         # set up optimizer and metrics
-        if not self.classification:
-            self.model.compile(optimizer=optimizer, loss=keras.losses.MeanSquaredError())
-        else:           
-            auroc = keras.metrics.AUC(curve='ROC', name='auroc')
-            aupr = keras.metrics.AUC(curve='PR', name='aupr')
-            self.model.compile(optimizer=optimizer,
-                          loss=keras.losses.BinaryCrossentropy(),
-                          metrics=[auroc, aupr])
+        with self._scope():
+            if not self.classification:
+                if self.mask_value is None:
+                    loss = keras.losses.MeanSquaredError()
+                else:
+                    loss = masked_mean_squared_error(self.mask_value)
+                self.model.compile(optimizer=optimizer, loss=loss, **options)
+            else:           
+                auroc = keras.metrics.AUC(curve='ROC', name='auroc')
+                aupr = keras.metrics.AUC(curve='PR', name='aupr')
+                self.model.compile(optimizer=optimizer,
+                              loss=keras.losses.BinaryCrossentropy(),
+                              metrics=[auroc, aupr], **options)
         
 
-    def fit(self, train, valid, num_epochs=300, batch_size=100, 
-            patience=25, lr=0.001, lr_decay=0.3, decay_patience=7):
-
+    @monitor.timed('ResidualBind.fit')
+    def fit(self, train, valid, num_epochs=300, batch_size=None, 
+            patience=25, lr=0.001, lr_decay=0.3, decay_patience=7, checkpoint_every=None):
+        """train the model; the best weights are kept in memory (best_weights) and written
+           to weights_path in the background at the end (and every checkpoint_every epochs)"""
+        batch_size = batch_size or self._batch_size('batch_size')
+
+        # a frozen graph would go stale during training
+        self.frozen = None
+        self.mc_dropout = None
+        self.best_weights = None
+        self.history = {'loss': [], 'val_pearsonr': [], 'lr': [], 'best_val_pearsonr': None, 'early_stopped': False}
         self._compile_model(lr)
 
         if self.classification:
@@ -138,36 +289,49 @@ class ResidualBind():
             patience, lr, lr_decay, decay_patience)
         else:
             self._fit_regression(train, valid, num_epochs, batch_size, 
-            patience, lr, lr_decay, decay_patience)
+            patience, lr, lr_decay, decay_patience, checkpoint_every)
 
 
     def _fit_regression(self, train, valid, num_epochs=300, batch_size=100, 
-            patience=25, lr=0.001, lr_decay=0.3, decay_patience=7):
+            patience=25, lr=0.001, lr_decay=0.3, decay_patience=7, checkpoint_every=None):
+        from tensorflow.keras import backend as K
+        from checkpoint import snapshot_weights
 
         # fit model with decaying learning rate and store model with highest Pearson r
-        best_pearsonr = 0
+        # (the best epoch is kept even if its Pearson r is negative)
+        best_pearsonr = -np.inf
         counter = 0
         decay_counter = 0
         for epoch in range(num_epochs):
-            print('Epoch %d out of %d'%(epoch, num_epochs))
+            log_event('epoch_start', 'Epoch %d out of %d'%(epoch, num_epochs), epoch=epoch, num_epochs=num_epochs)
 
             # training epoch
-            history = self.model.fit(train['inputs'], train['targets'], 
-                                             epochs=1,
-                                             batch_size=batch_size, 
-                                             shuffle=True)
+            start = time.time()
+            with monitor.timer('ResidualBind.train_epoch', len(train['inputs'])):
+                history = self.model.fit(**self._training_data(train, batch_size),
+                                                 epochs=1,
+                                                 verbose=keras_verbose())
+            epoch_time = time.time() - start
 
             # get metrics on validation set
-            predictions = self.model.predict(valid['inputs'], batch_size=batch_size)
-            corr = pearsonr_scores(valid['targets'], predictions)
-            print('  Validation: ' + str(np.mean(corr)))
+            start = time.time()
+            with monitor.timer('ResidualBind.validate', len(valid['inputs'])):
+                corr = self._validation_pearsonr(valid, batch_size)
+            predict_time = time.time() - start
+            self.history['loss'].append(history.history['loss'][-1])
+            self.history['val_pearsonr'].append(corr)
+            self.history['lr'].append(float(lr))
+            log_event('epoch', '  Validation: ' + str(corr), epoch=epoch, loss=history.history['loss'][-1],
+                      val_pearsonr=corr, lr=float(lr), epoch_seconds=epoch_time,
+                      predict_seqs_per_sec=len(valid['inputs'])/max(predict_time, 1e-9))
 
             # check for early stopping and decay learning rate conditions
             if best_pearsonr < corr:
                 best_pearsonr = corr
                 decay_counter = 0
                 counter = 0
-                self.save_weights()
+                self.best_weights = snapshot_weights(self.model)
+                self.history['best_val_pearsonr'] = corr
             else:
                 counter += 1
                 decay_counter += 1
@@ -176,19 +340,73 @@ class ResidualBind():
                     lr = np.maximum(lr, 1e-6)
                     K.set_value(self.model.optimizer.lr, lr)
                     decay_counter = 0
-                    print('  Decaying learning rate to: %f'%(lr))
+                    log_event('lr_decay', '  Decaying learning rate to: %f'%(lr), epoch=epoch, lr=float(lr))
 
                 if counter == patience:
-                    print('  Patience ran out... Early Stopping!')
+                    log_event('early_stop', '  Patience ran out... Early Stopping!', epoch=epoch,
+                              best_val_pearsonr=best_pearsonr)
+                    self.history['early_stopped'] = True
                     break
 
+            # periodic checkpoint of the best model so far
+            if checkpoint_every and (epoch+1) % checkpoint_every == 0 and self.best_weights is not None:
+                self.save_checkpoint(self.best_weights)
+
+        # write the best model
+        if self.best_weights is not None:
+            self.save_checkpoint(self.best_weights)
+
+
+    def _validation_pearsonr(self, valid, batch_size):
+        """mean Pearson r of the validation set, streamed over prediction batches (the
+           predictions are not kept)"""
+        X, targets = valid['inputs'], np.asarray(valid['targets'])
+
+        def batches():
+            if isinstance(X, list):
+                import bucketing
+                for index, length in bucketing.bucket_batches([len(x) for x in X], batch_size):
+                    yield index, bucketing.pad_batch(X, index, length)
+            else:
+                for start in range(0, len(X), batch_size):
+                    yield slice(start, start+batch_size), X[start:start+batch_size]
+
+        accumulator = CorrelationAccumulator(self.mask_value)
+        for index, x in batches():
+            accumulator.update(targets[index], np.asarray(self.model.predict_on_batch(x), dtype=np.float64))
+        return np.nanmean(accumulator.result())
+
+
+    def _training_data(self, train, batch_size):
+        """keras fit arguments for one shuffled pass over the training set; under a
+           distribution strategy every replica takes batches of batch_size from its own shard"""
+        if isinstance(train['inputs'], list):
+            # variable-length sequences in length buckets
+            import bucketing
+            if self.strategy is not None:
+                raise ValueError('variable-length training does not support a distribution strategy')
+            return {'x': bucketing.bucketed_dataset(train['inputs'], train['targets'], batch_size)}
+        if self.strategy is None:
+            return {'x': train['inputs'], 'y': train['targets'], 'batch_size': batch_size, 'shuffle': True}
+        import tensorflow as tf
+        x, y = train['inputs'], train['targets']
+
+        def dataset_fn(input_context):
+            dataset = tf.data.Dataset.from_tensor_slices((x, y)).shuffle(len(x)).repeat()
+            return dataset.batch(batch_size, drop_remainder=True)
+
+        # equal-sized shards give every worker the same number of steps
+        return {'x': tf.keras.utils.experimental.DatasetCreator(dataset_fn),
+                'steps_per_epoch': len(x)//batch_size}
 
     def _fit_classification(self, train, valid, num_epochs=300, batch_size=100, 
             patience=25, lr=0.001, lr_decay=0.3, decay_patience=7):
+        from tensorflow import keras
+        from checkpoint import snapshot_weights
 
         es_callback = keras.callbacks.EarlyStopping(monitor='val_auroc', #'val_aupr',#
                                                     patience=patience, 
-                                                    verbose=1, 
+                                                    verbose=keras_verbose(), 
                                                     mode='max', 
                                                     restore_best_weights=True)
         reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor='val_auroc', 
@@ -196,7 +414,18 @@ class ResidualBind():
                                                       patience=decay_patience, 
                                                       min_lr=1e-7,
                                                       mode='max',
-                                                      verbose=1) 
+                                                      verbose=keras_verbose()) 
+
+        # per-epoch metrics as events
+        epoch_start = {}
+        def log_epoch(epoch, logs):
+            fields = {'lr': float(keras.backend.get_value(self.model.optimizer.lr))}
+            fields.update({key: float(value) for key, value in logs.items()})
+            log_event('epoch', 'Epoch %d: '%(epoch) + str(fields), epoch=epoch,
+                      epoch_seconds=time.time() - epoch_start['time'], **fields)
+        log_callback = keras.callbacks.LambdaCallback(
+            on_epoch_begin=lambda epoch, logs: epoch_start.update(time=time.time()),
+            on_epoch_end=log_epoch)
 
         # fit model
         history = self.model.fit(train['inputs'], train['targets'], 
@@ -204,35 +433,76 @@ class ResidualBind():
                                 batch_size=batch_size, 
                                 shuffle=True,
                                 validation_data=(valid['inputs'], valid['targets']), 
-                                callbacks=[es_callback, reduce_lr])
+                                callbacks=[es_callback, reduce_lr, log_callback],
+                                verbose=keras_verbose())
+
+        self.history['loss'] = history.history['loss']
 
-        # save weights
-        self.save_weights()
+        # save weights (early stopping restored the best weights)
+        self.best_weights = snapshot_weights(self.model)
+        self.save_checkpoint(self.best_weights)
 
 
-    def test_model(self, test, batch_size=100, load_weights=None):
+    def _batch_size(self, name):
+        """batch size from the performance config (default 100)"""
+        if self.performance is None:
+            return 100
+        return getattr(self.performance, name)
+
+    def test_model(self, test, batch_size=None, load_weights=None):
 
         if self.classification:
             metrics = self.model.test_model(test['inputs'], test['targets'])
         else:
             predictions = self.predict(test['inputs'], batch_size, load_weights)
-            metrics = pearsonr_scores(test['targets'], predictions)
+            metrics = pearsonr_scores(test['targets'], predictions, self.mask_value)
         return metrics
 
-    def predict(self, X, batch_size=100, load_weights=False):
-        if load_weights:
+    def predict(self, X, batch_size=None, load_weights=False):
+        """load_weights: True reads weights_path, 'best' uses the in-memory best weights of
+           the last fit (falling back to weights_path)"""
+        batch_size = batch_size or self._batch_size('predict_batch_size')
+        if load_weights == 'best' and self.best_weights is not None:
+            self.restore_best_weights()
+        elif load_weights:
+            self.load_weights()
+
+        with monitor.timer('ResidualBind.predict', len(X)):
+            if self.frozen is not None:
+                return self.frozen.predict(X, batch_size=batch_size)
+            return self._predict_keras(X, batch_size)
+
+    def _predict_keras(self, X, batch_size):
+        """keras predict; a list of variable-length sequences is predicted in length buckets"""
+        if isinstance(X, list):
+            import bucketing
+            return bucketing.predict_bucketed(self.model, X, batch_size)
+        return self.model.predict(X, batch_size=batch_size, verbose=keras_verbose())
+
+    def predict_uncertainty(self, X, num_samples=20, batch_size=None, load_weights=False):
+        """Monte-Carlo dropout: predictive mean and variance over num_samples dropout samples,
+           and the samples, shape (num_samples, N, num_class); every batch of batch_size
+           sequences is scored num_samples times in one call (see inference.MCDropoutGraph)"""
+        import inference
+        batch_size = batch_size or self._batch_size('predict_batch_size')
+        if load_weights == 'best' and self.best_weights is not None:
+            self.restore_best_weights()
+        elif load_weights:
             self.load_weights()
 
-        return self.model.predict(X, batch_size=batch_size)
+        if self.mc_dropout is None or self.mc_dropout.graph.num_samples != num_samples:
+            self.mc_dropout = inference.mc_dropout(self.model, self.input_shape, num_samples)
+        with monitor.timer('ResidualBind.predict_uncertainty', len(X)*num_samples):
+            return self.mc_dropout.predict_uncertainty(X, batch_size=batch_size)
 
-    def predict_windows(self, X, stride=1, batch_size=100, load_weights=False):
+    def predict_windows(self, X, stride=1, batch_size=None, load_weights=False):
         if load_weights:
             self.load_weights()
 
         L = self.input_shape[0]
         predictions = []
         for i in range(1, X.shape[1]-L, stride):
-            predictions.append(self.predict(X[:,i:i+L,:], batch_size, weights=False))
+            predictions.append(self.predict(X[:,i:i+L,:], batch_size, load_weights=False))
         return np.hstack(predictions)
 
 
@@ -244,13 +514,16 @@ class ResidualBind():
 
 class GlobalImportance():
     """Class that performs GIA experiments."""
-    def __init__(self, model, alphabet='ACGU'):
+    def __init__(self, model, alphabet='ACGU', null_batch_size=10000):
         self.model = model
         self.alphabet = alphabet
+        self.null_batch_size = null_batch_size
         self.x_null = None
         self.x_null_index = None
+        self.null_samples = None
 
 
+    @monitor.timed('GlobalImportance.set_null_model')
     def set_null_model(self, null_model, base_sequence, num_sample=1000, binding_scores=None):
         """use model-based approach to set the null sequences"""
         self.x_null = generate_null_sequence_set(null_model, base_sequence, num_sample, binding_scores) 
@@ -280,12 +553,23 @@ class GlobalImportance():
         self.mean_null_score = np.mean(self.null_scores)
 
 
-    def embed_patterns(self, patterns):
-        """embed patterns in null sequences"""
-        if not isinstance(patterns, list):
+    def embed_patterns(self, patterns, index=None):
+        """embed patterns in null sequences (optionally only a subset given by index)"""
+        x_index = self._embed_index(patterns, index=index)
+
+        # convert to categorical representation to one-hot 
+        return np.eye(len(self.alphabet))[x_index]
+
+
+    def _embed_index(self, patterns, hairpin=None, index=None):
+        """embed patterns in the categorical representation of the null sequences"""
+        if not isinstance(patterns, (list, tuple)) or (len(patterns) == 2 and isinstance(patterns[0], str)):
             patterns = [patterns]
 
-        x_index = np.copy(self.x_null_index)
+        x_index = np.copy(self.x_null_index if index is None else self.x_null_index[index])
+        if hairpin is not None:
+            x_index = self._apply_stem(x_index, *hairpin)
+
         for pattern, position in patterns:
 
             # convert pattern to categorical representation
@@ -294,13 +578,17 @@ class GlobalImportance():
             # embed pattern 
             x_index[:,position:position+len(pattern)] = pattern_index
 
-        # convert to categorical representation to one-hot 
-        one_hot = np.zeros((len(x_index), len(x_index[0]), len(self.alphabet)))
-        for n, x in enumerate(x_index):
-            for l, a in enumerate(x):
-                one_hot[n,l,a] = 1.0
+        # fix the stem
+        if hairpin is not None:
+            x_index = self._apply_stem(x_index, *hairpin)
+        return x_index
+
 
-        return one_hot
+    def _apply_stem(self, x_index, stem_left, stem_right, stem_size):
+        """set the right stem to the reverse-complement of the left stem"""
+        stem = x_index[:,stem_left:stem_left+stem_size]
+        x_index[:,stem_right:stem_right+stem_size] = len(self.alphabet) - 1 - stem[:,::-1]
+        return x_index
     
 
     def set_hairpin_null(self, stem_left=7, stem_right=23, stem_size=9):
@@ -341,113 +629,705 @@ class GlobalImportance():
         return self.model.predict(one_hot)[:, class_index] - self.null_scores
 
 
+    @monitor.timed('GlobalImportance.embed_predict_stats')
+    def embed_predict_stats(self, patterns, class_index=0, keep_scores=False):
+        """embed pattern in null sequences batch by batch and accumulate effect statistics"""
+        accumulator = EffectAccumulator(keep_scores=keep_scores)
+        num_null = len(self.x_null_index)
+        for start in range(0, num_null, self.null_batch_size):
+            index = np.arange(start, min(start+self.null_batch_size, num_null))
+            one_hot = self.embed_patterns(patterns, index)
+            accumulator.update(self.model.predict(one_hot)[:, class_index] - self.null_scores[index])
+        return accumulator
+
+
     def predict_effect(self, one_hot, class_index=0):
         """Measure effect size of sequences versus null sequences"""
         predictions = self.model.predict(one_hot)[:, class_index]
         return predictions - self.null_scores
 
 
-    def optimal_kmer(self, kmer_size=7, position=17, class_index=0):
-        """GIA to find optimal k-mers"""
+    @monitor.timed('GlobalImportance.predict_effect_uncertainty')
+    def predict_effect_uncertainty(self, one_hot, num_samples=20, class_index=0, interval=95):
+        """effect size with an uncertainty band from Monte-Carlo dropout (or ensemble members)
+
+        The model must have predict_uncertainty (ResidualBind or an
+        inference.EnsembleModel). Each dropout sample gives a global effect,
+        the mean over null sequences; returns the mean effect, its standard
+        deviation and interval percentiles over samples, the per-sequence
+        effects (mean over samples) and the effect of each sample.
+        """
+        samples = self.model.predict_uncertainty(one_hot, num_samples)['samples'][:, :, class_index]
+        null_samples = self._null_samples(num_samples)[:, :, class_index]
+        sample_effects = np.mean(samples - null_samples, axis=1)
+        tail = (100 - interval)/2
+        return {'mean': np.mean(sample_effects),
+                'std': np.std(sample_effects),
+                'lower': np.percentile(sample_effects, tail),
+                'upper': np.percentile(sample_effects, 100 - tail),
+                'effects': np.mean(samples - null_samples, axis=0),
+                'samples': sample_effects}
+
+
+    def embed_predict_uncertainty(self, patterns, num_samples=20, class_index=0, interval=95):
+        """embed pattern in null sequences and get the effect with an uncertainty band"""
+        return self.predict_effect_uncertainty(self.embed_patterns(patterns), num_samples, class_index, interval)
+
+
+    def _null_samples(self, num_samples):
+        """dropout samples of the null sequences (cached until the null set changes)"""
+        if self.null_samples is None or self.null_samples[0] is not self.x_null or \
+           self.null_samples[1] != num_samples:
+            self.null_samples = (self.x_null, num_samples, self.model.predict_uncertainty(self.x_null, num_samples)['samples'])
+        return self.null_samples[2]
+
+
+    @monitor.timed('GlobalImportance.run_plan')
+    def run_plan(self, plan, class_index=0, accumulate=False, keep_scores=False, compression=100, index=None):
+        """evaluate all interventions of an InterventionPlan over the null set (or the 
+           subset given by index), packing them into predict calls of null_batch_size sequences"""
+        if index is None:
+            index = np.arange(len(self.x_null_index))
+        null_scores = self.null_scores[index]
+        num_null = len(index)
+        A = len(self.alphabet)
+
+        # stem-loop baselines are scored first so effects can be formed as predictions arrive
+        order = sorted(range(len(plan.interventions)), key=lambda i: len(plan.interventions[i][0]) > 0)
+        baselines = {None: null_scores}
+        if accumulate:
+            results = [EffectAccumulator(keep_scores, compression) for _ in plan.interventions]
+        else:
+            results = [np.zeros(num_null) for _ in plan.interventions]
+
+        def record(i, start, end, effect):
+            if accumulate:
+                results[i].update(effect)
+            else:
+                results[i][start:end] = effect
+
+        def flush(segments, blocks):
+            with monitor.timer('GlobalImportance.embed'):
+                one_hot = np.eye(A)[np.concatenate(blocks)]
+            predictions = self.model.predict(one_hot)[:, class_index]
+            offset = 0
+            for i, start, end in segments:
+                scores = predictions[offset:offset+end-start]
+                offset += end - start
+                patterns, hairpin = plan.interventions[i]
+                if not patterns:
+                    # stem-loop null: keep its scores as the baseline for interventions within it
+                    baselines.setdefault(hairpin, np.zeros(num_null))[start:end] = scores
+                    record(i, start, end, scores - null_scores[start:end])
+                else:
+                    record(i, start, end, scores - baselines[hairpin][start:end])
+
+        segments, blocks, num_buffered = [], [], 0
+        for i in order:
+            patterns, hairpin = plan.interventions[i]
+            if not patterns and hairpin is None:
+                record(i, 0, num_null, np.zeros(num_null))
+                continue
+            start = 0
+            while start < num_null:
+                end = min(num_null, start + self.null_batch_size - num_buffered)
+                segments.append((i, start, end))
+                with monitor.timer('GlobalImportance.embed', end - start):
+                    blocks.append(self._embed_index(list(patterns), hairpin, index[start:end]))
+                num_buffered += end - start
+                start = end
+                if num_buffered == self.null_batch_size:
+                    flush(segments, blocks)
+                    segments, blocks, num_buffered = [], [], 0
+        if segments:
+            flush(segments, blocks)
+
+        # gather named groups
+        effects = {}
+        for name, index in plan.groups.items():
+            if accumulate:
+                effects[name] = [results[i] for i in index]
+            else:
+                effects[name] = np.array([results[i] for i in index])
+        return effects
+
+
+    def _intervention_effects(self, interventions, class_index=0, accumulate=False, keep_scores=False,
+                              compression=100, index=None):
+        """effect sizes for a list of interventions, as a score array or as accumulators"""
+        plan = InterventionPlan().add('effects', interventions)
+        return self.run_plan(plan, class_index, accumulate, keep_scores, compression, index)['effects']
+
+
+    @monitor.timed('GlobalImportance.optimal_kmer')
+    def optimal_kmer(self, kmer_size=7, position=17, class_index=0, accumulate=False,
+                     search='exhaustive', top_n=10, initial_sample=50, eta=2, confidence=0.99):
+        """GIA to find optimal k-mers
+
+        search='adaptive' races the k-mers on growing null subsamples and only
+        keeps candidates whose confidence interval overlaps the current top_n;
+        the survivors are scored on the full null set. Eliminated k-mers keep
+        their subsample estimate (see the count of the accumulators).
+        """
 
         # generate all kmers             
         kmers = ["".join(p) for p in itertools.product(list(self.alphabet), repeat=kmer_size)]
 
-        # score each kmer
-        mean_scores = []
-        for i, kmer in enumerate(kmers):
-            if np.mod(i+1,500) == 0:
-                print("%d out of %d"%(i+1, len(kmers)))
-            
-            effect = self.embed_predict_effect((kmer, position), class_index)
-            mean_scores.append(np.mean(effect))
+        # score each kmer (only the streaming mean is needed unless accumulators are requested)
+        compression = 100 if accumulate else None
+        if search == 'exhaustive':
+            all_stats = self._intervention_effects([(kmer, position) for kmer in kmers], class_index,
+                                                   accumulate=True, compression=compression)
+        elif search == 'adaptive':
+            all_stats = self._race_kmers(kmers, position, class_index, top_n, initial_sample,
+                                         eta, confidence, compression)
+        else:
+            raise ValueError("search must be 'exhaustive' or 'adaptive'")
 
         kmers = np.array(kmers)
-        mean_scores = np.array(mean_scores)
+        mean_scores = np.array([effect.mean for effect in all_stats])
 
         # sort by highest prediction
         sort_index = np.argsort(mean_scores)[::-1]
 
+        if accumulate:
+            return kmers[sort_index], [all_stats[i] for i in sort_index]
         return kmers[sort_index], mean_scores[sort_index]
 
 
+    def _race_kmers(self, kmers, position, class_index, top_n, initial_sample, eta, confidence, compression):
+        """successive halving over nested null subsamples with confidence-interval elimination"""
+        from scipy import stats
+        num_null = len(self.x_null_index)
+        order = np.random.permutation(num_null)
+        z = stats.norm.ppf(confidence)
+
+        all_stats = [EffectAccumulator(compression=compression) for _ in kmers]
+        survivors = np.arange(len(kmers))
+        num_scored = 0
+        num_sample = min(num_null, initial_sample)
+        while True:
+            # score the survivors on the next block of null sequences
+            effects = self._intervention_effects([(kmers[i], position) for i in survivors], class_index,
+                                                 accumulate=True, compression=compression,
+                                                 index=order[num_scored:num_sample])
+            for i, effect in zip(survivors, effects):
+                all_stats[i].merge(effect)
+            num_scored = num_sample
+            if num_scored == num_null or len(survivors) <= top_n:
+                break
+
+            # keep candidates whose upper bound reaches the lower bound of the current top_n
+            mean = np.array([all_stats[i].mean for i in survivors])
+            stderr = np.array([all_stats[i].std for i in survivors])/np.sqrt(num_scored)
+            threshold = np.sort(mean - z*stderr)[::-1][min(top_n, len(survivors))-1]
+            survivors = survivors[mean + z*stderr >= threshold]
+
+            # remaining candidates are scored on the full null set once they fit the budget
+            num_sample = min(num_null, num_sample*eta)
+            if len(survivors) <= top_n:
+                num_sample = num_null
+
+        return all_stats
+
+
+    @monitor.timed('GlobalImportance.screen_patterns')
+    def screen_patterns(self, patterns, position=17, class_index=0, index=None, seed=None):
+        """GIA screen of gapped and IUPAC-degenerate patterns
+
+        patterns is a list of strings (gap character '-' keeps the null
+        background, degenerate codes are sampled uniformly for each null
+        sequence) or an allowed-base mask array from compile_patterns. Returns
+        the mean and standard deviation of the effect of each pattern.
+        """
+        if not isinstance(patterns, np.ndarray):
+            patterns = compile_patterns(patterns, self.alphabet)
+        if index is None:
+            index = np.arange(len(self.x_null_index))
+        rng = np.random.RandomState(seed)
+
+        num_patterns, num_fixed, A = patterns.shape
+        num_null = len(index)
+        offsets = position + np.arange(num_fixed)
+        cum_mask = np.cumsum(patterns, axis=2)
+        counts = cum_mask[:,:,-1]
+        identity = np.eye(A, dtype=self.x_null.dtype)
+
+        # one embedding buffer shared by all patterns
+        batch_size = min(self.null_batch_size, num_patterns*num_null)
+        buffer = self._embedding_buffer(batch_size)
+
+        # per-pattern count, mean and sum of squared deviations, merged batch by batch
+        # as in EffectAccumulator (parallel Welford)
+        counts_seen = np.zeros(num_patterns)
+        mean_scores = np.zeros(num_patterns)
+        m2 = np.zeros(num_patterns)
+        for start in range(0, num_patterns*num_null, batch_size):
+            flat = np.arange(start, min(start+batch_size, num_patterns*num_null))
+            n = len(flat)
+            pattern_index = flat // num_null
+            rows = index[flat % num_null]
+
+            # sample an allowed base at each fixed position, keep the background at gaps
+            u = rng.uniform(size=(n, num_fixed))*counts[pattern_index]
+            chosen = np.sum(cum_mask[pattern_index] <= u[:,:,np.newaxis], axis=2)
+            chosen = np.where(counts[pattern_index] == 0, self.x_null_index[rows][:,offsets], chosen)
+
+            buffer[:n] = self.x_null[rows]
+            buffer[np.arange(n)[:,np.newaxis], offsets] = identity[chosen]
+
+            effect = self.model.predict(buffer[:n])[:, class_index] - self.null_scores[rows]
+            batch_counts = np.bincount(pattern_index, minlength=num_patterns)
+            batch_means = np.bincount(pattern_index, weights=effect, minlength=num_patterns)/np.maximum(batch_counts, 1)
+            batch_m2 = np.bincount(pattern_index, weights=(effect - batch_means[pattern_index])**2,
+                                   minlength=num_patterns)
+            total = counts_seen + batch_counts
+            delta = batch_means - mean_scores
+            weight = np.where(total > 0, batch_counts/np.maximum(total, 1), 0)
+            mean_scores += delta*weight
+            m2 += batch_m2 + delta**2*counts_seen*weight
+            counts_seen = total
+
+        # standard deviation over the null sequences (population, as before)
+        std_scores = np.sqrt(m2/num_null)
+        return mean_scores, std_scores
+
+
+    @monitor.timed('GlobalImportance.gapped_kmer_screen')
+    def gapped_kmer_screen(self, left_size=3, right_size=3, gaps=[1, 2, 3, 4], position=17, class_index=0):
+        """GIA to find optimal bipartite (gapped) k-mers"""
+        masks = gapped_kmer_masks(left_size, right_size, gaps, len(self.alphabet))
+        mean_scores = self.screen_patterns(masks, position, class_index)[0]
+
+        # sort by highest prediction
+        sort_index = np.argsort(mean_scores)[::-1]
+        patterns = decode_patterns(masks[sort_index], self.alphabet)
+        return patterns, mean_scores[sort_index]
+
+
+    def _embedding_buffer(self, batch_size):
+        """reusable one-hot buffer for embedding interventions"""
+        shape = (batch_size,) + self.x_null.shape[1:]
+        buffer = getattr(self, '_buffer', None)
+        if buffer is None or buffer.shape[0] < batch_size or buffer.shape[1:] != shape[1:]:
+            buffer = self._buffer = np.empty(shape, dtype=self.x_null.dtype)
+        return buffer
+
+
+    @monitor.timed('GlobalImportance.kmer_mutagenesis')
     def kmer_mutagenesis(self, kmer='UGCAUG', position=17, class_index=0):
         """GIA mutagenesis of a k-mer"""
 
-        # get wt score
-        wt_score = np.mean(self.embed_predict_effect((kmer, position), class_index))
-
-        # score each mutation
+        # all single mutants; mutants that equal the wild type are deduplicated by the plan
         L = len(kmer)
         A = len(self.alphabet)
-        mean_scores = np.zeros((L, A))
+        interventions = []
         for l in range(L):
             for a in range(A):
-                if kmer[l] == self.alphabet[a]:
-                    mean_scores[l,a] = wt_score
+                mut_kmer = list(kmer)
+                mut_kmer[l] = self.alphabet[a]
+                interventions.append(("".join(mut_kmer), position))
 
-                else:
-                    # introduce mutation
-                    mut_kmer = list(kmer)
-                    mut_kmer[l] = self.alphabet[a]
-                    mut_kmer = "".join(mut_kmer)
-                                
-                    # score mutant
-                    mean_scores[l,a]  = np.mean(self.embed_predict_effect((mut_kmer, position), class_index))
+        # score each mutation
+        all_stats = self._intervention_effects(interventions, class_index, accumulate=True, compression=None)
+        return np.array([effect.mean for effect in all_stats]).reshape(L, A)
 
-        return mean_scores
 
 
+    @monitor.timed('GlobalImportance.kmer_epistasis')
+    def kmer_epistasis(self, kmer='UGCAUG', position=17, class_index=0):
+        """GIA pairwise epistasis map of a k-mer
 
-    def positional_bias(self, motif='UGCAUG', positions=[2, 12, 23, 33], class_index=0):
+        Returns an (L, A, L, A) tensor with the interaction of every pair of
+        substitutions, E(ij) - E(i) - E(j) + E(wt), where E is the mean effect
+        over the null set; the diagonal (same position) is zero. The wild type
+        (once), all single and all double mutants are scored in one batched screen.
+        """
+        L = len(kmer)
+        A = len(self.alphabet)
+        wt = np.array([self.alphabet.index(i) for i in kmer])
+
+        # the wild type once, then the single mutants to the other A-1 bases at each position
+        pos, base = np.meshgrid(np.arange(L), np.arange(A), indexing='ij')
+        mutant = base != wt[:,np.newaxis]
+        pos, base = pos[mutant], base[mutant]
+        singles = np.tile(wt, (len(pos) + 1, 1))
+        singles[1 + np.arange(len(pos)), pos] = base
+
+        # double mutants at every pair of positions, excluding wild-type bases
+        left, right = np.triu_indices(L, 1)
+        pair = np.repeat(np.arange(len(left)), A*A)
+        base_left = np.tile(np.repeat(np.arange(A), A), len(left))
+        base_right = np.tile(np.arange(A), A*len(left))
+        keep = (base_left != wt[left[pair]]) & (base_right != wt[right[pair]])
+        pair, base_left, base_right = pair[keep], base_left[keep], base_right[keep]
+        doubles = np.tile(wt, (len(pair), 1))
+        doubles[np.arange(len(pair)), left[pair]] = base_left
+        doubles[np.arange(len(pair)), right[pair]] = base_right
+
+        # score all mutants together
+        masks = np.eye(A, dtype=bool)[np.concatenate([singles, doubles], axis=0)]
+        mean_scores = self.screen_patterns(masks, position, class_index)[0]
+        wt_score = mean_scores[0]
+        single_scores = np.full((L, A), wt_score)
+        single_scores[pos, base] = mean_scores[1:len(singles)]
+
+        # double mutant effects; a wild-type base reduces a double to a single mutant
+        double_scores = single_scores[:,:,np.newaxis,np.newaxis] + single_scores[np.newaxis,np.newaxis,:,:] - wt_score
+        double_scores[left[pair], base_left, right[pair], base_right] = mean_scores[len(singles):]
+        double_scores[right[pair], base_right, left[pair], base_left] = mean_scores[len(singles):]
+
+        epistasis = double_scores - single_scores[:,:,np.newaxis,np.newaxis] \
+                    - single_scores[np.newaxis,np.newaxis,:,:] + wt_score
+        epistasis[np.arange(L), :, np.arange(L), :] = 0
+        return epistasis
+
+
+
+    @monitor.timed('GlobalImportance.positional_bias')
+    def positional_bias(self, motif='UGCAUG', positions=[2, 12, 23, 33], class_index=0,
+                        accumulate=False, keep_scores=False):
         """GIA to find positional bias"""
+        interventions = positional_bias_interventions(motif, positions)
+        return self._intervention_effects(interventions, class_index, accumulate, keep_scores)
 
-        # loop over positions and measure effect size of intervention
-        all_scores = []
-        for position in positions:
-            all_scores.append(self.embed_predict_effect((motif, position), class_index))
 
-        return np.array(all_scores)
 
+    @monitor.timed('GlobalImportance.multiple_sites')
+    def multiple_sites(self, motif='UGCAUG', positions=[17, 10, 25, 3], class_index=0,
+                       accumulate=False, keep_scores=False):
+        """GIA to find relation with multiple binding sites"""
+        interventions = multiple_sites_interventions(motif, positions)
+        return self._intervention_effects(interventions, class_index, accumulate, keep_scores)
 
 
-    def multiple_sites(self, motif='UGCAUG', positions=[17, 10, 25, 3], class_index=0):
-        """GIA to find relation with multiple binding sites"""
+    @monitor.timed('GlobalImportance.gc_bias')
+    def gc_bias(self, motif='UGCAUG', motif_position=17,
+                gc_motif='GCGCGC', gc_positions=[34, 2], class_index=0,
+                accumulate=False, keep_scores=False):
+        """GIA to find GC-bias"""
+        interventions = gc_bias_interventions(motif, motif_position, gc_motif, gc_positions)
+        return self._intervention_effects(interventions, class_index, accumulate, keep_scores)
 
-        # loop over positions and measure effect size of intervention
-        all_scores = []
-        for i, position in enumerate(positions):
 
-            # embed motif multiple times
-            interventions = []
-            for j in range(i+1):
-                interventions.append((motif, positions[j]))
+#-------------------------------------------------------------------------------------
+# Batched intervention planning
+#-------------------------------------------------------------------------------------
 
-            all_scores.append(self.embed_predict_effect(interventions, class_index))
 
-        return np.array(all_scores)
+class InterventionPlan():
+    """Declarative set of GIA interventions.
 
+    Each intervention is a list of (pattern, position) pairs, optionally embedded
+    in a stem-loop null given by hairpin=(stem_left, stem_right, stem_size).
+    Identical interventions across named groups are scored only once, and
+    GlobalImportance.run_plan packs all of them into large predict calls.
+    """
+    def __init__(self):
+        self.interventions = []
+        self.groups = {}
+        self._lookup = {}
 
-    def gc_bias(self, motif='UGCAUG', motif_position=17,
-                gc_motif='GCGCGC', gc_positions=[34, 2], class_index=0):
-        """GIA to find GC-bias"""
 
-        all_scores = []
+    def _register(self, patterns, hairpin):
+        if isinstance(patterns, tuple) and len(patterns) == 2 and isinstance(patterns[0], str):
+            patterns = [patterns]
+        key = (tuple((str(pattern), int(position)) for pattern, position in patterns), hairpin)
+        if key not in self._lookup:
+            self._lookup[key] = len(self.interventions)
+            self.interventions.append(key)
+        return self._lookup[key]
+
 
+    def add(self, name, interventions, hairpin=None):
+        """add a named group of interventions"""
+        if not isinstance(interventions, list):
+            interventions = [interventions]
+        if hairpin is not None:
+            # the stem-loop null itself is the baseline for interventions within it
+            hairpin = tuple(int(h) for h in hairpin)
+            self._register([], hairpin)
+        self.groups[name] = [self._register(patterns, hairpin) for patterns in interventions]
+        return self
 
-        # background sequence with gc-bias on right side
-        all_scores.append(self.embed_predict_effect((gc_motif, gc_positions[0]), class_index))
 
-        # background sequence with motif at center
-        all_scores.append(self.embed_predict_effect((motif, motif_position), class_index))
+    def __len__(self):
+        """number of unique interventions"""
+        return len(self.interventions)
 
-        # create interventions for gc bias
-        for position in gc_positions:
 
-            interventions = [(motif, motif_position), (gc_motif, position)]
-            all_scores.append(self.embed_predict_effect(interventions, class_index))
+def positional_bias_interventions(motif, positions):
+    """one intervention per position"""
+    return [(motif, position) for position in positions]
 
-        return np.array(all_scores)
+
+def multiple_sites_interventions(motif, positions):
+    """embed motif at the first 1, 2, ... positions"""
+    return [[(motif, positions[j]) for j in range(i+1)] for i in range(len(positions))]
+
+
+def gc_bias_interventions(motif, motif_position, gc_motif, gc_positions):
+    """gc motif alone, motif alone, and motif with gc motif at each gc position"""
+    interventions = []
+
+    # background sequence with gc-bias on right side
+    interventions.append((gc_motif, gc_positions[0]))
+
+    # background sequence with motif at center
+    interventions.append((motif, motif_position))
+
+    # create interventions for gc bias
+    for position in gc_positions:
+        interventions.append([(motif, motif_position), (gc_motif, position)])
+    return interventions
+
+
+#-------------------------------------------------------------------------------------
+# Gapped and degenerate patterns
+#-------------------------------------------------------------------------------------
+
+
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'U': 'U', 'T': 'U',
+         'R': 'AG', 'Y': 'CU', 'S': 'CG', 'W': 'AU', 'K': 'GU', 'M': 'AC',
+         'B': 'CGU', 'D': 'AGU', 'H': 'ACU', 'V': 'ACG', 'N': 'ACGU', '-': ''}
+
+
+def _iupac_bases(code, alphabet):
+    """alphabet indices allowed by an IUPAC code"""
+    bases = IUPAC[code.upper()]
+    if 'T' in alphabet:
+        bases = bases.replace('U', 'T')
+    return [alphabet.index(b) for b in bases]
+
+
+def compile_patterns(patterns, alphabet='ACGU'):
+    """convert IUPAC/gapped patterns to an allowed-base mask of shape (N, max_length, A);
+       positions without allowed bases (gaps and padding) keep the null background"""
+    max_length = max(len(pattern) for pattern in patterns)
+    masks = np.zeros((len(patterns), max_length, len(alphabet)), dtype=bool)
+    for n, pattern in enumerate(patterns):
+        for l, code in enumerate(pattern):
+            masks[n, l, _iupac_bases(code, alphabet)] = True
+    return masks
+
+
+def decode_patterns(masks, alphabet='ACGU'):
+    """convert allowed-base masks back to IUPAC patterns"""
+    codes = {}
+    for code in IUPAC:
+        if code != 'T':
+            codes[tuple(np.isin(range(len(alphabet)), _iupac_bases(code, alphabet)))] = code
+    table = np.array([codes.get(tuple(bits), '?') for bits in itertools.product([False, True], repeat=len(alphabet))])
+
+    # binary code of each allowed-base set, with the first base as most significant bit
+    weights = 2**np.arange(len(alphabet))[::-1]
+    symbols = table[np.sum(masks*weights, axis=2)]
+    return np.array(["".join(s).rstrip('-') for s in symbols])
+
+
+def kmer_index(kmer_size, alphabet_size=4):
+    """all k-mers as a categorical index array of shape (A^k, k), in itertools.product order"""
+    return np.indices((alphabet_size,)*kmer_size).reshape(kmer_size, -1).T
+
+
+def gapped_kmer_masks(left_size=3, right_size=3, gaps=[1, 2, 3, 4], alphabet_size=4):
+    """allowed-base masks of all bipartite k-mers (left half-site, gap, right half-site)"""
+    identity = np.eye(alphabet_size, dtype=bool)
+    left = identity[kmer_index(left_size, alphabet_size)]
+    right = identity[kmer_index(right_size, alphabet_size)]
+    num_left, num_right = len(left), len(right)
+    num_fixed = left_size + max(gaps) + right_size
+
+    masks = []
+    for gap in gaps:
+        mask = np.zeros((num_left*num_right, num_fixed, alphabet_size), dtype=bool)
+        mask[:, :left_size] = np.repeat(left, num_right, axis=0)
+        mask[:, left_size+gap:left_size+gap+right_size] = np.tile(right, (num_left, 1, 1))
+        masks.append(mask)
+    return np.concatenate(masks, axis=0)
+
+
+#-------------------------------------------------------------------------------------
+# Streaming statistics for GIA effects
+#-------------------------------------------------------------------------------------
+
+
+class QuantileSketch():
+    """Merging t-digest style sketch for approximate quantiles of a stream."""
+    def __init__(self, compression=100, buffer_size=1000):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self._buffer = []
+        self._num_buffered = 0
+
+
+    def update(self, values):
+        """add a batch of values to the sketch"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self._buffer.append(values)
+        self._num_buffered += len(values)
+        if self._num_buffered >= self.buffer_size:
+            self._compress()
+
+
+    def merge(self, other):
+        """merge the centroids of another sketch into this one"""
+        other._compress()
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+        self._compress(force=True)
+
+
+    def _compress(self, force=False):
+        """merge buffered values into centroids with the arcsine scale function"""
+        if not self._num_buffered and not force:
+            return
+        means = np.concatenate([self.means] + self._buffer)
+        weights = np.concatenate([self.weights, np.ones(self._num_buffered)])
+        self._buffer = []
+        self._num_buffered = 0
+        if not len(means):
+            return
+
+        sort_index = np.argsort(means, kind='mergesort')
+        means = means[sort_index]
+        weights = weights[sort_index]
+
+        # assign each point to a bucket of unit size in k-space; buckets are small near the tails
+        total = np.sum(weights)
+        q = (np.cumsum(weights) - weights/2)/total
+        k = self.compression/np.pi*np.arcsin(2*q - 1)
+        bucket = np.floor(k - np.min(k)).astype(int)
+        bucket = np.unique(bucket, return_inverse=True)[1]
+
+        self.weights = np.bincount(bucket, weights=weights)
+        self.means = np.bincount(bucket, weights=weights*means)/self.weights
+
+
+    def quantile(self, q):
+        """approximate quantile(s) for q in [0, 1]"""
+        self._compress()
+        if not len(self.means):
+            return np.full(np.shape(q), np.nan)
+        centers = (np.cumsum(self.weights) - self.weights/2)/np.sum(self.weights)
+        return np.interp(q, centers, self.means)
+
+
+class EffectAccumulator():
+    """Streaming count, mean, variance and quantiles of GIA effect sizes.
+
+    Batches are merged with the parallel form of Welford's algorithm, so the
+    full score array is only kept when keep_scores=True. Quantiles are tracked
+    unless compression=None.
+    """
+    def __init__(self, keep_scores=False, compression=100):
+        self.count = 0
+        self.mean = 0.
+        self._m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = QuantileSketch(compression) if compression else None
+        self.keep_scores = keep_scores
+        self._scores = []
+
+
+    def update(self, values):
+        """add a batch of effect sizes"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n = len(values)
+        if not n:
+            return
+        batch_mean = np.mean(values)
+        batch_m2 = np.sum((values - batch_mean)**2)
+
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean += delta*n/total
+        self._m2 += batch_m2 + delta**2*self.count*n/total
+        self.count = total
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+        if self.sketch is not None:
+            self.sketch.update(values)
+        if self.keep_scores:
+            self._scores.append(values)
+
+
+    def merge(self, other):
+        """merge the statistics of another accumulator into this one"""
+        if not other.count:
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta**2*self.count*other.count/total
+        self.mean += delta*other.count/total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        if self.keep_scores and other.keep_scores:
+            self._scores.extend(other._scores)
+        return self
+
+
+    @property
+    def variance(self):
+        """unbiased sample variance"""
+        if self.count < 2:
+            return np.nan
+        return self._m2/(self.count - 1)
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+    @property
+    def scores(self):
+        """full effect sizes (only if keep_scores=True)"""
+        if not self.keep_scores:
+            return None
+        if not self._scores:
+            return np.zeros(0)
+        return np.concatenate(self._scores)
+
+
+    def quantile(self, q):
+        """approximate quantile(s) of the effect sizes"""
+        if self.sketch is None:
+            return np.full(np.shape(q), np.nan)
+        return self.sketch.quantile(q)
+
+
+    def ttest(self, other):
+        """Welch's t-test between two accumulated effect distributions"""
+        from scipy import stats
+        return stats.ttest_ind_from_stats(self.mean, self.std, self.count,
+                                          other.mean, other.std, other.count,
+                                          equal_var=False)
+
+
+    def boxplot_stats(self, whis=1.5):
+        """summary in the format of matplotlib's Axes.bxp"""
+        q1, median, q3 = self.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        return {'med': median, 'q1': q1, 'q3': q3, 'mean': self.mean,
+                'whislo': max(self.min, q1 - whis*iqr),
+                'whishi': min(self.max, q3 + whis*iqr),
+                'fliers': []}
+
+
+    def summary(self):
+        """dictionary of the streaming statistics"""
+        q = self.quantile([0.025, 0.25, 0.5, 0.75, 0.975])
+        return {'count': self.count, 'mean': self.mean, 'variance': self.variance,
+                'min': self.min, 'max': self.max,
+                'q2.5': q[0], 'q25': q[1], 'q50': q[2], 'q75': q[3], 'q97.5': q[4]}
 
 
 #-------------------------------------------------------------------------------------
@@ -455,6 +1335,7 @@ class GlobalImportance():
 #-------------------------------------------------------------------------------------
 
     
+@monitor.timed('generate_null_sequence_set')
 def generate_null_sequence_set (null_model, base_sequence, num_sample=1000 , binding_scores=None):
     if null_model == 'random':    return generate_shuffled_set(base_sequence, num_sample)
     if null_model == 'profile':   return generate_profile_set(base_sequence, num_sample)
@@ -542,15 +1423,103 @@ def generate_quartile_set(base_sequence, num_sample, binding_scores, quartile):
 #-------------------------------------------------------------------------------------
 
 
-def pearsonr_scores(y_true, y_pred, mask_value=None):
-    corr = []
-    for i in range(y_true.shape[1]):
-        if mask_value:
-            index = np.where(y_true[:,i] != mask_value)[0]
-            corr.append(stats.pearsonr(y_true[index,i], y_pred[index,i])[0])
-        else:
-            corr.append(stats.pearsonr(y_true[:,i], y_pred[:,i])[0])
-    return np.array(corr)
+def _valid_targets(y_true, y_pred, mask_value=None):
+    """2D float arrays and a mask of entries that are not NaN or equal to mask_value"""
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    if y_true.ndim == 1:
+        y_true = y_true[:,np.newaxis]
+    if y_pred.ndim == 1:
+        y_pred = y_pred[:,np.newaxis]
+    valid = ~np.isnan(y_true) & ~np.isnan(y_pred)
+    if mask_value is not None:
+        valid &= y_true != mask_value
+    return y_true, y_pred, valid
+
+
+def _masked_pearsonr(y_true, y_pred, valid):
+    """column-wise Pearson correlation over valid entries"""
+    num = np.sum(valid, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_true = np.sum(np.where(valid, y_true, 0), axis=0)/num
+        mean_pred = np.sum(np.where(valid, y_pred, 0), axis=0)/num
+        d_true = np.where(valid, y_true - mean_true, 0)
+        d_pred = np.where(valid, y_pred - mean_pred, 0)
+        corr = np.sum(d_true*d_pred, axis=0)/np.sqrt(np.sum(d_true**2, axis=0)*np.sum(d_pred**2, axis=0))
+    corr[num < 2] = np.nan
+    return corr
+
+
+def masked_mean_squared_error(mask_value):
+    """keras loss: mean squared error over the targets that are not equal to mask_value"""
+    import tensorflow as tf
+
+    def loss(y_true, y_pred):
+        y_true = tf.cast(y_true, y_pred.dtype)
+        valid = tf.cast(tf.not_equal(y_true, mask_value), y_pred.dtype)
+        squared_error = tf.reduce_sum(valid*tf.square(y_true - y_pred), axis=-1)
+        return squared_error/tf.maximum(tf.reduce_sum(valid, axis=-1), 1.)
+    return loss
+
 
+def pearsonr_scores(y_true, y_pred, mask_value=None):
+    """Pearson correlation of each target column, ignoring NaN and masked targets"""
+    return _masked_pearsonr(*_valid_targets(y_true, y_pred, mask_value))
+
+
+def spearmanr_scores(y_true, y_pred, mask_value=None):
+    """Spearman correlation of each target column, ignoring NaN and masked targets"""
+    from scipy import stats
+    y_true, y_pred, valid = _valid_targets(y_true, y_pred, mask_value)
+    rank_true = stats.rankdata(np.where(valid, y_true, np.nan), axis=0, nan_policy='omit')
+    rank_pred = stats.rankdata(np.where(valid, y_pred, np.nan), axis=0, nan_policy='omit')
+    return _masked_pearsonr(rank_true, rank_pred, valid)
+
+
+class CorrelationAccumulator():
+    """Streaming column-wise Pearson correlation over prediction batches.
+
+    Per-column counts, means and co-moments are merged batch by batch, so the
+    full predictions never need to be stored.
+    """
+    def __init__(self, mask_value=None):
+        self.mask_value = mask_value
+        self.count = 0
+        self.mean_true = 0.
+        self.mean_pred = 0.
+        self._m2_true = 0.
+        self._m2_pred = 0.
+        self._comoment = 0.
+
+
+    def update(self, y_true, y_pred):
+        """add a batch of targets and predictions"""
+        y_true, y_pred, valid = _valid_targets(y_true, y_pred, self.mask_value)
+        n = np.sum(valid, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_true = np.nan_to_num(np.sum(np.where(valid, y_true, 0), axis=0)/n)
+            mean_pred = np.nan_to_num(np.sum(np.where(valid, y_pred, 0), axis=0)/n)
+        d_true = np.where(valid, y_true - mean_true, 0)
+        d_pred = np.where(valid, y_pred - mean_pred, 0)
+
+        total = self.count + n
+        scale = np.divide(self.count*n, total, out=np.zeros(np.shape(total)), where=total > 0)
+        delta_true = mean_true - self.mean_true
+        delta_pred = mean_pred - self.mean_pred
+        self._m2_true = self._m2_true + np.sum(d_true**2, axis=0) + delta_true**2*scale
+        self._m2_pred = self._m2_pred + np.sum(d_pred**2, axis=0) + delta_pred**2*scale
+        self._comoment = self._comoment + np.sum(d_true*d_pred, axis=0) + delta_true*delta_pred*scale
+        weight = np.divide(n, total, out=np.zeros(np.shape(total)), where=total > 0)
+        self.mean_true = self.mean_true + delta_true*weight
+        self.mean_pred = self.mean_pred + delta_pred*weight
+        self.count = total
+        return self
+
+
+    def result(self):
+        """Pearson correlation of each column"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = self._comoment/np.sqrt(self._m2_true*self._m2_pred)
+        return np.where(self.count < 2, np.nan, corr)
 
 
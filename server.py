@@ -0,0 +1,440 @@
+"""Local prediction server for trained ResidualBind models.
+
+Serves the *_weights.hdf5 files of a results directory (one model per
+RNAcompete experiment) over HTTP on a TCP port or a Unix socket. Concurrent
+requests for the same experiment are coalesced into batches: a batch is
+dispatched when it reaches max_batch sequences or when its oldest sequence
+has waited max_latency seconds, and right away when requests arrive too
+slowly for waiting to pay off. Each experiment has a bounded queue; when it
+is full, requests are rejected with 503 so that clients back off.
+
+Endpoints:
+    POST /predict   {"experiment": "RNCMPT00001", "sequences": ["ACGU...", ...]}
+                    -> {"predictions": [[score], ...]}
+    GET  /models    experiments available and loaded
+    GET  /metrics   throughput, batch sizes, latency percentiles, queue depth
+    GET  /health
+
+Usage:
+    python server.py --weights_dir ../results/rnacompete_2013/log_norm_seq --port 8000
+
+    client = Client(port=8000)
+    scores = client.predict('RNCMPT00001', sequences)
+"""
+
+import os, json, time, glob, socket, asyncio, argparse, collections, http.client
+import concurrent.futures
+import numpy as np
+from monitor import log_event, set_verbosity
+from helper import encode_sequence
+
+
+def one_hot(sequences, alphabet='ACGU'):
+    """one-hot encode sequences of equal length (T is read as U)"""
+    index = encode_sequence(''.join(sequences), alphabet)
+    if np.any(index < 0):
+        raise ValueError('sequences must only contain the letters ' + alphabet + 'T')
+    return np.eye(len(alphabet), dtype=np.float32)[index].reshape(len(sequences), -1, len(alphabet))
+
+
+#-------------------------------------------------------------------------------------
+# Models
+#-------------------------------------------------------------------------------------
+
+
+class ModelStore():
+    """Models of a results directory, loaded on first use
+
+    backend 'numpy' scores with numpy_inference (no TensorFlow in the server
+    process); 'tensorflow' builds each model and routes it through the
+    frozen inference graph.
+    """
+    def __init__(self, weights_dir, input_shape=(41, 4), backend='numpy', dilations=[2, 4, 8], pool_size=10):
+        self.weights_dir = weights_dir
+        self.input_shape = tuple(input_shape)
+        self.backend = backend
+        self.dilations = dilations
+        self.pool_size = pool_size
+        self.models = {}
+
+
+    def experiments(self):
+        paths = sorted(glob.glob(os.path.join(self.weights_dir, '*_weights.hdf5')))
+        return [os.path.basename(path)[:-len('_weights.hdf5')] for path in paths]
+
+
+    def get(self, experiment):
+        if experiment not in self.models:
+            weights_path = os.path.join(self.weights_dir, experiment + '_weights.hdf5')
+            if os.path.basename(experiment) != experiment or not os.path.exists(weights_path):
+                raise KeyError(experiment)
+            if self.backend == 'numpy':
+                from numpy_inference import NumpyResidualBind
+                model = NumpyResidualBind(weights_path, self.dilations, self.pool_size)
+            else:
+                from numpy_inference import is_variable_length
+                from residualbind import ResidualBind
+                if is_variable_length(weights_path):
+                    raise ValueError('%s is a variable-length model; the server scores fixed-length models'%(
+                                     experiment))
+                model = ResidualBind(list(self.input_shape), 1, weights_path, dilations=self.dilations,
+                                     pool_size=self.pool_size)
+                model.load_weights()
+                model = model.freeze()
+            self.models[experiment] = model
+            log_event('server_load', 'loaded model: ' + experiment, experiment=experiment, backend=self.backend)
+        return self.models[experiment]
+
+
+#-------------------------------------------------------------------------------------
+# Micro-batching
+#-------------------------------------------------------------------------------------
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Batcher():
+    """Coalesces the requests for one model into batches
+
+    Waiting for more requests only pays off when they arrive faster than
+    max_latency, so the batcher tracks the mean time between arrivals and
+    dispatches a batch immediately when the next request is not expected
+    before the deadline.
+    """
+    def __init__(self, predict, executor, metrics, max_batch=1000, max_latency=0.005, max_queue=20000):
+        self.predict = predict
+        self.executor = executor
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+        self.queued = 0
+        self.arrival = asyncio.Event()
+        self.last_arrival = None
+        self.interval = None
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+
+    def submit(self, x):
+        """future with the predictions of x; raises QueueFull when the queue would exceed max_queue
+           sequences (a larger request is accepted into an empty queue)"""
+        if self.queued and self.queued + len(x) > self.max_queue:
+            raise QueueFull()
+        now = time.perf_counter()
+        if self.last_arrival is not None:
+            # moving average of the time between requests
+            interval = now - self.last_arrival
+            self.interval = interval if self.interval is None else 0.9*self.interval + 0.1*interval
+        self.last_arrival = now
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((x, future, now))
+        self.queued += len(x)
+        self.arrival.set()
+        return future
+
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.queue:
+                self.arrival.clear()
+                await self.arrival.wait()
+
+            # collect requests until the batch is full or the oldest request is due
+            deadline = self.queue[0][2] + self.max_latency
+            while self.queued < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or self.interval is None or self.interval > remaining:
+                    break
+                self.arrival.clear()
+                try:
+                    await asyncio.wait_for(self.arrival.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            requests, size = [], 0
+            while self.queue and (not requests or size + len(self.queue[0][0]) <= self.max_batch):
+                request = self.queue.popleft()
+                requests.append(request)
+                size += len(request[0])
+            self.queued -= size
+
+            start = time.perf_counter()
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.predict,
+                                                         np.concatenate([r[0] for r in requests]))
+            except Exception as error:
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.metrics.batch(size, time.perf_counter() - start)
+
+            offset = 0
+            for x, future, _ in requests:
+                if not future.done():
+                    future.set_result(predictions[offset:offset+len(x)])
+                offset += len(x)
+
+
+class Metrics():
+    """Request, batch and latency statistics of the server"""
+    def __init__(self, window=10000):
+        self.start = time.time()
+        self.requests = 0
+        self.sequences = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_sequences = 0
+        self.predict_seconds = 0.
+        self.latencies = collections.deque(maxlen=window)
+
+
+    def batch(self, size, seconds):
+        self.batches += 1
+        self.batch_sequences += size
+        self.predict_seconds += seconds
+
+
+    def request(self, num_sequences, latency):
+        self.requests += 1
+        self.sequences += num_sequences
+        self.latencies.append(latency)
+
+
+    def snapshot(self, queued=0):
+        uptime = time.time() - self.start
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {'uptime_seconds': uptime,
+                'requests': self.requests,
+                'sequences': self.sequences,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch_size': self.batch_sequences/max(self.batches, 1),
+                'seqs_per_sec': self.sequences/max(uptime, 1e-9),
+                'predict_seqs_per_sec': self.batch_sequences/max(self.predict_seconds, 1e-9),
+                'latency_ms': {'p50': 1000*np.percentile(latencies, 50),
+                               'p90': 1000*np.percentile(latencies, 90),
+                               'p99': 1000*np.percentile(latencies, 99),
+                               'max': 1000*np.max(latencies)},
+                'queued_sequences': queued}
+
+
+#-------------------------------------------------------------------------------------
+# HTTP
+#-------------------------------------------------------------------------------------
+
+
+class PredictionServer():
+    """asyncio HTTP/1.1 server for the models of a ModelStore"""
+    def __init__(self, store, max_batch=1000, max_latency=0.005, max_queue=20000):
+        self.store = store
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_queue = max_queue
+        self.metrics = Metrics()
+        self.batchers = {}
+        # experiment -> future of a model being loaded, shared by concurrent first requests
+        self.loading = {}
+        # one prediction at a time; a batch uses all cores
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+    async def batcher(self, experiment):
+        if experiment not in self.batchers:
+            # models are loaded off the event loop, on the prediction thread (a tensorflow
+            # model clears the keras session while it is built)
+            if experiment not in self.loading:
+                self.loading[experiment] = asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.store.get, experiment)
+            try:
+                model = await self.loading[experiment]
+            finally:
+                # a failed load is retried by the next request
+                self.loading.pop(experiment, None)
+            if experiment in self.batchers:
+                return self.batchers[experiment]
+            self.batchers[experiment] = Batcher(lambda x: model.predict(x, batch_size=self.max_batch),
+                                                self.executor, self.metrics, self.max_batch,
+                                                self.max_latency, self.max_queue)
+        return self.batchers[experiment]
+
+
+    async def predict(self, request):
+        start = time.perf_counter()
+        if not isinstance(request, dict) or 'experiment' not in request or 'sequences' not in request:
+            raise ValueError('request must have the fields experiment and sequences')
+        sequences = request['sequences']
+        if not sequences:
+            return 200, {'predictions': []}
+        if any(len(sequence) != self.store.input_shape[0] for sequence in sequences):
+            raise ValueError('sequences must have length %d'%(self.store.input_shape[0]))
+        x = one_hot(sequences)
+        batcher = await self.batcher(request['experiment'])
+        try:
+            predictions = await batcher.submit(x)
+        except QueueFull:
+            self.metrics.rejected += 1
+            return 503, {'error': 'queue full, retry later'}
+        self.metrics.request(len(x), time.perf_counter() - start)
+        return 200, {'predictions': np.asarray(predictions).tolist()}
+
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/predict':
+            try:
+                request = json.loads(body)
+            except ValueError:
+                return 400, {'error': 'request body must be json'}
+            try:
+                return await self.predict(request)
+            except KeyError as error:
+                return 404, {'error': 'unknown experiment: %s'%(error.args[0])}
+            except ValueError as error:
+                return 400, {'error': str(error)}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.snapshot(sum(b.queued for b in self.batchers.values()))
+        if method == 'GET' and path == '/models':
+            return 200, {'experiments': self.store.experiments(), 'loaded': sorted(self.store.models)}
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': 'not found'}
+
+
+    async def handle(self, reader, writer):
+        """serve requests of one (keep-alive) connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, response = await self.route(method, path, body)
+                except Exception as error:
+                    self.metrics.errors += 1
+                    log_event('server_error', str(error), error=repr(error))
+                    status, response = 500, {'error': str(error)}
+
+                payload = json.dumps(response, default=float).encode('utf8')
+                reason = http.client.responses.get(status, '')
+                extra = 'Retry-After: 1\r\n' if status == 503 else ''
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n'
+                              %(status, reason, len(payload), extra)).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_socket=None):
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+            address = unix_socket
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            address = '%s:%d'%(host, server.sockets[0].getsockname()[1])
+        log_event('server_start', 'serving %s on %s'%(self.store.weights_dir, address), address=address,
+                  max_batch=self.max_batch, max_latency=self.max_latency, max_queue=self.max_queue)
+        async with server:
+            await server.serve_forever()
+
+
+#-------------------------------------------------------------------------------------
+# Client
+#-------------------------------------------------------------------------------------
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Client():
+    """Keep-alive client of a PredictionServer (not thread-safe: one client per thread)"""
+    def __init__(self, host='127.0.0.1', port=8000, unix_socket=None, timeout=60, retries=10):
+        if unix_socket:
+            self.connection = UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.retries = retries
+
+
+    def request(self, method, path, body=None):
+        for attempt in range(self.retries + 1):
+            self.connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                    headers={'Content-Type': 'application/json'})
+            response = self.connection.getresponse()
+            result = json.loads(response.read())
+            if response.status == 503 and attempt < self.retries:
+                # back off while the server's queue is full
+                time.sleep(0.01*2**attempt)
+                continue
+            if response.status != 200:
+                raise RuntimeError('%d: %s'%(response.status, result.get('error')))
+            return result
+
+
+    def predict(self, experiment, sequences):
+        result = self.request('POST', '/predict', {'experiment': experiment, 'sequences': list(sequences)})
+        return np.array(result['predictions'], dtype=np.float32)
+
+
+    def metrics(self):
+        return self.request('GET', '/metrics')
+
+
+    def models(self):
+        return self.request('GET', '/models')
+
+
+    def close(self):
+        self.connection.close()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve ResidualBind predictions from a directory of weights files')
+    parser.add_argument('--weights_dir', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', default=None, help='serve on a Unix socket instead of a TCP port')
+    parser.add_argument('--input_length', type=int, default=41)
+    parser.add_argument('--backend', choices=['numpy', 'tensorflow'], default='numpy')
+    parser.add_argument('--max_batch', type=int, default=1000, help='sequences per batch')
+    parser.add_argument('--max_latency_ms', type=float, default=5., help='longest wait for a batch to fill')
+    parser.add_argument('--max_queue', type=int, default=20000, help='queued sequences per model before rejecting')
+    args = parser.parse_args()
+
+    set_verbosity(1)
+    store = ModelStore(args.weights_dir, (args.input_length, 4), args.backend)
+    server = PredictionServer(store, args.max_batch, args.max_latency_ms/1000, args.max_queue)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
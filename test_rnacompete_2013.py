@@ -1,8 +1,10 @@
-import os
+import os, time
 import numpy as np
 from tensorflow.keras import backend as K
 from residualbind import ResidualBind
 import helper
+from performance import autotune
+from monitor import monitor, SweepReport, trace, set_verbosity, log_to_jsonl
 
 #---------------------------------------------------------------------------------------
 
@@ -11,31 +13,44 @@ ss_type = 'seq'                  # 'seq', 'pu', or 'struct'
 data_path = '../data/RNAcompete_2013/rnacompete2013.h5'
 results_path = helper.make_directory('../results', 'rnacompete_2013')
 save_path = helper.make_directory(results_path, normalization+'_'+ss_type)
+profile_path = None              # directory for a TensorFlow profiler trace of the first experiment
+verbose = 1                      # 0: silent, 1: progress, 2: keras progress bars
+performance_path = os.path.join(results_path, 'performance_predict.json')  # tuned settings for this machine
+
+set_verbosity(verbose)
+log_to_jsonl(os.path.join(results_path, normalization+'_'+ss_type+'_test_events.jsonl'))
 
 #---------------------------------------------------------------------------------------
 
 # loop over different RNA binding proteins
 pearsonr_scores = []
+sweep = SweepReport()
 experiments = helper.get_experiment_names(data_path)
 for rbp_index, experiment in enumerate(experiments):
     print('Analyzing: '+ experiment)
+    monitor.reset()
+    start = time.time()
+    with trace(profile_path if rbp_index == 0 else None):
+        # load rbp dataset
+        train, valid, test = helper.load_rnacompete_data(data_path, 
+                                                         ss_type=ss_type, 
+                                                         normalization=normalization, 
+                                                         rbp_index=rbp_index)
 
-    # load rbp dataset
-    train, valid, test = helper.load_rnacompete_data(data_path, 
-                                                     ss_type=ss_type, 
-                                                     normalization=normalization, 
-                                                     rbp_index=rbp_index)
-
-    # load residualbind model
-    input_shape = list(train['inputs'].shape)[1:]
-    num_class = 1
-    weights_path = os.path.join(save_path, experiment + '_weights.hdf5')    
-    model = ResidualBind(input_shape, num_class, weights_path)
-    model.load_weights()
+        # load residualbind model
+        input_shape = list(train['inputs'].shape)[1:]
+        num_class = 1
+        weights_path = os.path.join(save_path, experiment + '_weights.hdf5')    
+        performance = autotune(input_shape, mode='predict', cache_path=performance_path)
+        model = ResidualBind(input_shape, num_class, weights_path, performance=performance)
+        model.load_weights()
 
-    # evaluate model
-    corr = model.test_model(test, batch_size=500)
-    print("  Test: "+str(np.mean(corr)))
+        # evaluate model
+        corr = model.test_model(test)
+        print("  Test: "+str(np.mean(corr)))
+    monitor.add_time('experiment', time.time() - start)
+    print(monitor.report('  Timing: ' + experiment))
+    sweep.add(experiment, monitor.snapshot())
 
     pearsonr_scores.append(corr)
 pearsonr_scores = np.array(pearsonr_scores)
@@ -48,3 +63,7 @@ with open(file_path, 'w') as f:
     f.write('%s\t%s\n'%('Experiment', 'Pearson score'))
     for experiment, score in zip(experiments, pearsonr_scores):
         f.write('%s\t%.4f\n'%(experiment, score))
+
+# save per-experiment and aggregated timings
+print(sweep.report())
+sweep.write(os.path.join(results_path, normalization+'_'+ss_type+'_test_timing.json'))
@@ -1,8 +1,10 @@
-import os
+import os, time
 import numpy as np
 from tensorflow.keras import backend as K
 from residualbind import ResidualBind
-import helper
+import helper, distributed
+from performance import autotune
+from monitor import monitor, SweepReport, trace, set_verbosity, log_to_jsonl
 
 #---------------------------------------------------------------------------------------
 
@@ -10,45 +12,95 @@ normalization = 'log_norm'   # 'log_norm' or 'clip_norm'
 ss_type = 'seq'                  # 'seq', 'pu', or 'struct'
 data_path = '../data/RNAcompete_2013/rnacompete2013.h5'
 results_path = helper.make_directory('../results', 'rnacompete_2013')
-save_path = helper.make_directory(results_path, normalization+'_'+ss_type)
+trunk_path = None                # pretrained trunk from pretrain_rnacompete_2013.py to fine-tune from
+freeze_trunk = True              # fine-tune only the dense head
+run_name = normalization+'_'+ss_type + ('_finetune' if trunk_path else '')
+save_path = helper.make_directory(results_path, run_name)
+profile_path = None              # directory for a TensorFlow profiler trace of the first experiment
+verbose = 1                      # 0: silent, 1: progress, 2: keras progress bars
+performance_path = os.path.join(results_path, 'performance_train.json')  # tuned thread settings for this machine
+
+# data-parallel training when launched with: python distributed.py --num_workers N train_rnacompete_2013.py
+strategy = distributed.strategy_from_env()
+chief = distributed.is_chief()
+
+if chief:
+    set_verbosity(verbose)
+    log_to_jsonl(os.path.join(results_path, run_name+'_events.jsonl'))
 
 #---------------------------------------------------------------------------------------
 
 # loop over different RNA binding proteins
 pearsonr_scores = []
+convergence = []
+sweep = SweepReport()
 experiments = helper.get_experiment_names(data_path)
 for rbp_index, experiment in enumerate(experiments):
     print('Analyzing: '+ experiment)
+    monitor.reset()
+    start = time.time()
+    with trace(profile_path if rbp_index == 0 else None):
+        # load rbp dataset
+        train, valid, test = helper.load_rnacompete_data(data_path, 
+                                                         ss_type=ss_type, 
+                                                         normalization=normalization, 
+                                                         rbp_index=rbp_index,
+                                                         shard=distributed.shard())
+
+        # load residualbind model
+        input_shape = list(train['inputs'].shape)[1:]
+        num_class = 1
+        weights_path = os.path.join(save_path, experiment + '_weights.hdf5')    
+        # thread pools are tuned for training; the batch size stays 100 as it affects the optimization
+        # (workers of a data-parallel run share the machine and use distributed.py --threads_per_worker)
+        performance = None
+        if strategy is None:
+            performance = autotune(input_shape, mode='train', batch_sizes=[100], cache_path=performance_path)
+        resnet = ResidualBind(input_shape, num_class, weights_path, performance=performance, strategy=strategy)
+        if trunk_path:
+            resnet.load_trunk(trunk_path, trainable=not freeze_trunk)
 
-    # load rbp dataset
-    train, valid, test = helper.load_rnacompete_data(data_path, 
-                                                     ss_type=ss_type, 
-                                                     normalization=normalization, 
-                                                     rbp_index=rbp_index)
-
-    # load residualbind model
-    input_shape = list(train['inputs'].shape)[1:]
-    num_class = 1
-    weights_path = os.path.join(save_path, experiment + '_weights.hdf5')    
-    resnet = ResidualBind(input_shape, num_class, weights_path)
-
-    # fit model
-    resnet.fit(train, valid, num_epochs=300, batch_size=100, patience=20, 
-              lr=0.001, lr_decay=0.3, decay_patience=7)
-        
-    # evaluate model
-    metrics = resnet.test_model(test, batch_size=100, load_weights='best')
-    print("  Test: "+str(np.mean(metrics)))
+        # fit model
+        resnet.fit(train, valid, num_epochs=300, patience=20, 
+                  lr=0.001, lr_decay=0.3, decay_patience=7)
+
+        # evaluate model
+        metrics = resnet.test_model(test, load_weights='best')
+        print("  Test: "+str(np.mean(metrics)))
+    monitor.add_time('experiment', time.time() - start)
+    convergence.append([len(resnet.history['val_pearsonr']), time.time() - start])
+    print(monitor.report('  Timing: ' + experiment))
+    sweep.add(experiment, monitor.snapshot())
 
     pearsonr_scores.append(metrics)
 pearsonr_scores = np.array(pearsonr_scores)
 
-print('FINAL RESULTS: %.4f+/-%.4f'%(np.mean(pearsonr_scores), np.std(pearsonr_scores)))
+# only the chief writes results
+if chief:
+    print('FINAL RESULTS: %.4f+/-%.4f'%(np.mean(pearsonr_scores), np.std(pearsonr_scores)))
+
+    # save results to table
+    file_path = os.path.join(results_path, run_name+'_performance.tsv')
+    with open(file_path, 'w') as f:
+        f.write('%s\t%s\n'%('Experiment', 'Pearson score'))
+        for experiment, score in zip(experiments, pearsonr_scores):
+            f.write('%s\t%.4f\n'%(experiment, score))
 
-# save results to table
-file_path = os.path.join(results_path, normalization+'_'+ss_type+'_performance.tsv')
-with open(file_path, 'w') as f:
-    f.write('%s\t%s\n'%('Experiment', 'Pearson score'))
-    for experiment, score in zip(experiments, pearsonr_scores):
-        f.write('%s\t%.4f\n'%(experiment, score))
+    # epochs and time to convergence, compared with training from scratch when that was run
+    file_path = os.path.join(results_path, run_name+'_convergence.tsv')
+    with open(file_path, 'w') as f:
+        f.write('%s\t%s\t%s\n'%('Experiment', 'Epochs', 'Seconds'))
+        for experiment, (epochs, seconds) in zip(experiments, convergence):
+            f.write('%s\t%d\t%.1f\n'%(experiment, epochs, seconds))
+    epochs, seconds = np.sum(convergence, axis=0)
+    print('Sweep: %d epochs, %.1f minutes'%(epochs, seconds/60))
+    scratch_path = os.path.join(results_path, normalization+'_'+ss_type+'_convergence.tsv')
+    if trunk_path and os.path.exists(scratch_path):
+        scratch = np.loadtxt(scratch_path, skiprows=1, usecols=[1, 2], ndmin=2)
+        scratch_epochs, scratch_seconds = np.sum(scratch, axis=0)
+        print('From scratch: %d epochs, %.1f minutes (%.1fx epochs, %.1fx time with the pretrained trunk)'%(
+              scratch_epochs, scratch_seconds/60, scratch_epochs/epochs, scratch_seconds/seconds))
 
+    # save per-experiment and aggregated timings
+    print(sweep.report())
+    sweep.write(os.path.join(results_path, run_name+'_timing.json'))
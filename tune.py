@@ -0,0 +1,181 @@
+"""Hyperparameter search for ResidualBind with successive halving and Hyperband.
+
+Trials are trained for a few epochs, the best 1/eta by validation Pearson r
+are continued for eta times as many epochs, and the rest are stopped.
+Continued trials resume from their best weights (the optimizer state starts
+fresh at the learning rate the trial had reached). Trials run in a pool of
+forked worker processes that share the loaded dataset, each with its share
+of the cores. The parent process must not have initialized TensorFlow, since
+TensorFlow does not survive a fork.
+
+Usage:
+    train, valid, test = helper.load_rnacompete_data(data_path, rbp_index=rbp_index)
+    best, trials = tune.hyperband(train, valid, tune.DEFAULT_SPACE, max_epochs=81, eta=3, num_workers=4)
+"""
+
+import os, sys, json, math, logging, tempfile, multiprocessing
+import numpy as np
+from monitor import log_event
+
+
+# architecture (ResidualBind arguments) and training (fit arguments) hyperparameters
+DEFAULT_SPACE = {
+    'num_filters': [64, 96, 128],
+    'kernel_size': [7, 11, 15],
+    'dilations': [[2, 4], [2, 4, 8], [1, 2, 4, 8]],
+    'pool_size': [5, 10],
+    'dense_units': [128, 256, 512],
+    'lr': [0.0003, 0.001, 0.003],
+    'lr_decay': [0.3, 0.5],
+    'decay_patience': [5, 7],
+    'patience': [10, 20],
+}
+
+ARCHITECTURE_KEYS = ['num_filters', 'kernel_size', 'dilations', 'pool_size', 'dense_units']
+FIT_KEYS = ['batch_size', 'lr', 'lr_decay', 'decay_patience', 'patience']
+
+
+def sample_configs(space, num_configs, seed=None):
+    """random configurations from a dictionary of hyperparameter -> list of values"""
+    rng = np.random.RandomState(seed)
+    return [{key: values[rng.randint(len(values))] for key, values in space.items()} for _ in range(num_configs)]
+
+
+#-------------------------------------------------------------------------------------
+# Trials (run in forked worker processes)
+#-------------------------------------------------------------------------------------
+
+
+# dataset shared with forked workers (copy-on-write, never pickled)
+_dataset = None
+
+
+def _init_worker(intra_op_threads):
+    from performance import PerformanceConfig
+    PerformanceConfig(intra_op_threads=intra_op_threads, inter_op_threads=1).apply()
+
+
+def run_trial(trial):
+    """train a trial up to trial['budget'] epochs in total, resuming from its checkpoint"""
+    from tensorflow.keras import backend as K
+    from residualbind import ResidualBind
+    train, valid = _dataset
+    config = trial['config']
+    architecture = {key: config[key] for key in ARCHITECTURE_KEYS if key in config}
+    fit_args = {key: config[key] for key in FIT_KEYS if key in config}
+
+    model = ResidualBind(list(train['inputs'].shape)[1:], train['targets'].shape[1], trial['weights_path'],
+                         **architecture)
+    previous = None
+    if trial['epochs'] > 0:
+        fit_args['lr'] = trial['lr']
+        # earlier rungs write a checkpoint only once an epoch has a finite validation r
+        if os.path.exists(trial['weights_path']):
+            from checkpoint import snapshot_weights
+            model.load_weights()
+            previous = snapshot_weights(model.model)
+
+    model.fit(train, valid, num_epochs=trial['budget'] - trial['epochs'], **fit_args)
+    history = model.history
+    if previous is not None and not (history['best_val_pearsonr'] is not None and
+                                     history['best_val_pearsonr'] > trial['val_pearsonr']):
+        # the checkpoint keeps the best weights over all rungs
+        model.save_checkpoint(previous)
+    model.wait_for_checkpoints()
+
+    trial = dict(trial)
+    trial['epochs'] += len(history['val_pearsonr'])
+    # the rate after the last epoch's decay, which the next rung continues from
+    trial['lr'] = float(K.get_value(model.model.optimizer.lr))
+    trial['early_stopped'] = history['early_stopped']
+    if history['best_val_pearsonr'] is not None:
+        trial['val_pearsonr'] = max(trial['val_pearsonr'], history['best_val_pearsonr'])
+    trial['history'] = trial['history'] + history['val_pearsonr']
+    return trial
+
+
+def _map(trials, num_workers):
+    """run trials in a pool of forked workers (in process if num_workers is 1)"""
+    if num_workers == 1:
+        return [run_trial(trial) for trial in trials]
+    if 'tensorflow' in sys.modules:
+        log_event('tune_warning', 'tensorflow was imported before forking trial workers', level=logging.WARNING)
+    context = multiprocessing.get_context('fork')
+    intra_op_threads = max(1, (os.cpu_count() or 1)//num_workers)
+    with context.Pool(num_workers, initializer=_init_worker, initargs=(intra_op_threads,),
+                      maxtasksperchild=1) as pool:
+        return pool.map(run_trial, trials, chunksize=1)
+
+
+#-------------------------------------------------------------------------------------
+# Scheduling
+#-------------------------------------------------------------------------------------
+
+
+def successive_halving(train, valid, configs, min_epochs=3, max_epochs=81, eta=3, num_workers=1, work_dir=None):
+    """train configs for min_epochs, keep the best 1/eta and train them eta times longer, until
+       max_epochs; returns all trials sorted by best validation Pearson r"""
+    global _dataset
+    _dataset = (train, valid)
+    work_dir = work_dir or tempfile.mkdtemp(prefix='residualbind_tune_')
+    os.makedirs(work_dir, exist_ok=True)
+    trials = [{'trial': i, 'config': config, 'epochs': 0, 'lr': config.get('lr', 0.001), 'val_pearsonr': -np.inf,
+               'history': [], 'early_stopped': False, 'weights_path': os.path.join(work_dir, 'trial_%d.hdf5'%(i))}
+              for i, config in enumerate(configs)]
+
+    budget = min_epochs
+    active = trials
+    finished = []
+    while active:
+        # trials that stopped early keep their result and are not trained further
+        for trial in active:
+            trial['budget'] = min(budget, max_epochs)
+        active = _map(active, num_workers)
+        log_event('tune_rung', 'rung of %d epochs: best validation r %.4f'%(budget, max(t['val_pearsonr'] for t in active)),
+                  budget=budget, num_trials=len(active), val_pearsonr=[t['val_pearsonr'] for t in active])
+
+        stopped = [t for t in active if t['early_stopped']]
+        active = sorted([t for t in active if not t['early_stopped']], key=lambda t: t['val_pearsonr'], reverse=True)
+        finished += stopped
+        if budget >= max_epochs or len(active) <= 1:
+            finished += active
+            break
+
+        num_keep = max(1, len(active)//eta)
+        finished += active[num_keep:]
+        active = active[:num_keep]
+        budget *= eta
+
+    return sorted(finished, key=lambda t: t['val_pearsonr'], reverse=True)
+
+
+def hyperband(train, valid, space=DEFAULT_SPACE, max_epochs=81, eta=3, num_workers=1, seed=None, work_dir=None):
+    """Hyperband: successive halving brackets from many short trials to few full-length trials
+
+    Returns the best trial and all trials (with the bracket they ran in).
+    """
+    s_max = int(math.floor(math.log(max_epochs)/math.log(eta) + 1e-9))
+    rng = np.random.RandomState(seed)
+    work_dir = work_dir or tempfile.mkdtemp(prefix='residualbind_tune_')
+
+    all_trials = []
+    for s in range(s_max, -1, -1):
+        num_configs = int(math.ceil((s_max + 1)/(s + 1)*eta**s))
+        min_epochs = max(1, int(round(max_epochs*eta**(-s))))
+        configs = sample_configs(space, num_configs, rng.randint(2**31))
+        trials = successive_halving(train, valid, configs, min_epochs, max_epochs, eta, num_workers,
+                                    os.path.join(work_dir, 'bracket_%d'%(s)))
+        for trial in trials:
+            trial['bracket'] = s
+        all_trials += trials
+
+    all_trials = sorted(all_trials, key=lambda t: t['val_pearsonr'], reverse=True)
+    return all_trials[0], all_trials
+
+
+def write_trials(trials, file_path):
+    """save trial results as json"""
+    with open(file_path, 'w') as f:
+        json.dump([{key: value for key, value in trial.items() if key != 'weights_path'} for trial in trials],
+                  f, indent=2, default=float)
+    return file_path
@@ -0,0 +1,54 @@
+import os, time
+import numpy as np
+import helper, tune
+from monitor import set_verbosity, log_to_jsonl
+
+# tensorflow is imported by the forked trial workers only (tune.py)
+
+#---------------------------------------------------------------------------------------
+
+normalization = 'log_norm'   # 'log_norm' or 'clip_norm'
+ss_type = 'seq'                  # 'seq', 'pu', or 'struct'
+data_path = '../data/RNAcompete_2013/rnacompete2013.h5'
+results_path = helper.make_directory('../results', 'rnacompete_2013')
+save_path = helper.make_directory(results_path, 'tune_'+normalization+'_'+ss_type)
+max_epochs = 81                  # epochs of the longest trials
+eta = 3                          # fraction of trials (1/eta) continued at each rung
+num_workers = 4                  # trials trained in parallel
+verbose = 1                      # 0: silent, 1: progress
+
+set_verbosity(verbose)
+log_to_jsonl(os.path.join(results_path, 'tune_'+normalization+'_'+ss_type+'_events.jsonl'))
+
+#---------------------------------------------------------------------------------------
+
+# loop over different RNA binding proteins
+best_trials = []
+experiments = helper.get_experiment_names(data_path)
+for rbp_index, experiment in enumerate(experiments):
+    print('Tuning: '+ experiment)
+    start = time.time()
+
+    # load rbp dataset
+    train, valid, test = helper.load_rnacompete_data(data_path, 
+                                                     ss_type=ss_type, 
+                                                     normalization=normalization, 
+                                                     rbp_index=rbp_index)
+
+    # hyperband search, keeping the trial weights of each experiment
+    best, trials = tune.hyperband(train, valid, tune.DEFAULT_SPACE, max_epochs=max_epochs, eta=eta,
+                                  num_workers=num_workers, seed=rbp_index,
+                                  work_dir=os.path.join(save_path, experiment))
+    tune.write_trials(trials, os.path.join(save_path, experiment+'_trials.json'))
+
+    epochs = np.sum([trial['epochs'] for trial in trials])
+    print("  Best: %.4f with %s"%(best['val_pearsonr'], str(best['config'])))
+    print("  %d trials, %d epochs in total, %.1f minutes"%(len(trials), epochs, (time.time() - start)/60))
+    best_trials.append(best)
+
+# save best configuration of each experiment to table
+file_path = os.path.join(results_path, 'tune_'+normalization+'_'+ss_type+'_best.tsv')
+with open(file_path, 'w') as f:
+    f.write('%s\t%s\t%s\t%s\n'%('Experiment', 'Validation Pearson score', 'Epochs', 'Configuration'))
+    for experiment, best in zip(experiments, best_trials):
+        f.write('%s\t%.4f\t%d\t%s\n'%(experiment, best['val_pearsonr'], best['epochs'], str(best['config'])))